@@ -0,0 +1,614 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import argparse
+from collections import deque
+from dataclasses import dataclass, asdict
+
+import openai
+
+from page_renderer import render_page_number, ImageBudget
+from render_pipeline import get_render_pool
+from page_triage import triage_pages, merge_descriptions, PAGE_VISION
+from vision_analyzer import vision_payload, vision_cost, get_pdf_page_count, VISION_MODEL, VISION_MAX_TOKENS
+from vision_cache import cache_key, get_default_cache
+from prompt_templates.vision_prompt import default_vision_prompt
+from prompt_templates.iteration_prompts import initial_prompt, merge_prompt
+from prompt_templates.default_summary_template import default_summary_template
+from gpt4_summarizer import split_text, merge_groups, completion_cost, set_verbosity, SUMMARY_MODEL
+from response_parser import structurize_locally, headings_prompt, split_on_headings
+from request_scheduler import get_scheduler
+from openai_session import get_settings, get_async_client, get_openai_client, close_async_client
+from deck_store import DeckStore, DECK_STORE_PATH, file_sha256, find_decks
+from tracing import span, configure_tracing
+
+
+BATCH_FOLDER = os.path.join(".cache", "batches")
+BATCH_ENDPOINT = "/v1/chat/completions"
+# The Batch API bills half the price of synchronous requests
+BATCH_PRICE_FACTOR = 0.5
+# Rounds a request may fail or expire in before its deck is given up
+MAX_ATTEMPTS = 3
+# A round is split into request files under the Batch API's input limits (200 MB, 50,000 requests)
+MAX_SHARD_BYTES = 190_000_000
+MAX_SHARD_REQUESTS = 50_000
+
+STAGE_VISION = "vision"
+STAGE_SUMMARY = "summary"
+STAGE_STRUCTURE = "structure"
+STAGE_DONE = "done"
+STAGE_FAILED = "failed"
+
+
+@dataclass
+class BatchOptions:
+    zoom_factor: float = 1.0
+    image_format: str = "jpeg"
+    quality: int = 80
+    adaptive: bool = False
+    triage: bool = False
+    use_cache: bool = True
+    summary_template: str = None
+    merge_fanout: int = 2
+    max_chunk_tokens: int = None
+    structurize: bool = True
+    max_shard_bytes: int = MAX_SHARD_BYTES
+    max_shard_requests: int = MAX_SHARD_REQUESTS
+
+
+def custom_id(deck, stage, index):
+    # Deck, stage and position of the request's answer; a summary index also carries its merge round
+    return f"{deck['deck_hash'][:16]}/{stage}/{index}"
+
+
+def chat_request(request_id, body):
+    return {"custom_id": request_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+
+
+def summary_body(prompt):
+    return {"model": SUMMARY_MODEL, "messages": [{"role": "system", "content": prompt}], "temperature": 0}
+
+
+def render_pages(pdf_path, page_numbers, render_args, window=None):
+    """
+    Renders the pages in the render process pool and yields (page_number, image_bytes)
+    in page order. At most `window` pages (twice the CPUs by default) are rendered
+    ahead of the consumer, so a long deck is never held in memory whole.
+    """
+    pool = get_render_pool()
+    window = window or 2 * (os.cpu_count() or 1)
+    pending = deque()
+    try:
+        for page_number in page_numbers:
+            pending.append((page_number, pool.submit(render_page_number, pdf_path, page_number, *render_args)))
+            if len(pending) >= window:
+                page_number, future = pending.popleft()
+                yield page_number, future.result()
+        while pending:
+            page_number, future = pending.popleft()
+            yield page_number, future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+def read_results(path):
+    """ {custom_id: (content, usage)} of the answered requests in a Batch API output file, failed ones left out """
+    results = {}
+    with open(path, encoding="utf-8") as results_file:
+        for line in results_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                continue
+            body = response["body"]
+            content = body["choices"][0]["message"]["content"]
+            if content:
+                results[record["custom_id"]] = content, body.get("usage") or {}
+    return results
+
+
+class BatchPipeline:
+    """
+    Runs the pipeline for a set of decks as rounds of Batch API requests instead of
+    synchronous calls: write_requests() writes every request the decks need next
+    (vision per page, map_reduce summary steps, heading extraction) as JSON lines
+    files, one batch each, and ingest() reads the Batch API's output files back,
+    matching the answers to decks, pages and steps by custom_id, and moves every
+    deck on to its next stage. Failed or expired requests are written again in the
+    next round.
+
+    All state lives in `folder` (state.json and the request and result files), so a
+    run can be picked up by any process, e.g. the next night.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.state_path = os.path.join(folder, "state.json")
+        with open(self.state_path, encoding="utf-8") as state_file:
+            self.state = json.load(state_file)
+        self.options = BatchOptions(**self.state["options"])
+        pending = self.state["pending"]
+        if pending is not None and "file" in pending:
+            # A round written before rounds were split into shards
+            self.state["pending"] = {"custom_ids": pending["custom_ids"],
+                                     "shards": [{"file": pending["file"], "batch_id": pending["batch_id"]}]}
+        self.summary_template = self.options.summary_template or default_summary_template()
+
+    @classmethod
+    def start(cls, folder, paths, options=None):
+        """ Sets up a batch run for the decks in folder, one entry per distinct deck """
+        options = options or BatchOptions()
+        os.makedirs(folder, exist_ok=True)
+        decks = {}
+        for path in paths:
+            deck_hash = file_sha256(path)
+            decks.setdefault(deck_hash[:16], {
+                "path": os.path.abspath(path), "deck_hash": deck_hash, "stage": STAGE_VISION, "plan": None,
+                "page_numbers": None, "descriptions": {}, "cache_keys": {}, "round": 0, "inputs": [], "outputs": [],
+                "summary": None, "structured": None, "cost": 0.0, "attempts": {}, "error": None,
+            })
+        state = {"options": asdict(options), "round": 0, "pending": None, "decks": decks, "created": time.time()}
+        _write_json(os.path.join(folder, "state.json"), state)
+        return cls(folder)
+
+    def save(self):
+        _write_json(self.state_path, self.state)
+
+    @property
+    def decks(self):
+        return self.state["decks"]
+
+    def counts(self):
+        counts = {}
+        for deck in self.decks.values():
+            counts[deck["stage"]] = counts.get(deck["stage"], 0) + 1
+        return counts
+
+    def write_requests(self):
+        """
+        Writes the requests of the next round and returns the paths of its files, or None
+        when no deck needs any. A file is closed once it would grow past max_shard_bytes
+        or max_shard_requests, each file is one batch. The round stays pending until its
+        results are ingested; calling this again before that returns the same files.
+        """
+        pending = self.state["pending"]
+        if pending is not None:
+            return [os.path.join(self.folder, shard["file"]) for shard in pending["shards"]]
+
+        round_number = self.state["round"] + 1
+        options = self.options
+        custom_ids, shards = [], []
+        shard_file, shard_bytes, shard_requests = None, 0, 0
+        with span("batch.write", round=round_number) as write_span:
+            try:
+                for deck in self.decks.values():
+                    try:
+                        for request in self._deck_requests(deck):
+                            line = (json.dumps(request) + "\n").encode("utf-8")
+                            if shard_file is None or (shard_requests and (
+                                    shard_bytes + len(line) > options.max_shard_bytes or shard_requests >= options.max_shard_requests)):
+                                if shard_file is not None:
+                                    shard_file.close()
+                                shards.append(f"{round_number:03d}.{len(shards) + 1:02d}.requests.jsonl")
+                                shard_file = open(os.path.join(self.folder, f"{shards[-1]}.tmp"), "wb")
+                                shard_bytes, shard_requests = 0, 0
+                            shard_file.write(line)
+                            shard_bytes += len(line)
+                            shard_requests += 1
+                            custom_ids.append(request["custom_id"])
+                    except Exception as e:
+                        deck.update(stage=STAGE_FAILED, error=f"{type(e).__name__}: {e}")
+            finally:
+                if shard_file is not None:
+                    shard_file.close()
+            write_span.set(requests=len(custom_ids), shards=len(shards))
+
+        if not custom_ids:
+            for name in shards:
+                os.remove(os.path.join(self.folder, f"{name}.tmp"))
+            self.save()
+            return None
+        for name in shards:
+            os.replace(os.path.join(self.folder, f"{name}.tmp"), os.path.join(self.folder, name))
+        self.state["round"] = round_number
+        self.state["pending"] = {"custom_ids": custom_ids, "shards": [{"file": name, "batch_id": None} for name in shards]}
+        self.save()
+        return [os.path.join(self.folder, name) for name in shards]
+
+    def ingest(self, results_paths, price_factor=BATCH_PRICE_FACTOR):
+        """
+        Takes in the Batch API output files of the pending round (a path or a list of them),
+        returns the number of answers used; requests without an answer in any of them count
+        as failed. Costs are the synchronous price times price_factor.
+        """
+        pending = self.state["pending"]
+        if pending is None:
+            raise ValueError("No round is waiting for results")
+        if isinstance(results_paths, str):
+            results_paths = [results_paths]
+
+        with span("batch.ingest", round=self.state["round"]) as ingest_span:
+            results = {}
+            for results_path in results_paths:
+                results.update(read_results(results_path))
+            used = 0
+            for request_id in pending["custom_ids"]:
+                deck_id, stage, index = request_id.split("/", 2)
+                deck = self.decks[deck_id]
+                if deck["stage"] != stage:
+                    continue
+                if request_id in results:
+                    content, usage = results[request_id]
+                    self._take_answer(deck, stage, index, content, usage, price_factor)
+                    used += 1
+                    continue
+                # Failed or expired; asked again next round
+                attempts = deck["attempts"][request_id] = deck["attempts"].get(request_id, 0) + 1
+                if attempts >= MAX_ATTEMPTS:
+                    deck.update(stage=STAGE_FAILED, error=f"Request {request_id} failed {attempts} times")
+
+            for deck in self.decks.values():
+                self._advance(deck)
+            ingest_span.set(requests=len(pending["custom_ids"]), answers=used)
+
+        self.state["pending"] = None
+        self.save()
+        return used
+
+    def _deck_requests(self, deck):
+        """ Requests the deck needs for its current stage, after moving it past stages needing none """
+        self._advance(deck)
+        options = self.options
+
+        if deck["stage"] == STAGE_VISION:
+            budget = ImageBudget(quality=options.quality) if options.adaptive else None
+            cache = get_default_cache() if options.use_cache else None
+            page_numbers = [page_number for page_number in deck["page_numbers"] if str(page_number) not in deck["descriptions"]]
+            render_args = (options.zoom_factor, options.image_format, options.quality, budget)
+            for page_number, image_bytes in render_pages(deck["path"], page_numbers, render_args):
+                key = cache_key(image_bytes, default_vision_prompt, VISION_MODEL, options.zoom_factor, VISION_MAX_TOKENS)
+                cached = cache.get(key) if cache is not None else None
+                if cached is not None:
+                    deck["descriptions"][str(page_number)] = cached
+                    continue
+                deck["cache_keys"][str(page_number)] = key
+                yield chat_request(custom_id(deck, STAGE_VISION, page_number),
+                                   vision_payload([image_bytes], default_vision_prompt, [page_number]))
+            # Everything came from the cache
+            if self._advance(deck):
+                yield from self._deck_requests(deck)
+
+        elif deck["stage"] == STAGE_SUMMARY:
+            for i, output in enumerate(deck["outputs"]):
+                if output is not None:
+                    continue
+                if deck["round"] == 0:
+                    prompt = initial_prompt(deck["inputs"][i], self.summary_template)
+                else:
+                    prompt = merge_prompt(merge_groups(deck["inputs"], options.merge_fanout)[i], self.summary_template)
+                yield chat_request(custom_id(deck, STAGE_SUMMARY, f"{deck['round']}.{i}"), summary_body(prompt))
+
+        elif deck["stage"] == STAGE_STRUCTURE:
+            yield chat_request(custom_id(deck, STAGE_STRUCTURE, 0), summary_body(headings_prompt(deck["summary"])))
+
+    def _take_answer(self, deck, stage, index, content, usage, price_factor):
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+        if stage == STAGE_VISION:
+            cost = vision_cost(prompt_tokens, completion_tokens) * price_factor
+            deck["descriptions"][index] = content
+            if self.options.use_cache and index in deck["cache_keys"]:
+                get_default_cache().put(deck["cache_keys"].pop(index), content, cost)
+        else:
+            cost = completion_cost(prompt_tokens, completion_tokens) * price_factor
+            if stage == STAGE_SUMMARY:
+                answer_round, i = map(int, index.split("."))
+                if answer_round != deck["round"]:
+                    return
+                deck["outputs"][i] = content
+            else:
+                deck["structured"] = split_on_headings(deck["summary"], content)
+        deck["cost"] += cost
+
+    def _advance(self, deck):
+        """ Moves the deck on as far as its answers allow, returns whether its stage changed """
+        stage = deck["stage"]
+        options = self.options
+
+        if deck["stage"] == STAGE_VISION and deck["page_numbers"] is None:
+            # Triage is local, only the vision pages become requests
+            if options.triage:
+                deck["plan"] = triage_pages(deck["path"])
+                deck["page_numbers"] = [page["page_number"] for page in deck["plan"] if page["kind"] == PAGE_VISION]
+            else:
+                deck["page_numbers"] = list(range(1, get_pdf_page_count(deck["path"]) + 1))
+
+        if deck["stage"] == STAGE_VISION and all(str(page_number) in deck["descriptions"] for page_number in deck["page_numbers"]):
+            chunks = split_text(self._slide_descriptions(deck), self.summary_template, running_summary=False, max_chunk_tokens=options.max_chunk_tokens)
+            deck.update(stage=STAGE_SUMMARY, round=0, inputs=chunks, outputs=[None] * len(chunks))
+
+        # Rounds as in map_reduce_summarize: the chunks are mapped, then merged merge_fanout at a time
+        while deck["stage"] == STAGE_SUMMARY and all(output is not None for output in deck["outputs"]):
+            summaries = deck["outputs"]
+            if len(summaries) <= 1:
+                deck.update(stage=STAGE_STRUCTURE, summary=summaries[0] if summaries else "", inputs=[], outputs=[])
+                break
+            # A lone leftover summary is carried over as is
+            groups = merge_groups(summaries, options.merge_fanout)
+            deck.update(round=deck["round"] + 1, inputs=summaries,
+                        outputs=[group[0] if len(group) == 1 else None for group in groups])
+
+        if deck["stage"] == STAGE_STRUCTURE and deck["structured"] is None:
+            # Only summaries the template headings can't be found in need a request
+            structured = structurize_locally(deck["summary"], self.summary_template) if options.structurize else {}
+            if structured is not None:
+                deck["structured"] = structured
+        if deck["stage"] == STAGE_STRUCTURE and deck["structured"] is not None:
+            deck["stage"] = STAGE_DONE
+
+        return deck["stage"] != stage
+
+    @staticmethod
+    def _slide_descriptions(deck):
+        descriptions = [f"Slide {page_number}:\n{deck['descriptions'][str(page_number)]}" for page_number in deck["page_numbers"]]
+        if deck["plan"] is not None:
+            descriptions = merge_descriptions(deck["plan"], dict(zip(deck["page_numbers"], descriptions)))
+        return descriptions
+
+    def store_results(self, store):
+        """ Puts every finished deck into the deck store, returns how many """
+        done = [deck for deck in self.decks.values() if deck["stage"] == STAGE_DONE]
+        for deck in done:
+            store.put(deck["deck_hash"], deck["summary"], deck["structured"], self._slide_descriptions(deck),
+                      name=os.path.basename(deck["path"]), cost=deck["cost"])
+        return len(done)
+
+    def records(self):
+        """ One result per deck, in the form batch_runner.py writes """
+        for deck in self.decks.values():
+            record = {"path": deck["path"], "deck_hash": deck["deck_hash"], "finished": deck["stage"] == STAGE_DONE,
+                      "cost": round(deck["cost"], 6), "stage": deck["stage"]}
+            if deck["stage"] == STAGE_DONE:
+                record.update(summary=deck["summary"], structured=deck["structured"])
+            if deck["error"]:
+                record["error"] = deck["error"]
+            yield record
+
+
+def _write_json(path, data):
+    # Swapped in whole, so an interrupted write never leaves a broken state file
+    with open(f"{path}.tmp", "w", encoding="utf-8") as json_file:
+        json.dump(data, json_file)
+    os.replace(f"{path}.tmp", path)
+
+
+async def run_local(requests_path, results_path, api_key=None, concurrency=16):
+    """
+    Executes a requests file with synchronous calls (full price) and writes a Batch API
+    output file; for testing against a mock server, or when a round can't wait.
+    """
+    settings = get_settings(api_key)
+    scheduler = get_scheduler(settings.api_key)
+    client = get_async_client()
+    headers = {"Authorization": f"Bearer {settings.api_key}"}
+    slots = asyncio.Semaphore(concurrency)
+
+    async def send(request):
+        async with slots:
+            try:
+                response = await scheduler.run(
+                    lambda: client.post(f"{settings.base_url}/chat/completions", headers=headers, json=request["body"]))
+                body = response.json()
+                return {"custom_id": request["custom_id"], "response": {"status_code": response.status_code, "body": body}, "error": None}
+            except Exception as e:
+                return {"custom_id": request["custom_id"], "response": None, "error": {"message": f"{type(e).__name__}: {e}"}}
+
+    with open(requests_path, encoding="utf-8") as requests_file:
+        tasks = [asyncio.create_task(send(json.loads(line))) for line in requests_file if line.strip()]
+    with open(results_path, "w", encoding="utf-8") as results_file:
+        for task in asyncio.as_completed(tasks):
+            results_file.write(json.dumps(await task) + "\n")
+
+
+def submit_openai(requests_path, api_key=None):
+    """ Uploads a requests file and creates its batch, returns the batch id """
+    client = get_openai_client(api_key)
+    with open(requests_path, "rb") as requests_file:
+        input_file = client.files.create(file=(os.path.basename(requests_path), requests_file), purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window="24h")
+    print(f"Submitted batch {batch.id} ({os.path.basename(requests_path)})")
+    return batch.id
+
+
+def wait_openai(batch_id, results_path, api_key=None, poll_interval=60.0):
+    """ Polls until the batch ends and writes its output and error files to results_path """
+    client = get_openai_client(api_key)
+    while (batch := client.batches.retrieve(batch_id)).status not in ("completed", "failed", "expired", "cancelled"):
+        counts = batch.request_counts
+        print(f"Batch {batch_id} {batch.status}" + (f": {counts.completed + counts.failed}/{counts.total}" if counts else ""))
+        time.sleep(poll_interval)
+    print(f"Batch {batch_id} {batch.status}")
+
+    # Requests an expired or failed batch didn't answer are missing from the files and asked again
+    with open(results_path, "wb") as results_file:
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                results_file.write(client.files.content(file_id).read())
+
+
+def run_openai(pipeline, api_key=None, poll_interval=60.0):
+    """
+    Submits every shard of the pending round that has no batch yet, so they run side by
+    side, then waits for them; returns the results paths. Batch ids are saved as soon as
+    they exist, a later run keeps waiting for them. A shard the API refuses gets no
+    answers, its requests go into the next round.
+    """
+    shards = pipeline.state["pending"]["shards"]
+    for shard in shards:
+        if shard["batch_id"] is None:
+            try:
+                shard["batch_id"] = submit_openai(os.path.join(pipeline.folder, shard["file"]), api_key)
+            except openai.OpenAIError as e:
+                print(f"Batch for {shard['file']} not created: {e}")
+                continue
+            pipeline.save()
+
+    results_paths = []
+    for shard in shards:
+        results_path = os.path.join(pipeline.folder, shard["file"].replace(".requests.jsonl", ".results.jsonl"))
+        results_paths.append(results_path)
+        if shard["batch_id"] is None:
+            open(results_path, "w").close()
+        else:
+            wait_openai(shard["batch_id"], results_path, api_key, poll_interval)
+    return results_paths
+
+
+def run_drop(requests_path, results_path, drop_folder, poll_interval=60.0):
+    """
+    Hands a requests file to whatever submits batches from drop_folder and waits for it
+    to leave the output as <name>.results.jsonl next to it.
+    """
+    os.makedirs(drop_folder, exist_ok=True)
+    name = os.path.basename(requests_path).replace(".requests.jsonl", "")
+    dropped = os.path.join(drop_folder, os.path.basename(requests_path))
+    if not os.path.exists(dropped):
+        shutil.copyfile(requests_path, f"{dropped}.tmp")
+        os.replace(f"{dropped}.tmp", dropped)
+    print(f"Waiting for {os.path.join(drop_folder, name)}.results.jsonl")
+    while not os.path.exists(output := os.path.join(drop_folder, f"{name}.results.jsonl")):
+        time.sleep(poll_interval)
+    shutil.move(output, results_path)
+
+
+def run_pipeline(pipeline, executor="openai", api_key=None, poll_interval=60.0, drop_folder=None):
+    """ Writes, executes and ingests rounds until every deck is done or failed """
+    while (requests_paths := pipeline.write_requests()) is not None:
+        pending = pipeline.state["pending"]
+        print(f"Round {pipeline.state['round']}: {len(pending['custom_ids'])} requests in {len(requests_paths)} files")
+
+        if executor == "openai":
+            results_paths = run_openai(pipeline, api_key=api_key, poll_interval=poll_interval)
+        else:
+            results_paths = [requests_path.replace(".requests.jsonl", ".results.jsonl") for requests_path in requests_paths]
+            for requests_path, results_path in zip(requests_paths, results_paths):
+                if executor == "local":
+                    asyncio.run(_run_local_and_close(requests_path, results_path, api_key))
+                else:
+                    run_drop(requests_path, results_path, drop_folder, poll_interval)
+
+        # Local rounds were paid at the synchronous price
+        used = pipeline.ingest(results_paths, price_factor=1.0 if executor == "local" else BATCH_PRICE_FACTOR)
+        print(f"Round {pipeline.state['round']}: {used}/{len(pending['custom_ids'])} answers, decks {pipeline.counts()}")
+
+
+async def _run_local_and_close(requests_path, results_path, api_key):
+    try:
+        await run_local(requests_path, results_path, api_key)
+    finally:
+        await close_async_client()
+
+
+def store_results(pipeline, path=DECK_STORE_PATH):
+    store = DeckStore(path)
+    try:
+        stored = pipeline.store_results(store)
+    finally:
+        store.close()
+    if stored:
+        print(f"{stored} finished decks in the deck store {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process a backlog of Pitch Decks through the OpenAI Batch API, one round of requests per stage.")
+    parser.add_argument("--work", default=os.path.join(BATCH_FOLDER, "default"), help="Folder holding the run's state, request and result files")
+    parser.add_argument("--decks-db", default=DECK_STORE_PATH, help="SQLite file of the deck store finished decks are added to")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Increase output verbosity")
+    parser.add_argument("--trace", metavar="FILE", default=None, help="Append a JSON lines trace of every rendering, API and parsing step to FILE")
+    parser.add_argument("--base-url", default=None, help="OpenAI-compatible API to send requests to, e.g. a local mock server (default: OPENAI_BASE_URL or api.openai.com)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    start = commands.add_parser("start", help="Set up a run for a directory or manifest of decks")
+    start.add_argument("source", help="Directory of PDF files, or a manifest listing one PDF path per line")
+    start.add_argument("-z", "--zoom", type=float, default=1.0, help="Zoom factor for page rendering")
+    start.add_argument("--image-format", choices=["jpeg", "png", "webp", "auto"], default="jpeg", help="Codec for the page images (auto requires --adaptive)")
+    start.add_argument("--adaptive", action="store_true", help="Size, encode and pick the detail level of every page adaptively")
+    start.add_argument("--quality", type=int, default=80, help="Encoder quality for lossy image formats (1-100)")
+    start.add_argument("--triage", action="store_true", help="Send only image-heavy pages to the vision API")
+    start.add_argument("--no-cache", action="store_true", help="Bypass the on-disk vision description cache")
+    start.add_argument("--merge-fanout", type=int, default=2, help="Summaries merged per request")
+    start.add_argument("--max-chunk-tokens", type=int, default=None, help="Upper limit for deck text tokens per summary request")
+    start.add_argument("--no-structurize", dest="structurize", action="store_false", help="Skip extracting headings and values")
+    start.add_argument("--max-shard-mb", type=int, default=MAX_SHARD_BYTES // 1_000_000, help="Upper limit for one request file (one batch), in MB")
+    start.add_argument("--max-shard-requests", type=int, default=MAX_SHARD_REQUESTS, help="Upper limit for the requests in one file (one batch)")
+
+    commands.add_parser("write", help="Write the requests of the next round and print the paths of its files")
+    ingest = commands.add_parser("ingest", help="Take in the Batch API output files of the pending round")
+    ingest.add_argument("results", nargs="+", help="Batch API output (and error) JSON lines files, one or more per request file")
+
+    run = commands.add_parser("run", help="Write, execute and ingest rounds until every deck is done")
+    run.add_argument("--executor", choices=["openai", "local", "drop"], default="openai",
+                     help="openai: the Batch API; local: synchronous calls at full price; drop: files exchanged through --drop-folder")
+    run.add_argument("--drop-folder", default=None, help="With --executor drop: where request files are left and <name>.results.jsonl files are expected")
+    run.add_argument("--poll-interval", type=float, default=60.0, help="Seconds between checks for finished batches")
+
+    commands.add_parser("status", help="Print the stage of every deck")
+    export = commands.add_parser("export", help="Write one JSON line per deck, like batch_runner.py")
+    export.add_argument("-o", "--output", default="results.jsonl")
+    args = parser.parse_args()
+
+    set_verbosity(args.verbose)
+    if args.base_url:
+        os.environ["OPENAI_BASE_URL"] = args.base_url
+    if args.trace:
+        configure_tracing(args.trace)
+
+    if args.command == "start":
+        if args.image_format == "auto" and not args.adaptive:
+            parser.error("--image-format auto requires --adaptive")
+        if args.merge_fanout < 2:
+            parser.error("--merge-fanout must be at least 2")
+        decks = find_decks(args.source)
+        pipeline = BatchPipeline.start(args.work, decks, BatchOptions(
+            zoom_factor=args.zoom, image_format=args.image_format, quality=args.quality, adaptive=args.adaptive,
+            triage=args.triage, use_cache=not args.no_cache, merge_fanout=args.merge_fanout,
+            max_chunk_tokens=args.max_chunk_tokens, structurize=args.structurize,
+            max_shard_bytes=args.max_shard_mb * 1_000_000, max_shard_requests=args.max_shard_requests))
+        print(f"Batch run in {args.work} with {len(pipeline.decks)} decks")
+        return
+
+    pipeline = BatchPipeline(args.work)
+    if args.command == "write":
+        paths = pipeline.write_requests()
+        if paths is None:
+            print(f"Nothing left to request: {pipeline.counts()}")
+        else:
+            print("\n".join(paths))
+            print(f"({len(pipeline.state['pending']['custom_ids'])} requests in {len(paths)} files)")
+    elif args.command == "ingest":
+        used = pipeline.ingest(args.results)
+        print(f"{used} answers ingested, decks {pipeline.counts()}")
+        store_results(pipeline, args.decks_db)
+    elif args.command == "run":
+        if args.executor == "drop" and args.drop_folder is None:
+            parser.error("--executor drop requires --drop-folder")
+        run_pipeline(pipeline, args.executor, poll_interval=args.poll_interval, drop_folder=args.drop_folder)
+        print(f"Finished: decks {pipeline.counts()}, cost {sum(deck['cost'] for deck in pipeline.decks.values()):.3f}$")
+        store_results(pipeline, args.decks_db)
+    elif args.command == "status":
+        for deck in pipeline.decks.values():
+            print(f"{deck['stage']:<10}{deck['cost']:>8.3f}$  {deck['path']}" + (f"  ({deck['error']})" if deck["error"] else ""))
+        print(f"Round {pipeline.state['round']}" + (", waiting for results" if pipeline.state["pending"] else ""))
+    elif args.command == "export":
+        with open(args.output, "w", encoding="utf-8") as output:
+            for record in pipeline.records():
+                output.write(json.dumps(record) + "\n")
+        print(f"Wrote {len(pipeline.decks)} records to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
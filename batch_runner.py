@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+
+from page_renderer import ImageBudget
+from render_pipeline import PageRenderPipeline, DEFAULT_MAX_INFLIGHT_BYTES
+from page_triage import triage_pages, merge_descriptions, PAGE_VISION
+from vision_analyzer import describe_pages, get_pdf_page_count, SlideBatching
+from gpt4_summarizer import summarize_async, set_verbosity, SUMMARY_STRATEGIES
+from response_parser import structurize_summary_async
+from request_scheduler import RateLimits, configure_rate_limits, configure_completion_limits
+from run_checkpoint import delete_checkpoints
+from deck_store import DeckStore, DECK_STORE_PATH, file_sha256, find_decks
+from prompt_templates.vision_prompt import default_vision_prompt
+from tracing import span, configure_tracing, reset_context, peak_rss
+from openai_session import get_settings, get_async_client, close_async_client
+
+
+def load_finished(output_path):
+    """ Hashes of the decks that already have a finished result in the output file """
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+
+    with open(output_path, encoding="utf-8") as output:
+        for line in output:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line of an interrupted batch may be cut short
+                continue
+            if record.get("finished"):
+                finished.add(record["deck_hash"])
+    return finished
+
+
+async def process_deck(path, deck_hash, args, client, render_pool, api_key, decks):
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+
+    # Checkpoints are keyed by content, so a restarted batch resumes half-done decks too
+    run_id = f"batch-{deck_hash[:16]}"
+    record = {"path": path, "deck_hash": deck_hash, "finished": False, "cost": 0.0}
+
+    try:
+        # CPU-bound triage and rendering run in the process pool
+        plan, page_numbers = None, None
+        if args.triage:
+            plan = await loop.run_in_executor(render_pool, triage_pages, path)
+            page_numbers = [page["page_number"] for page in plan if page["kind"] == PAGE_VISION]
+        else:
+            page_numbers = list(range(1, get_pdf_page_count(path) + 1))
+        record["n_pages"] = len(plan) if plan is not None else len(page_numbers)
+
+        # Pages are sent while the rest of the deck is still rendering in the pool
+        pages = PageRenderPipeline(path, page_numbers, zoom_factor=args.zoom, image_format=args.image_format, quality=args.quality,
+                                   budget=args.budget, pool=render_pool, max_inflight_bytes=args.max_inflight_mb * 1_000_000, max_renders=args.workers)
+        descriptions, cost = await describe_pages(
+            client, pages, default_vision_prompt, zoom_factor=args.zoom, api_key=api_key, use_cache=not args.no_cache, run_id=run_id,
+            batching=SlideBatching(max_slides=args.batch_slides) if args.batch_slides > 1 else None)
+        record["cost"] += cost
+
+        if plan is not None and (descriptions != [] or not page_numbers):
+            descriptions = merge_descriptions(plan, dict(zip(page_numbers, descriptions)))
+
+        if descriptions == []:
+            record["error"] = "Description generation didn't finish"
+            return record
+
+        # GPT-4 calls of every deck share the key's completion limiter
+        summary, cost, finished = await summarize_async(
+            descriptions, strategy=args.strategy, api_key=api_key,
+            merge_fanout=args.merge_fanout, run_id=run_id)
+        record["cost"] += cost
+
+        if not finished:
+            record["error"] = "Summary generation didn't finish"
+            return record
+        record["summary"] = summary
+
+        if args.structurize:
+            structured, cost = await structurize_summary_async(summary, api_key)
+            record["structured"] = structured
+            record["cost"] += cost
+
+        record["finished"] = True
+        # The results file stays small, the descriptions only go to the deck store
+        decks.put(deck_hash, summary, record.get("structured"), descriptions,
+                  name=os.path.basename(path), cost=record["cost"])
+        delete_checkpoints(run_id)
+
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+
+    finally:
+        record["elapsed"] = round(time.monotonic() - started, 2)
+
+    return record
+
+
+async def run_batch(decks, output_path, args, api_key):
+    finished = load_finished(output_path)
+
+    pending = []
+    for path in decks:
+        deck_hash = file_sha256(path)
+        if deck_hash in finished:
+            print(f"Skipping {path} (already done)")
+            continue
+        pending.append((path, deck_hash))
+
+    print(f"Processing {len(pending)} decks ({len(decks) - len(pending)} already done)...")
+
+    # Decks in flight are bounded to keep memory in check; API limits are shared by all of them
+    deck_slots = asyncio.Semaphore(args.max_decks)
+    totals = {"done": 0, "failed": 0, "cost": 0.0}
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=reset_context) as render_pool, \
+            open(output_path, "a", encoding="utf-8") as output:
+        decks = DeckStore(args.decks_db)
+
+        # One keep-alive connection pool for every deck of the batch
+        client = get_async_client()
+
+        async def run_one(path, deck_hash):
+            async with deck_slots:
+                with span("deck", path=path, deck_hash=deck_hash) as deck_span:
+                    record = await process_deck(path, deck_hash, args, client, render_pool, api_key, decks)
+                    deck_span.set(finished=record["finished"], cost=record["cost"])
+
+            # Results stream out as each deck finishes
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+
+            totals["done" if record["finished"] else "failed"] += 1
+            totals["cost"] += record["cost"]
+            status = "done" if record["finished"] else f"failed: {record.get('error')}"
+            print(f"[{totals['done'] + totals['failed']}/{len(pending)}] {path} {status} "
+                  f"({record['elapsed']}s, {record['cost']:.3f}$)")
+
+        try:
+            await asyncio.gather(*[run_one(path, deck_hash) for path, deck_hash in pending])
+        finally:
+            await close_async_client()
+            decks.close()
+
+    print(f"Finished: {totals['done']} done, {totals['failed']} failed. Total cost: {totals['cost']:.3f}")
+    # One figure for the whole batch: decks in flight share the process, render workers aren't included
+    if (rss := peak_rss()) is not None:
+        print(f"Peak RSS of the batch process: {rss / 1_000_000:.0f} MB (render workers not included)")
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process a directory or manifest of Pitch Deck PDF files.')
+
+    parser.add_argument("source", help="Directory of PDF files, or a manifest listing one PDF path per line")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSON lines file the results are appended to; decks already finished in it are skipped")
+    parser.add_argument("--decks-db", default=DECK_STORE_PATH, help="SQLite file of the deck store finished decks are added to")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Increase output verbosity")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Processes rendering PDF pages")
+    parser.add_argument("--max-decks", type=int, default=4, help="Decks processed concurrently")
+    parser.add_argument("--max-inflight-mb", type=int, default=DEFAULT_MAX_INFLIGHT_BYTES // 1_000_000, help="Rendered page images per deck waiting for or in an upload (MB)")
+    parser.add_argument("-z", "--zoom", type=float, default=1.0, help="Zoom factor for page rendering")
+    parser.add_argument("--image-format", choices=["jpeg", "png", "webp", "auto"], default="jpeg", help="Codec for the page images sent to the vision API (auto requires --adaptive)")
+    parser.add_argument("--adaptive", action="store_true", help="Size, encode and pick the detail level of every page adaptively instead of a fixed zoom")
+    parser.add_argument("--target-tiles", type=int, default=ImageBudget.target_tiles, help="With --adaptive: 512px tiles billed per page in high detail")
+    parser.add_argument("--max-image-bytes", type=int, default=ImageBudget.max_bytes, help="With --adaptive: upper limit for one encoded page")
+    parser.add_argument("--quality", type=int, default=80, help="Encoder quality for lossy image formats (1-100)")
+    parser.add_argument("--triage", action="store_true", help="Send only image-heavy pages to the vision API")
+    parser.add_argument("--batch-slides", type=int, default=1, help="Pages described per vision request (1 sends every page on its own)")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the on-disk vision description cache")
+    parser.add_argument("-s", "--strategy", choices=list(SUMMARY_STRATEGIES), default="map_reduce", help="Summarization strategy")
+    parser.add_argument("--merge-fanout", type=int, default=2, help="Summaries merged per call in the map_reduce strategy")
+    parser.add_argument("--no-structurize", dest="structurize", action="store_false", help="Skip extracting headings and values")
+    parser.add_argument("--max-concurrency", type=int, default=RateLimits.max_concurrency, help="Vision requests in flight across all decks")
+    parser.add_argument("--rpm", type=int, default=RateLimits.requests_per_minute, help="Vision requests per minute")
+    parser.add_argument("--tpm", type=int, default=RateLimits.tokens_per_minute, help="Vision tokens per minute")
+    parser.add_argument("--summary-concurrency", type=int, default=RateLimits.max_concurrency, help="GPT-4 summary calls in flight across all decks")
+    parser.add_argument("--summary-rpm", type=int, default=RateLimits.requests_per_minute, help="GPT-4 summary requests per minute")
+    parser.add_argument("--summary-tpm", type=int, default=RateLimits.tokens_per_minute, help="GPT-4 summary tokens per minute")
+    parser.add_argument("--trace", metavar="FILE", default=None, help="Append a JSON lines trace of every rendering, API and parsing step to FILE")
+    parser.add_argument("--base-url", default=None, help="OpenAI-compatible API to send requests to, e.g. a local mock server (default: OPENAI_BASE_URL or api.openai.com)")
+    args = parser.parse_args()
+
+    set_verbosity(args.verbose)
+    if args.base_url:
+        os.environ["OPENAI_BASE_URL"] = args.base_url
+    # Render workers inherit the setting and append to the same file
+    if args.trace:
+        configure_tracing(args.trace)
+
+    if args.image_format == "auto" and not args.adaptive:
+        parser.error("--image-format auto requires --adaptive")
+    args.budget = ImageBudget(target_tiles=args.target_tiles, max_bytes=args.max_image_bytes, quality=args.quality) if args.adaptive else None
+
+    api_key = get_settings().api_key
+    configure_rate_limits(api_key, RateLimits(
+        max_concurrency=args.max_concurrency, requests_per_minute=args.rpm, tokens_per_minute=args.tpm))
+    configure_completion_limits(api_key, RateLimits(
+        max_concurrency=args.summary_concurrency, requests_per_minute=args.summary_rpm, tokens_per_minute=args.summary_tpm))
+
+    decks = find_decks(args.source)
+    asyncio.run(run_batch(decks, args.output, args, api_key))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from argparse import Namespace
+
+import fitz
+
+from page_renderer import ImageBudget
+from render_pipeline import DEFAULT_MAX_INFLIGHT_BYTES
+from batch_runner import run_batch
+from deck_store import file_sha256, find_decks
+from gpt4_summarizer import set_verbosity
+from request_scheduler import RateLimits, configure_rate_limits, configure_completion_limits
+from run_checkpoint import delete_checkpoints
+from mock_openai_server import MockOpenAIServer, MockSettings, percentile
+
+
+# Pipeline modes compared by the benchmark: batch_runner options per mode
+MODES = {
+    "refine": {"strategy": "refine"},
+    "map_reduce": {"strategy": "map_reduce"},
+    "patch": {"strategy": "patch"},
+    "triage": {"strategy": "map_reduce", "triage": True},
+    "adaptive": {"strategy": "map_reduce", "triage": True, "adaptive": True, "image_format": "auto"},
+    "batched": {"strategy": "map_reduce", "triage": True, "adaptive": True, "image_format": "auto", "batch_slides": 4},
+}
+
+MOCK_API_KEY = "sk-mock-benchmark-key-0000000000000000"
+
+
+def make_deck(path, n_pages, seed):
+    """ Synthetic slide deck mixing text, chart-like, photo, blank and duplicate pages """
+    rng = random.Random(seed)
+    pdf = fitz.open()
+
+    for page_number in range(1, n_pages + 1):
+        if page_number > 2 and rng.random() < 0.1:
+            pdf.fullcopy_page(pdf.page_count - 1)
+            continue
+
+        page = pdf.new_page(width=960, height=540)
+        kind = rng.choice(["text", "text", "chart", "photo", "blank"]) if page_number > 1 else "text"
+
+        if kind != "blank":
+            page.insert_text((60, 80), f"Deck {seed} - slide {page_number}", fontsize=32)
+        if kind == "text":
+            for line in range(8):
+                words = " ".join(rng.choice(["market", "revenue", "team", "growth", "customers", "product"]) for _ in range(8))
+                page.insert_text((60, 150 + 40 * line), f"- {words}", fontsize=18)
+        elif kind == "chart":
+            for bar in range(60):
+                height = rng.uniform(20, 300)
+                page.draw_rect(fitz.Rect(60 + bar * 14, 480 - height, 70 + bar * 14, 480), color=(0, 0, 1), fill=(0.3, 0.5, 0.9))
+        elif kind == "photo":
+            pix = fitz.Pixmap(fitz.csRGB, 320, 180, rng.randbytes(320 * 180 * 3), False)
+            page.insert_image(fitz.Rect(60, 110, 900, 500), pixmap=pix)
+
+    pdf.save(path)
+    pdf.close()
+    return path
+
+
+def make_decks(folder, n_decks, n_pages):
+    return [make_deck(os.path.join(folder, f"deck_{i:03d}.pdf"), n_pages, seed=i) for i in range(n_decks)]
+
+
+def run_mode(mode, decks, server, args):
+    options = dict(MODES[mode])
+    budget = ImageBudget() if options.get("adaptive") else None
+    batch_args = Namespace(
+        zoom=args.zoom, image_format=options.get("image_format", "jpeg"), quality=80, budget=budget,
+        triage=options.get("triage", False), batch_slides=options.get("batch_slides", 1), no_cache=True, strategy=options["strategy"], merge_fanout=2,
+        structurize=True, max_decks=args.max_decks, workers=args.workers, max_inflight_mb=args.max_inflight_mb)
+
+    # Fresh limits, no leftovers from an earlier mode and nothing served from caches
+    configure_rate_limits(MOCK_API_KEY, RateLimits(
+        max_concurrency=args.max_concurrency, requests_per_minute=args.rpm, tokens_per_minute=args.tpm))
+    configure_completion_limits(MOCK_API_KEY, RateLimits(
+        max_concurrency=args.max_concurrency, requests_per_minute=args.rpm, tokens_per_minute=args.tpm))
+    for path in decks:
+        delete_checkpoints(f"batch-{file_sha256(path)[:16]}")
+    server.stats.reset()
+
+    with tempfile.TemporaryDirectory() as folder:
+        output_path = os.path.join(folder, "results.jsonl")
+        # Benchmark decks never go into the real deck store
+        batch_args.decks_db = os.path.join(folder, "decks.sqlite3")
+        started = time.monotonic()
+        asyncio.run(run_batch(decks, output_path, batch_args, MOCK_API_KEY))
+        elapsed = time.monotonic() - started
+
+        with open(output_path, encoding="utf-8") as output:
+            records = [json.loads(line) for line in output]
+
+    stats = server.stats.snapshot()
+    deck_latencies = [record["elapsed"] for record in records if record["finished"]]
+    return {
+        "mode": mode,
+        "decks": len(records),
+        "failed": sum(1 for record in records if not record["finished"]),
+        "elapsed": round(elapsed, 2),
+        "decks_per_min": round(len(deck_latencies) / elapsed * 60, 2),
+        "deck_p50": percentile(deck_latencies, 50),
+        "deck_p95": percentile(deck_latencies, 95),
+        "request_p50": stats["latency_p50"],
+        "request_p95": stats["latency_p95"],
+        "requests": stats["requests"],
+        "statuses": stats["statuses"],
+        "prompt_tokens": stats["prompt_tokens"],
+        "completion_tokens": stats["completion_tokens"],
+    }
+
+
+def print_results(results):
+    def seconds(value):
+        return "-" if value is None else f"{value:.2f}s"
+
+    print(f"\n{'mode':<12}{'decks/min':>10}{'deck p50':>10}{'deck p95':>10}{'req p50':>9}{'req p95':>9}"
+          f"{'requests':>10}{'429':>6}{'5xx':>6}{'tokens':>10}")
+    for result in results:
+        statuses = result["statuses"]
+        errors_5xx = sum(count for status, count in statuses.items() if status.startswith("5"))
+        print(f"{result['mode']:<12}{result['decks_per_min']:>10}{seconds(result['deck_p50']):>10}{seconds(result['deck_p95']):>10}"
+              f"{seconds(result['request_p50']):>9}{seconds(result['request_p95']):>9}{result['requests']:>10}"
+              f"{statuses.get('429', 0):>6}{errors_5xx:>6}{result['prompt_tokens'] + result['completion_tokens']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark of the deck pipeline against a local mock API.")
+    parser.add_argument("source", nargs="?", default=None, help="Directory or manifest of decks (default: generate synthetic decks)")
+    parser.add_argument("--decks", type=int, default=8, help="Synthetic decks to generate")
+    parser.add_argument("--pages", type=int, default=12, help="Pages per synthetic deck")
+    parser.add_argument("-m", "--modes", default=",".join(MODES), help=f"Comma separated modes out of {list(MODES)}")
+    parser.add_argument("-z", "--zoom", type=float, default=1.0)
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--max-decks", type=int, default=4, help="Decks processed concurrently")
+    parser.add_argument("--max-inflight-mb", type=int, default=DEFAULT_MAX_INFLIGHT_BYTES // 1_000_000, help="Rendered page images per deck waiting for or in an upload (MB)")
+    parser.add_argument("--max-concurrency", type=int, default=RateLimits.max_concurrency, help="Client side requests in flight")
+    parser.add_argument("--rpm", type=int, default=1000, help="Client side requests per minute")
+    parser.add_argument("--tpm", type=int, default=1_000_000, help="Client side tokens per minute")
+    parser.add_argument("--latency", default="lognormal:0.3,0.4", help="Mock latency distribution, see mock_openai_server.py")
+    parser.add_argument("--token-latency", type=float, default=0.001, help="Mock seconds per generated token")
+    parser.add_argument("--error-429", type=float, default=0.0, help="Share of mock responses that are 429s")
+    parser.add_argument("--error-5xx", type=float, default=0.0, help="Share of mock responses that are 5xx errors")
+    parser.add_argument("--server-rpm", type=int, default=0, help="Requests per minute the mock allows (0: unlimited)")
+    parser.add_argument("--server-tpm", type=int, default=0, help="Tokens per minute the mock allows (0: unlimited)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="PATH", default=None, help="Also write the results as JSON")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    set_verbosity(args.verbose)
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"Unknown mode '{mode}', expected one of {list(MODES)}")
+
+    settings = MockSettings(
+        latency=args.latency, token_latency=args.token_latency, error_429_rate=args.error_429,
+        error_5xx_rate=args.error_5xx, requests_per_minute=args.server_rpm, tokens_per_minute=args.server_tpm, seed=args.seed)
+
+    with MockOpenAIServer(settings) as server, tempfile.TemporaryDirectory() as folder:
+        os.environ["OPENAI_BASE_URL"] = server.url
+        decks = find_decks(args.source) if args.source else make_decks(folder, args.decks, args.pages)
+        print(f"Benchmarking {len(decks)} decks against {server.url}")
+
+        results = [run_mode(mode, decks, server, args) for mode in modes]
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+import os
+import re
+import glob
+import json
+import time
+import hashlib
+import sqlite3
+import argparse
+import threading
+
+from response_parser import heading_key
+from tracing import span
+
+
+DECK_STORE_PATH = os.path.join(".cache", "decks.sqlite3")
+EXPORT_FOLDER = os.path.join(".cache", "export")
+# Rows per Parquet row group, the export never holds more than one table of this size
+EXPORT_BATCH_ROWS = 10_000
+
+# Heading of the template line "Light memo: Company name"
+COMPANY_HEADING = "light memo"
+SLIDE_PREFIX = re.compile(r"^Slide (\d+):\s*")
+
+# What a full-text hit points at
+KIND_SUMMARY = "summary"
+KIND_SLIDE = "slide"
+KIND_FIELD = "field"
+
+
+def file_sha256(path):
+    """ Hash of the deck's bytes, the key of a deck in the store, the job service and the batch runners """
+    digest = hashlib.sha256()
+    with open(path, "rb") as pdf_file:
+        for block in iter(lambda: pdf_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def find_decks(source):
+    """ PDFs under a directory, or the paths listed in a manifest file (plain paths or JSON lines with "path") """
+    if os.path.isdir(source):
+        return sorted(glob.glob(os.path.join(source, "**", "*.pdf"), recursive=True))
+
+    # Relative manifest entries are relative to the manifest itself
+    base = os.path.dirname(os.path.abspath(source))
+    decks = []
+    with open(source, encoding="utf-8") as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = json.loads(line)["path"] if line.startswith("{") else line
+            decks.append(os.path.join(base, path))
+    return decks
+
+
+def company_name(structured, summary=""):
+    """ Company of an analyzed deck: the value of the memo heading, else the heading line of the summary """
+    for heading, value in (structured or {}).items():
+        if heading_key(heading).startswith(COMPANY_HEADING):
+            # The LLM headings sometimes keep the company in the heading itself
+            name = value.strip() or heading.partition(":")[2].strip()
+            if name:
+                return name.splitlines()[0].strip()
+    match = re.search(r"^\W*Light memo\W*:\s*(.+)$", summary, re.IGNORECASE | re.MULTILINE)
+    return match.group(1).strip() if match else None
+
+
+def split_slide(description, default_page):
+    """ (page_number, text) of one "Slide N:" description """
+    match = SLIDE_PREFIX.match(description)
+    if match is None:
+        return default_page, description.strip()
+    return int(match.group(1)), description[match.end():].strip()
+
+
+def fts_query(text):
+    """ FTS5 query matching documents that contain every word of text; the words are quoted so no syntax leaks through """
+    words = re.findall(r"[^\W_]+\*?", text)
+    return " ".join(f'"{word.rstrip("*")}"' + ("*" if word.endswith("*") else "") for word in words)
+
+
+class DeckStore:
+    """
+    SQLite corpus of analyzed decks: memo, structured headings and per-slide
+    descriptions, keyed by deck hash. Companies and headings are indexed, and an
+    FTS5 index covers memos, slides and heading values, so a known deck or a search
+    across thousands of decks is a few milliseconds.
+    """
+
+    def __init__(self, path=DECK_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Shared by the HTTP handler threads and the worker loop, access is serialized by the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS decks (
+                deck_hash TEXT PRIMARY KEY,
+                name TEXT,
+                company TEXT COLLATE NOCASE,
+                summary TEXT NOT NULL,
+                cost REAL NOT NULL DEFAULT 0,
+                slides INTEGER NOT NULL DEFAULT 0,
+                options TEXT NOT NULL DEFAULT '{}',
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS decks_company ON decks (company);
+            CREATE INDEX IF NOT EXISTS decks_updated ON decks (updated);
+
+            CREATE TABLE IF NOT EXISTS slides (
+                deck_hash TEXT NOT NULL,
+                page_number INTEGER NOT NULL,
+                description TEXT NOT NULL,
+                PRIMARY KEY (deck_hash, page_number)
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS fields (
+                deck_hash TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                heading TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL COLLATE NOCASE,
+                PRIMARY KEY (deck_hash, position)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS fields_key_value ON fields (key, value);
+
+            -- Every searchable text once, the FTS index reads it from here
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY,
+                deck_hash TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                ref TEXT,
+                text TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS documents_deck_hash ON documents (deck_hash);
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+                text, content='documents', content_rowid='id', tokenize='porter unicode61');
+            CREATE TRIGGER IF NOT EXISTS documents_insert AFTER INSERT ON documents BEGIN
+                INSERT INTO documents_fts (rowid, text) VALUES (new.id, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS documents_delete AFTER DELETE ON documents BEGIN
+                INSERT INTO documents_fts (documents_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            END;
+        """)
+        self._conn.commit()
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            rows = self._conn.execute(sql, parameters).fetchall()
+            self._conn.commit()
+            return rows
+
+    def put(self, deck_hash, summary, structured=None, descriptions=None, name=None, cost=0.0, company=None, options=None):
+        """
+        Stores the analysis of a deck, replacing an earlier one of the same deck.
+        descriptions are the "Slide N:" texts the summary was made from.
+        """
+        structured = structured or {}
+        slides = [split_slide(description, i + 1) for i, description in enumerate(descriptions or [])]
+        company = company or company_name(structured, summary)
+        now = time.time()
+
+        documents = [(deck_hash, KIND_SUMMARY, None, summary)]
+        documents += [(deck_hash, KIND_SLIDE, str(page_number), text) for page_number, text in slides if text]
+        documents += [(deck_hash, KIND_FIELD, heading, value) for heading, value in structured.items() if value]
+
+        with span("store.put", deck_hash=deck_hash, slides=len(slides), fields=len(structured)), self._lock:
+            with self._conn:
+                self._delete(deck_hash)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO decks VALUES (?, ?, ?, ?, ?, ?, ?, "
+                    "COALESCE((SELECT created FROM decks WHERE deck_hash = ?), ?), ?)",
+                    (deck_hash, name, company, summary, cost, len(slides), json.dumps(options or {}),
+                     deck_hash, now, now))
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO slides VALUES (?, ?, ?)",
+                    [(deck_hash, page_number, text) for page_number, text in slides])
+                self._conn.executemany(
+                    "INSERT INTO fields VALUES (?, ?, ?, ?, ?)",
+                    [(deck_hash, position, heading, heading_key(heading), value.strip())
+                     for position, (heading, value) in enumerate(structured.items())])
+                self._conn.executemany(
+                    "INSERT INTO documents (deck_hash, kind, ref, text) VALUES (?, ?, ?, ?)", documents)
+
+    def _delete(self, deck_hash):
+        # Rows of the decks table are replaced by the caller, which keeps their created time
+        self._conn.execute("DELETE FROM documents WHERE deck_hash = ?", (deck_hash,))
+        self._conn.execute("DELETE FROM slides WHERE deck_hash = ?", (deck_hash,))
+        self._conn.execute("DELETE FROM fields WHERE deck_hash = ?", (deck_hash,))
+
+    def delete(self, deck_hash):
+        with self._lock, self._conn:
+            self._delete(deck_hash)
+            self._conn.execute("DELETE FROM decks WHERE deck_hash = ?", (deck_hash,))
+
+    def get(self, deck_hash):
+        """ The stored analysis of the deck with its structured summary and descriptions, None if it has none """
+        with span("store.get", deck_hash=deck_hash):
+            rows = self._execute("SELECT * FROM decks WHERE deck_hash = ?", (deck_hash,))
+            if not rows:
+                return None
+            deck = self._to_dict(rows[0])
+            deck["summary"] = rows[0]["summary"]
+            deck["structured"] = {row["heading"]: row["value"] for row in self._execute(
+                "SELECT heading, value FROM fields WHERE deck_hash = ? ORDER BY position", (deck_hash,))}
+            deck["descriptions"] = [f"Slide {row['page_number']}:\n{row['description']}" for row in self._execute(
+                "SELECT page_number, description FROM slides WHERE deck_hash = ? ORDER BY page_number", (deck_hash,))]
+            return deck
+
+    def has(self, deck_hash):
+        return bool(self._execute("SELECT 1 FROM decks WHERE deck_hash = ?", (deck_hash,)))
+
+    def list(self, company=None, limit=50):
+        """ Recently analyzed decks; company matches the start of the name, case-insensitive """
+        if company is None:
+            rows = self._execute("SELECT * FROM decks ORDER BY updated DESC LIMIT ?", (limit,))
+        else:
+            rows = self._execute(
+                "SELECT * FROM decks WHERE company LIKE ? ESCAPE '\\' ORDER BY company, updated DESC LIMIT ?",
+                (_like_prefix(company), limit))
+        return [self._to_dict(row) for row in rows]
+
+    def field(self, heading, value=None, limit=50):
+        """
+        Decks with a non-empty value under the heading, matched like the template
+        headings are; value matches the start of the text, case-insensitive.
+        """
+        key = heading_key(heading)
+        sql = """
+            SELECT decks.*, fields.heading, fields.value FROM fields JOIN decks USING (deck_hash)
+            WHERE fields.key = ? AND fields.value {} ORDER BY decks.updated DESC LIMIT ?"""
+        if value is None:
+            rows = self._execute(sql.format("!= ''"), (key, limit))
+        else:
+            rows = self._execute(sql.format("LIKE ? ESCAPE '\\'"), (key, _like_prefix(value), limit))
+        return [dict(self._to_dict(row), heading=row["heading"], value=row["value"]) for row in rows]
+
+    def search(self, query, kind=None, limit=20, raw=False):
+        """
+        Full-text search over memos, slide descriptions and heading values, best matches
+        first. The words of query must all occur (stemmed, "word*" for a prefix); with
+        raw the query is passed to FTS5 as it is.
+        """
+        match = query if raw else fts_query(query)
+        if not match:
+            return []
+        sql = """
+            SELECT documents.deck_hash, documents.kind, documents.ref, decks.name, decks.company,
+                   snippet(documents_fts, 0, '[', ']', '…', 12) AS snippet, documents_fts.rank AS rank
+            FROM documents_fts JOIN documents ON documents.id = documents_fts.rowid
+            JOIN decks ON decks.deck_hash = documents.deck_hash
+            WHERE documents_fts MATCH ? {} ORDER BY documents_fts.rank LIMIT ?"""
+        with span("store.search", query=query) as search_span:
+            if kind is None:
+                rows = self._execute(sql.format(""), (match, limit))
+            else:
+                rows = self._execute(sql.format("AND documents.kind = ?"), (match, kind, limit))
+            search_span.set(hits=len(rows))
+        return [dict(row) for row in rows]
+
+    def counts(self):
+        rows = self._execute("""
+            SELECT (SELECT COUNT(*) FROM decks) AS decks, (SELECT COUNT(*) FROM slides) AS slides,
+                   (SELECT COUNT(*) FROM fields) AS fields""")
+        return dict(rows[0])
+
+    def export_parquet(self, folder=EXPORT_FOLDER):
+        """
+        Writes decks.parquet, slides.parquet and fields.parquet to folder for bulk
+        analysis, in row groups of EXPORT_BATCH_ROWS; returns the paths by table.
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet export needs pyarrow, install it with `pip install pyarrow`")
+
+        string, number = pa.string(), pa.int64()
+        tables = {
+            "decks": ("SELECT deck_hash, name, company, summary, cost, slides, options, created, updated FROM decks", pa.schema([
+                ("deck_hash", string), ("name", string), ("company", string), ("summary", string), ("cost", pa.float64()),
+                ("slides", number), ("options", string), ("created", pa.float64()), ("updated", pa.float64())])),
+            "slides": ("SELECT deck_hash, page_number, description FROM slides", pa.schema([
+                ("deck_hash", string), ("page_number", number), ("description", string)])),
+            "fields": ("SELECT deck_hash, position, heading, key, value FROM fields", pa.schema([
+                ("deck_hash", string), ("position", number), ("heading", string), ("key", string), ("value", string)])),
+        }
+        os.makedirs(folder, exist_ok=True)
+        paths = {}
+        # A connection of its own, so the export reads one snapshot without holding the lock
+        conn = sqlite3.connect(self.path)
+        try:
+            for table, (sql, schema) in tables.items():
+                paths[table] = path = os.path.join(folder, f"{table}.parquet")
+                with span("store.export", table=table) as export_span, pq.ParquetWriter(path, schema) as writer:
+                    cursor = conn.execute(sql)
+                    rows = 0
+                    while batch := cursor.fetchmany(EXPORT_BATCH_ROWS):
+                        writer.write_table(pa.Table.from_pylist(
+                            [dict(zip(schema.names, row)) for row in batch], schema=schema))
+                        rows += len(batch)
+                    export_span.set(rows=rows)
+        finally:
+            conn.close()
+        return paths
+
+    @staticmethod
+    def _to_dict(row):
+        # The memo and the slides are left out of listings, get() returns them
+        return {
+            "deck_hash": row["deck_hash"],
+            "name": row["name"],
+            "company": row["company"],
+            "cost": row["cost"],
+            "slides": row["slides"],
+            "options": json.loads(row["options"]),
+            "created": row["created"],
+            "updated": row["updated"],
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _like_prefix(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def import_results(store, results_path):
+    """
+    Stores the finished decks of a batch_runner results file, returns how many. The
+    file has no descriptions, so decks already in the store are left as they are.
+    """
+    stored = 0
+    with open(results_path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("finished") and not store.has(record["deck_hash"]):
+                store.put(record["deck_hash"], record["summary"], record.get("structured"),
+                          name=os.path.basename(record["path"]), cost=record["cost"])
+                stored += 1
+    return stored
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up, search and export the corpus of analyzed Pitch Decks.")
+    parser.add_argument("--db", default=DECK_STORE_PATH, help="SQLite file of the deck store")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    search_parser = commands.add_parser("search", help="Full-text search over memos, slides and heading values")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--kind", choices=[KIND_SUMMARY, KIND_SLIDE, KIND_FIELD], default=None)
+    search_parser.add_argument("--limit", type=int, default=20)
+    search_parser.add_argument("--raw", action="store_true", help="Pass the query to FTS5 unchanged (AND, OR, NEAR, column filters)")
+
+    get_parser = commands.add_parser("get", help="Print the stored memo of a deck")
+    get_parser.add_argument("deck_hash")
+    get_parser.add_argument("--json", action="store_true", help="Print the whole record as JSON")
+
+    company_parser = commands.add_parser("company", help="Decks of companies whose name starts with NAME")
+    company_parser.add_argument("name")
+    company_parser.add_argument("--limit", type=int, default=50)
+
+    field_parser = commands.add_parser("field", help="Values of one template heading, e.g. \"Stage\"")
+    field_parser.add_argument("heading")
+    field_parser.add_argument("value", nargs="?", default=None, help="Only values starting with this")
+    field_parser.add_argument("--limit", type=int, default=50)
+
+    export_parser = commands.add_parser("export", help="Write the corpus as Parquet files")
+    export_parser.add_argument("folder", nargs="?", default=EXPORT_FOLDER)
+
+    import_parser = commands.add_parser("import", help="Store the finished decks of batch_runner results files")
+    import_parser.add_argument("results", nargs="+")
+
+    commands.add_parser("status", help="Print how many decks, slides and fields are stored")
+    args = parser.parse_args()
+
+    store = DeckStore(args.db)
+    try:
+        if args.command == "search":
+            for hit in store.search(args.query, kind=args.kind, limit=args.limit, raw=args.raw):
+                where = hit["kind"] if hit["ref"] is None else f"{hit['kind']} {hit['ref']}"
+                print(f"{hit['deck_hash'][:12]}  {hit['company'] or hit['name'] or '-'}  ({where})  {' '.join(hit['snippet'].split())}")
+        elif args.command == "get":
+            deck = store.get(args.deck_hash)
+            if deck is None:
+                raise SystemExit(f"No stored deck {args.deck_hash}")
+            print(json.dumps(deck, indent=2, ensure_ascii=False) if args.json else deck["summary"])
+        elif args.command == "company":
+            for deck in store.list(company=args.name, limit=args.limit):
+                print(f"{deck['deck_hash'][:12]}  {deck['company']}  {deck['name'] or ''}")
+        elif args.command == "field":
+            for deck in store.field(args.heading, args.value, limit=args.limit):
+                value = " ".join(deck["value"].split())
+                print(f"{deck['deck_hash'][:12]}  {deck['company'] or deck['name'] or '-'}  {value[:100]}")
+        elif args.command == "export":
+            for table, path in store.export_parquet(args.folder).items():
+                print(f"{table}: {path}")
+        elif args.command == "import":
+            for results_path in args.results:
+                print(f"{results_path}: {import_results(store, results_path)} decks stored")
+        else:
+            print(", ".join(f"{count} {name}" for name, count in store.counts().items()))
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
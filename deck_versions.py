@@ -0,0 +1,424 @@
+import os
+import re
+import glob
+import json
+import time
+import difflib
+import hashlib
+import sqlite3
+import asyncio
+import argparse
+from contextlib import closing
+from dataclasses import dataclass
+
+import fitz
+from PIL import Image
+
+from render_pipeline import PageRenderPipeline, get_render_pool, DEFAULT_MAX_INFLIGHT_BYTES
+from vision_analyzer import describe_pages, main_prompt
+from openai_session import get_settings, get_async_client, run_sync
+from gpt4_summarizer import summarize_async, set_verbosity
+from deck_store import file_sha256
+from prompt_templates.default_summary_template import default_summary_template
+from run_checkpoint import new_run_id, delete_checkpoints
+from disk_eviction import evict_files
+from tracing import span
+
+
+VERSION_FOLDER = os.path.join(".cache", "deck_versions")
+# SQLite index of the stored versions by page hashes, in the version folder
+VERSION_INDEX = "index.sqlite3"
+# Versions compared page by page in a lookup: those sharing the most page hashes with the deck
+MAX_VERSION_CANDIDATES = 20
+
+PAGE_UNCHANGED = "unchanged"
+PAGE_TRIVIAL = "trivial"
+PAGE_CHANGED = "changed"
+
+SLIDE_PREFIX = re.compile(r"^Slide \d+:\n")
+
+
+@dataclass
+class VersionMatchSettings:
+    # Bits of the 64-bit dHash that may differ on an unchanged page (antialiasing, re-export)
+    unchanged_max_distance: int = 4
+    # Small visual edits (a moved logo, a restyled chart) whose description still holds
+    trivial_max_distance: int = 12
+    # Text similarity (0-1) of a trivially changed page, e.g. a fixed typo
+    trivial_min_text_ratio: float = 0.95
+    # Share of pages an earlier version must share to be picked automatically
+    min_shared_pages: float = 0.5
+    # Zoom of the grayscale thumbnail the hash is computed from
+    thumbnail_zoom: float = 0.25
+
+
+def normalize_text(text):
+    return " ".join(text.lower().split())
+
+
+def dhash(page, zoom=0.25, hash_size=8):
+    """ Perceptual difference hash of a page: brightness gradients of a tiny grayscale thumbnail, as hex """
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    image = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    pixels = list(image.resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = bits << 1 | (left > right)
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+def page_keys(page):
+    """ Index keys of a page signature: its dHash, and its text hash unless the page has no text """
+    keys = [f"d:{page['dhash']}"]
+    if page["text"]:
+        keys.append(f"t:{page['text_hash']}")
+    return keys
+
+
+def hamming(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+
+def page_signatures(pdf_path, settings=None):
+    """ dHash and normalized text of every page """
+    settings = settings or VersionMatchSettings()
+    signatures = []
+    with span("version.fingerprint", path=os.path.basename(str(pdf_path))) as fingerprint_span:
+        pdf = fitz.open(pdf_path)
+        for page in pdf:
+            text = normalize_text(page.get_text("text", sort=True))
+            signatures.append({
+                "page_number": page.number + 1,
+                "dhash": dhash(page, settings.thumbnail_zoom),
+                "text": text,
+                "text_hash": hashlib.sha256(text.encode()).hexdigest()[:16],
+            })
+        pdf.close()
+        fingerprint_span.set(pages=len(signatures))
+    return signatures
+
+
+def compare_pages(new, old, settings):
+    """ PAGE_UNCHANGED, PAGE_TRIVIAL or PAGE_CHANGED for a pair of page signatures """
+    distance = hamming(new["dhash"], old["dhash"])
+    same_text = new["text_hash"] == old["text_hash"]
+
+    if same_text and distance <= settings.unchanged_max_distance:
+        return PAGE_UNCHANGED
+    if distance <= settings.trivial_max_distance:
+        if same_text:
+            return PAGE_TRIVIAL
+        # quick_ratio is an upper bound, the exact ratio is only computed when it can pass
+        matcher = difflib.SequenceMatcher(None, new["text"], old["text"], autojunk=False)
+        if matcher.quick_ratio() >= settings.trivial_min_text_ratio and matcher.ratio() >= settings.trivial_min_text_ratio:
+            return PAGE_TRIVIAL
+    return PAGE_CHANGED
+
+
+def match_pages(new_pages, old_pages, settings=None):
+    """
+    Best earlier page for every new page. Returns one dict per new page with its
+    status and the matched old page number (None for changed pages), and the old
+    page numbers no new page matched (removed slides).
+    """
+    settings = settings or VersionMatchSettings()
+    rank = {PAGE_UNCHANGED: 0, PAGE_TRIVIAL: 1}
+
+    matches = []
+    for new in new_pages:
+        best = None
+        for old in old_pages:
+            status = compare_pages(new, old, settings)
+            if status == PAGE_CHANGED:
+                continue
+            # Prefer the closer match, then the page at the same position
+            key = (rank[status], abs(old["page_number"] - new["page_number"]))
+            if best is None or key < best[0]:
+                best = key, status, old["page_number"]
+        if best is None:
+            matches.append({"page_number": new["page_number"], "status": PAGE_CHANGED, "previous": None})
+        else:
+            matches.append({"page_number": new["page_number"], "status": best[1], "previous": best[2]})
+
+    matched = {match["previous"] for match in matches}
+    removed = [old["page_number"] for old in old_pages if old["page_number"] not in matched]
+    return matches, removed
+
+
+def _version_path(deck_hash, folder):
+    return os.path.join(folder, f"{deck_hash}.json")
+
+
+def load_version(deck_hash, folder=VERSION_FOLDER):
+    try:
+        with open(_version_path(deck_hash, folder), encoding="utf-8") as version_file:
+            return json.load(version_file)
+    except FileNotFoundError:
+        return None
+
+
+def _index_version(conn, version):
+    conn.execute("DELETE FROM version_pages WHERE deck_hash = ?", (version["deck_hash"],))
+    conn.executemany("INSERT OR IGNORE INTO version_pages VALUES (?, ?, ?)", [
+        (key, version["deck_hash"], page["page_number"]) for page in version["pages"] for key in page_keys(page)])
+
+
+def _open_index(folder):
+    # A connection per call: lookups run in the render pool's processes
+    os.makedirs(folder, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(folder, VERSION_INDEX), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS version_pages (
+            key TEXT NOT NULL,
+            deck_hash TEXT NOT NULL,
+            page_number INTEGER NOT NULL,
+            PRIMARY KEY (key, deck_hash, page_number)
+        ) WITHOUT ROWID""")
+    conn.execute("CREATE INDEX IF NOT EXISTS version_pages_deck_hash ON version_pages (deck_hash)")
+    if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+        # Versions stored before the index existed
+        with conn:
+            for version in list_versions(folder):
+                _index_version(conn, version)
+            conn.execute("PRAGMA user_version = 1")
+    return conn
+
+
+def save_version(version, folder=VERSION_FOLDER):
+    os.makedirs(folder, exist_ok=True)
+    path = _version_path(version["deck_hash"], folder)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as version_file:
+        json.dump(version, version_file)
+    os.replace(tmp_path, path)
+    with closing(_open_index(folder)) as conn, conn:
+        _index_version(conn, version)
+
+
+def evict_versions(max_bytes, max_age, folder=VERSION_FOLDER):
+    """ Drops the versions not analyzed for max_age seconds, then the oldest ones past max_bytes; returns their paths """
+    removed = evict_files(folder, "*.json", max_bytes=max_bytes, max_age=max_age)
+    if removed:
+        with closing(_open_index(folder)) as conn, conn:
+            conn.executemany("DELETE FROM version_pages WHERE deck_hash = ?",
+                             [(os.path.basename(path)[:-len(".json")],) for path in removed])
+    return removed + evict_files(folder, "*.tmp", max_age=max_age)
+
+
+def list_versions(folder=VERSION_FOLDER):
+    versions = []
+    for path in glob.glob(os.path.join(folder, "*.json")):
+        with open(path, encoding="utf-8") as version_file:
+            versions.append(json.load(version_file))
+    return sorted(versions, key=lambda version: version["created"], reverse=True)
+
+
+def find_previous_version(signatures, folder=VERSION_FOLDER, settings=None):
+    """
+    The stored version sharing the most pages with the signatures, if it shares enough
+    of them. A deck analyzed before matches itself, so nothing is sent again. Only the
+    MAX_VERSION_CANDIDATES versions with the most pages of the same dHash or text are
+    compared page by page.
+    """
+    settings = settings or VersionMatchSettings()
+    keys = sorted({key for page in signatures for key in page_keys(page)})
+    if not keys:
+        return None
+    # Only versions sharing page hashes with the deck are read and matched
+    with closing(_open_index(folder)) as conn:
+        candidates = [row[0] for row in conn.execute(
+            f"SELECT deck_hash FROM version_pages WHERE key IN ({', '.join('?' * len(keys))}) "
+            "GROUP BY deck_hash ORDER BY COUNT(DISTINCT page_number) DESC LIMIT ?", (*keys, MAX_VERSION_CANDIDATES))]
+
+    best, best_shared = None, 0
+    for deck_hash in candidates:
+        version = load_version(deck_hash, folder)
+        if version is None:
+            continue
+        matches, _ = match_pages(signatures, version["pages"], settings)
+        shared = sum(1 for match in matches if match["status"] != PAGE_CHANGED)
+        if shared > best_shared:
+            best, best_shared = version, shared
+
+    if best is None or best_shared < settings.min_shared_pages * len(signatures):
+        return None
+    return best
+
+
+def strip_slide_prefix(description):
+    return SLIDE_PREFIX.sub("", description, count=1)
+
+
+async def describe_version(pdf_path, previous=None, zoom_factor=1, image_format="jpeg", quality=80, budget=None,
+                           api_key=None, use_cache=True, run_id=None, settings=None, client=None, page_callback=None,
+                           max_inflight_bytes=DEFAULT_MAX_INFLIGHT_BYTES, batching=None):
+    """
+    Describes a deck, reusing the descriptions of pages that are unchanged or
+    trivially changed since the previous version (a stored version dict; found
+    automatically when None). Only the other pages go to vision.
+    Returns a plan dict with the version record, the previous version, the
+    per-page matches, the removed old pages and the vision cost, or None if
+    describing the changed pages didn't finish.
+    """
+    settings = settings or VersionMatchSettings()
+    # Hashing, fingerprinting and reading the stored versions run in the render pool, off the event loop
+    loop = asyncio.get_running_loop()
+    render_pool = get_render_pool()
+    deck_hash = await loop.run_in_executor(render_pool, file_sha256, pdf_path)
+    signatures = await loop.run_in_executor(render_pool, page_signatures, pdf_path, settings)
+
+    if previous is None:
+        previous = await loop.run_in_executor(render_pool, find_previous_version, signatures, VERSION_FOLDER, settings)
+    if previous is not None:
+        matches, removed = match_pages(signatures, previous["pages"], settings)
+        old_descriptions = {page["page_number"]: page["description"] for page in previous["pages"]}
+    else:
+        matches, removed, old_descriptions = [{"page_number": page["page_number"], "status": PAGE_CHANGED, "previous": None}
+                                              for page in signatures], [], {}
+
+    changed = [match["page_number"] for match in matches if match["status"] == PAGE_CHANGED]
+    print(f"Version match: {len(signatures) - len(changed)} pages reused, {len(changed)} new or changed, "
+          f"{len(removed)} removed" + (f" (previous version {previous['name']})" if previous else ""))
+
+    cost = 0.0
+    descriptions = {}
+    if changed:
+        pages = PageRenderPipeline(pdf_path, changed, zoom_factor=zoom_factor, image_format=image_format, quality=quality,
+                                   budget=budget, max_inflight_bytes=max_inflight_bytes)
+        described, cost = await describe_pages(
+            client or get_async_client(), pages, main_prompt, zoom_factor=zoom_factor, api_key=api_key,
+            use_cache=use_cache, run_id=run_id, page_callback=page_callback, batching=batching)
+        if described == []:
+            return None
+        descriptions = {page_number: strip_slide_prefix(description) for page_number, description in zip(changed, described)}
+
+    for match in matches:
+        if match["status"] != PAGE_CHANGED:
+            descriptions[match["page_number"]] = old_descriptions[match["previous"]]
+
+    version = {
+        "deck_hash": deck_hash,
+        "name": os.path.basename(str(pdf_path)),
+        "created": time.time(),
+        "previous": previous["deck_hash"] if previous and previous["deck_hash"] != deck_hash else None,
+        "pages": [dict(signature, description=descriptions[signature["page_number"]]) for signature in signatures],
+        "summary": "",
+        "summary_template": None,
+    }
+    return {"version": version, "previous": previous, "matches": matches, "removed": removed, "cost": cost}
+
+
+def get_version_plan(pdf_path, previous=None, **kwargs):
+    """ describe_version for synchronous callers """
+    return run_sync(lambda: describe_version(pdf_path, previous, **kwargs))
+
+
+def slide_descriptions(plan):
+    """ "Slide N:" descriptions of every page of the new version """
+    return [f"Slide {page['page_number']}:\n{page['description']}" for page in plan["version"]["pages"]]
+
+
+def delta_text(plan):
+    """ Changed and removed slides, in the form revision_prompt expects """
+    descriptions = {page["page_number"]: page["description"] for page in plan["version"]["pages"]}
+    old_descriptions = {page["page_number"]: page["description"] for page in plan["previous"]["pages"]}
+
+    parts = [f"Removed slide {page_number} of the previous version:\n{old_descriptions[page_number]}"
+             for page_number in plan["removed"]]
+    parts += [f"Slide {match['page_number']}: (new or changed)\n{descriptions[match['page_number']]}"
+              for match in plan["matches"] if match["status"] == PAGE_CHANGED]
+    return "\n\n".join(parts)
+
+
+def version_text(plan, summary_template=None):
+    """ The text summarize_version summarizes: only the deltas when the previous memo can be refined """
+    if revises_previous(plan, summary_template):
+        return delta_text(plan)
+    return "\n".join(slide_descriptions(plan))
+
+
+def revises_previous(plan, summary_template=None):
+    previous = plan["previous"]
+    summary_template = summary_template or default_summary_template()
+    return previous is not None and bool(previous.get("summary")) and previous.get("summary_template") == summary_template
+
+
+async def summarize_version_async(plan, summary_template=None, api_key=None, run_id=None, strategy="refine", **kwargs):
+    """
+    Summary of the new version: the previous memo refined with only the deltas when
+    the previous version has a memo for the same template, a full summary otherwise.
+    The finished version (descriptions and memo) is stored for the next version.
+    Returns (summary, cost, finished).
+    """
+    summary_template = summary_template or default_summary_template()
+    previous = plan["previous"]
+    version = plan["version"]
+
+    if revises_previous(plan, summary_template):
+        changes = delta_text(plan)
+        if changes:
+            summary, cost, finished = await summarize_async(
+                changes, strategy="refine", initial_summary=previous["summary"], summary_template=summary_template,
+                api_key=api_key, run_id=run_id, revision=True, **kwargs)
+        else:
+            print("No slides changed, reusing the previous summary")
+            summary, cost, finished = previous["summary"], 0.0, True
+    else:
+        summary, cost, finished = await summarize_async(
+            "\n".join(slide_descriptions(plan)), strategy=strategy, summary_template=summary_template,
+            api_key=api_key, run_id=run_id, **kwargs)
+
+    if finished:
+        version.update(summary=summary, summary_template=summary_template)
+        save_version(version)
+    return summary, cost, finished
+
+
+def summarize_version(plan, *args, **kwargs):
+    """ Blocking summarize_version_async """
+    return run_sync(lambda: summarize_version_async(plan, *args, **kwargs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze a new version of a Pitch Deck, reusing the analysis of an earlier version.')
+    parser.add_argument("pdf_path", help="The new version of the deck")
+    parser.add_argument("--previous", default=None, help="PDF of the earlier version (default: the best matching analyzed version)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Increase output verbosity")
+    parser.add_argument("-z", "--zoom", type=float, default=1.0, help="Zoom factor for page rendering")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the on-disk vision description cache")
+    parser.add_argument("--run-id", default=None, help="Checkpoint the run under this id; running again with the same id resumes an unfinished run")
+    args = parser.parse_args()
+
+    set_verbosity(args.verbose)
+    api_key = get_settings().api_key
+
+    previous = None
+    if args.previous:
+        previous = load_version(file_sha256(args.previous))
+        if previous is None:
+            parser.error(f"{args.previous} hasn't been analyzed yet, run this on it first")
+
+    run_id = args.run_id or new_run_id()
+    print(f"Run id: {run_id}")
+
+    plan = get_version_plan(args.pdf_path, previous, zoom_factor=args.zoom, api_key=api_key,
+                            use_cache=not args.no_cache, run_id=run_id)
+    if plan is None:
+        print(f"Description generation didn't finish. Resume with --run-id {run_id}")
+        return
+
+    summary, cost, finished = summarize_version(plan, api_key=api_key, run_id=run_id)
+    if not finished:
+        print(f"Summary generation didn't finish. Resume with --run-id {run_id}")
+        return
+    delete_checkpoints(run_id)
+    print(f"Final Summary:\n\n {summary}\n\nTotal cost: {plan['cost'] + cost:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import os
+import glob
+import time
+
+
+def evict_files(folder, pattern="*", max_bytes=None, max_age=None, keep=()):
+    """
+    Removes the files of folder matching pattern that weren't modified for max_age
+    seconds, then the least recently modified ones until the rest take at most
+    max_bytes. Files whose name is in keep stay. Returns the removed paths.
+    """
+    now = time.time()
+    files = []
+    for path in glob.glob(os.path.join(glob.escape(folder), pattern)):
+        if os.path.basename(path) in keep:
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+
+    total = sum(size for _, size, _ in files)
+    removed = []
+    for modified, size, path in files:
+        expired = max_age is not None and now - modified > max_age
+        if not expired and (max_bytes is None or total <= max_bytes):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed.append(path)
+    return removed
+
@@ -1,14 +1,26 @@
-from openai import OpenAI
 import os
-from dotenv import load_dotenv
+import time
+import asyncio
 import argparse
+import inspect
 from tqdm import tqdm
 from math import ceil
 
-from vision_analyzer import get_descriptions
-from response_parser import structurize_summary
-from prompt_templates.iteration_prompts import initial_prompt, refine_prompt
+from vision_analyzer import get_descriptions, SlideBatching
+from pdf_text import iter_slide_texts
+from request_scheduler import RateLimits, get_completion_limiter
+from openai_session import get_async_openai_client, run_sync
+from page_renderer import ImageBudget
+from render_pipeline import DEFAULT_MAX_INFLIGHT_BYTES
+from response_parser import structurize_summary, template_headings, parse_sections, parse_patch, apply_patch, render_sections
+from prompt_templates.iteration_prompts import initial_prompt, refine_prompt, merge_prompt, patch_prompt, revision_prompt
 from prompt_templates.default_summary_template import default_summary_template
+from deck_store import DeckStore, DECK_STORE_PATH, file_sha256
+from run_checkpoint import new_run_id, load_checkpoint, save_checkpoint, delete_checkpoints
+from text_chunker import plan_chunks, chunk_token_budget, estimate_tokens, DEFAULT_OUTPUT_TOKENS
+from tracing import span, configure_tracing, peak_rss
+
+SUMMARY_MODEL = "gpt-4"
 
 verbose = False
 
@@ -20,56 +32,146 @@ def v_log(*args, **kwargs):
     if verbose:
         print(*args, **kwargs)
 
-def n_chunks(text, chunk_size=1500):
-    return ceil(len(text) / chunk_size)
+def chunk_budget(summary_template=default_summary_template(), running_summary=True, max_chunk_tokens=None):
+    """ Deck text tokens that fit in one prompt next to the template (and the running summary in refine) """
+    if running_summary:
+        overhead = refine_prompt("", summary_template, "")
+        summary_tokens = DEFAULT_OUTPUT_TOKENS
+    else:
+        overhead = initial_prompt("", summary_template)
+        summary_tokens = 0
+    return chunk_token_budget(overhead, model=SUMMARY_MODEL, summary_tokens=summary_tokens,
+                              max_chunk_tokens=max_chunk_tokens)
+
+
+def split_text(text, summary_template=default_summary_template(), running_summary=True, max_chunk_tokens=None):
+    # Whole slides / paragraphs packed up to the token budget
+    with span("summary.chunk", budget=chunk_budget(summary_template, running_summary, max_chunk_tokens)) as chunk_span:
+        # A generator of sections is packed as it comes, without joining it into one string
+        chunks = plan_chunks(text, chunk_span.attributes["budget"])
+        chunk_span.set(chunks=len(chunks), bytes=sum(len(chunk) for chunk in chunks))
+    return chunks
+
+
+async def split_text_async(text, summary_template=default_summary_template(), running_summary=True, max_chunk_tokens=None):
+    """ split_text in a worker thread: reading a generator of page texts and packing it would block the event loop """
+    return await asyncio.to_thread(split_text, text, summary_template, running_summary, max_chunk_tokens)
+
+
+def n_chunks(text, summary_template=default_summary_template(), running_summary=True, max_chunk_tokens=None):
+    return len(split_text(text, summary_template, running_summary, max_chunk_tokens))
+
+
+input_p1000_tokens = 0.03
+output_p1000_tokens = 0.06
+
+
+def completion_cost(prompt_tokens, completion_tokens):
+    return completion_tokens * output_p1000_tokens / 1000 + prompt_tokens * input_p1000_tokens / 1000
+
+
+async def complete(client, prompt, token_callback=None):
+    """
+    Runs one GPT-4 completion with an AsyncOpenAI client, returns the content and its cost.
+    With a token_callback the completion is streamed, and token_callback(delta, content_so_far)
+    is called for every received piece of text.
+    """
+    # All threads and event loops using the key share its concurrency and rate limits
+    limiter = get_completion_limiter(client.api_key)
+    with span("api.completion", model=SUMMARY_MODEL, stream=token_callback is not None, bytes=len(prompt)) as api_span:
+        async with limiter.slot_async(estimate_tokens(prompt) + DEFAULT_OUTPUT_TOKENS):
+            sent = time.perf_counter()
+            if token_callback is None:
+                completion = await client.chat.completions.create(
+                    model=SUMMARY_MODEL,
+                    messages=[{"role": "system", "content": prompt}],
+                    temperature=0
+                )
+                v_log(completion)
+                prompt_tokens, completion_tokens = completion.usage.prompt_tokens, completion.usage.completion_tokens
+                content = completion.choices[0].message.content
+            else:
+                stream = await client.chat.completions.create(
+                    model=SUMMARY_MODEL,
+                    messages=[{"role": "system", "content": prompt}],
+                    temperature=0,
+                    stream=True
+                )
+                content = ""
+                # A cancelled call closes its connection instead of reading the rest
+                try:
+                    async for chunk in stream:
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            content += delta
+                            token_callback(delta, content)
+                finally:
+                    await stream.close()
+                # Streamed responses carry no usage, so the tokens are estimated from the texts
+                prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(content)
+
+            cost = completion_cost(prompt_tokens, completion_tokens)
+            api_span.set(network=time.perf_counter() - sent, prompt_tokens=prompt_tokens,
+                         completion_tokens=completion_tokens, cost=cost)
+    return content, cost
+
+
+def get_client(api_key=None):
+    # Shared per key on the running loop's connection pool, so repeated runs reuse connections
+    return get_async_openai_client(api_key)
 
-def split_text(text, chunk_size=1500):
-    # Split the text into chunks of 'chunk_size'
-    return [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
 
 # Printing to be adjusted
-def iteratively_summarize(text, initial_summary="", iter_callback=None, summary_template=default_summary_template(), api_key=None):
-    chunks = split_text(text)
-    current_summary = initial_summary
-    n_chunks = len(chunks)
-    
-    if api_key is None:
-        load_dotenv()
-        api_key = os.getenv("OPENAI_API_KEY")
+async def iteratively_summarize_async(text, initial_summary="", iter_callback=None, summary_template=default_summary_template(), api_key=None, max_chunk_tokens=None, run_id=None, token_callback=None, revision=False):
+    """
+    Refines one summary chunk by chunk, starting from initial_summary if given. iter_callback(step, n_steps, summary)
+    is called after every finished step, token_callback(delta, content_so_far) streams each step's output.
+    With revision the text holds the changed and removed slides of a new deck version, and initial_summary
+    is the memo of the previous version.
+    """
+    # Continue from the run's checkpoint if it has one, the text is then already in the chunk plan
+    state = load_checkpoint(run_id, "summary")
+    if state is None:
+        state = {
+            "strategy": "refine",
+            "summary_template": summary_template,
+            "chunks": await split_text_async(text, summary_template, max_chunk_tokens=max_chunk_tokens),
+            "step": 0,
+            "summary": initial_summary,
+            "revision": revision,
+            "cost": 0.0,
+        }
+    else:
+        print(f"Resuming run {run_id} from step {state['step'] + 1}")
 
-    client = OpenAI(api_key=api_key)
-    total_cost = 0
+    chunks = state["chunks"]
+    summary_template = state["summary_template"]
+    current_summary = state["summary"]
+    n_chunks = len(chunks)
     
-    input_p1000_tokens = 0.03
-    output_p1000_tokens = 0.06
+    client = get_client(api_key)
+    total_cost = state["cost"]
     
     finished = True
     
     print(f"Processing {n_chunks} chunks...")
     
-    progress_bar = tqdm(range(n_chunks))
+    progress_bar = tqdm(range(n_chunks), initial=state["step"])
     
-    for i in range(n_chunks):
-        if i == 0:
+    for i in range(state["step"], n_chunks):
+        if state.get("revision"):
+            prompt = revision_prompt(chunks[i], summary_template, current_summary)
+        elif i == 0 and not current_summary:
             prompt = initial_prompt(chunks[0], summary_template)
         else:
             prompt = refine_prompt(chunks[i], summary_template, current_summary)
             
         v_log(f"\nPrompt {i + 1}/{n_chunks}:\n{prompt}\n")
-        total_cost = 0.0
         
         try:
-            completion = client.chat.completions.create(
-                model="gpt-4",
-                messages=[{"role": "system", "content": prompt}],
-                temperature=0
-            )
-            v_log(completion)
-            current_summary = completion.choices[0].message.content
-            
-            output_cost = completion.usage.completion_tokens * output_p1000_tokens / 1000
-            input_cost = completion.usage.prompt_tokens * input_p1000_tokens / 1000
-            total_cost += (output_cost + input_cost)
+            with span("summary.refine_step", step=i + 1, steps=n_chunks):
+                current_summary, cost = await complete(client, prompt, token_callback)
+            total_cost += cost
         
         except Exception as e:
             print(f"Error processing chunk {i + 1}/{n_chunks}:\n{e}")
@@ -77,11 +179,15 @@ def iteratively_summarize(text, initial_summary="", iter_callback=None, summary_
             #E.g. openai.error.TimeoutError ...
             finished = False
             break
+
+        state.update(step=i + 1, summary=current_summary, cost=total_cost)
+        if run_id is not None:
+            save_checkpoint(run_id, "summary", state)
         
         v_log(f"\nCost so far: {total_cost:.3f}\n")
         
         if not iter_callback is None:
-            iter_callback()
+            iter_callback(i + 1, n_chunks, current_summary)
             
         progress_bar.update(1)
     
@@ -91,6 +197,280 @@ def iteratively_summarize(text, initial_summary="", iter_callback=None, summary_
     return current_summary, total_cost, finished
 
 
+async def patch_summarize_async(text, initial_summary="", iter_callback=None, summary_template=default_summary_template(), api_key=None, max_chunk_tokens=None, run_id=None, token_callback=None):
+    """
+    Keeps the summary as one text per template section. For every chunk GPT-4 only
+    returns the sections the chunk changes, as a JSON patch that is merged locally;
+    the memo is rendered from the sections at the end. Callbacks as in
+    iteratively_summarize, but patches are not streamed.
+    """
+    state = load_checkpoint(run_id, "summary")
+    if state is None:
+        headings = template_headings(summary_template)
+        sections = {heading: "" for heading in headings}
+        if initial_summary:
+            sections.update(parse_sections(initial_summary, headings))
+        state = {
+            "strategy": "patch",
+            "summary_template": summary_template,
+            "chunks": await split_text_async(text, summary_template, max_chunk_tokens=max_chunk_tokens),
+            "step": 0,
+            "sections": sections,
+            "cost": 0.0,
+        }
+    else:
+        print(f"Resuming run {run_id} from step {state['step'] + 1}")
+
+    chunks = state["chunks"]
+    summary_template = state["summary_template"]
+    sections = state["sections"]
+    n_chunks = len(chunks)
+
+    client = get_client(api_key)
+    finished = True
+
+    print(f"Processing {n_chunks} chunks...")
+    progress_bar = tqdm(range(n_chunks), initial=state["step"])
+
+    for i in range(state["step"], n_chunks):
+        prompt = patch_prompt(chunks[i], summary_template, sections)
+        v_log(f"\nPrompt {i + 1}/{n_chunks}:\n{prompt}\n")
+
+        try:
+            with span("summary.patch_step", step=i + 1, steps=n_chunks) as step_span:
+                content, cost = await complete(client, prompt)
+                patch = parse_patch(content)
+                if patch is None:
+                    # Not a patch, most likely a whole memo: take the sections it fills in
+                    patch = {heading: value for heading, value in parse_sections(content, list(sections)).items() if value}
+                changed = apply_patch(sections, patch)
+                step_span.set(changed=len(changed))
+            state["cost"] += cost
+
+        except Exception as e:
+            print(f"Error processing chunk {i + 1}/{n_chunks}:\n{e}")
+            finished = False
+            break
+
+        v_log(f"\nChanged sections: {changed}\n")
+        state.update(step=i + 1)
+        if run_id is not None:
+            save_checkpoint(run_id, "summary", state)
+
+        if iter_callback is not None:
+            iter_callback(i + 1, n_chunks, render_sections(sections))
+        progress_bar.update(1)
+
+    progress_bar.close()
+    v_log(f"Total cost: {state['cost']:.3f}\n")
+
+    return render_sections(sections), state["cost"], finished
+
+
+def n_merge_steps(n_summaries, merge_fanout=2):
+    # Every merge round groups the summaries by merge_fanout until one remains,
+    # a lone leftover summary is carried over without a call
+    steps = 0
+    while n_summaries > 1:
+        groups = ceil(n_summaries / merge_fanout)
+        steps += groups - (1 if n_summaries % merge_fanout == 1 else 0)
+        n_summaries = groups
+    return steps
+
+
+async def complete_parallel(client, prompts, max_workers, on_result=None, token_callback=None):
+    """
+    Runs the prompts concurrently, at most max_workers at a time, returns the contents (None where failed)
+    and the total cost. on_result(i, content, cost) is called as each prompt finishes.
+    A single prompt is streamed to token_callback if given.
+    """
+    results = [None] * len(prompts)
+    total_cost = 0.0
+    slots = asyncio.Semaphore(max_workers)
+
+    # Tasks run in a copy of the caller's context, so they are traced under the caller's span
+    async def run(i, prompt):
+        nonlocal total_cost
+        cost = 0.0
+        try:
+            async with slots:
+                results[i], cost = await complete(client, prompt, token_callback if len(prompts) == 1 else None)
+            total_cost += cost
+        except Exception as e:
+            print(f"Error processing prompt {i + 1}/{len(prompts)}:\n{e}")
+        if on_result is not None:
+            on_result(i, results[i], cost)
+
+    await asyncio.gather(*[run(i, prompt) for i, prompt in enumerate(prompts)])
+    return results, total_cost
+
+
+def merge_groups(summaries, merge_fanout):
+    return [summaries[i:i + merge_fanout] for i in range(0, len(summaries), merge_fanout)]
+
+
+async def map_reduce_summarize_async(text, initial_summary="", iter_callback=None, summary_template=default_summary_template(), api_key=None, max_chunk_tokens=None, merge_fanout=2, max_workers=8, run_id=None, token_callback=None):
+    """
+    Summarizes every chunk against the template in parallel, then merges the
+    partial summaries merge_fanout at a time until a single memo remains.
+    Callbacks as in iteratively_summarize; only rounds with a single call (e.g.
+    the final merge) are streamed.
+    """
+    if merge_fanout < 2:
+        raise ValueError("merge_fanout must be at least 2")
+
+    # Round 0 maps the chunks, every later round merges the previous round's outputs
+    state = load_checkpoint(run_id, "summary")
+    if state is None:
+        # Map prompts don't carry a running summary, so each chunk can be larger
+        chunks = await split_text_async(text, summary_template, running_summary=False, max_chunk_tokens=max_chunk_tokens)
+        state = {
+            "strategy": "map_reduce",
+            "summary_template": summary_template,
+            "merge_fanout": merge_fanout,
+            "initial_summary": initial_summary,
+            "n_chunks": len(chunks),
+            "round": 0,
+            "inputs": chunks,
+            "outputs": [None] * len(chunks),
+            "cost": 0.0,
+        }
+    else:
+        print(f"Resuming run {run_id} from round {state['round'] + 1}")
+
+    summary_template = state["summary_template"]
+    merge_fanout = state["merge_fanout"]
+    client = get_client(api_key)
+
+    # An existing summary is merged in like any other partial summary
+    n_leaves = state["n_chunks"] + (1 if state["initial_summary"] else 0)
+    n_steps = state["n_chunks"] + n_merge_steps(n_leaves, merge_fanout)
+    print(f"Processing {state['n_chunks']} chunks in {n_steps} steps...")
+
+    if state["round"] == 0:
+        steps_done = 0
+    else:
+        steps_done = n_steps - n_merge_steps(len(state["inputs"]), merge_fanout)
+    steps_done += sum(1 for output in state["outputs"] if output is not None)
+    progress_bar = tqdm(range(n_steps), initial=steps_done)
+
+    finished = True
+    while True:
+        if state["round"] == 0:
+            prompts = [initial_prompt(chunk, summary_template) for chunk in state["inputs"]]
+        else:
+            prompts = [merge_prompt(group, summary_template)
+                       for group in merge_groups(state["inputs"], merge_fanout)]
+        pending = [i for i, output in enumerate(state["outputs"]) if output is None]
+
+        def on_result(i, content, cost):
+            if content is None:
+                return
+            state["outputs"][pending[i]] = content
+            state["cost"] += cost
+            if run_id is not None:
+                save_checkpoint(run_id, "summary", state)
+            progress_bar.update(1)
+            if iter_callback is not None:
+                iter_callback(progress_bar.n, n_steps, content)
+
+        with span("summary.map" if state["round"] == 0 else "summary.merge", round=state["round"], calls=len(pending)):
+            await complete_parallel(client, [prompts[i] for i in pending], max_workers, on_result, token_callback)
+        v_log(f"\nCost so far: {state['cost']:.3f}\n")
+
+        if any(output is None for output in state["outputs"]):
+            finished = False
+            break
+
+        summaries = state["outputs"]
+        if state["round"] == 0 and state["initial_summary"]:
+            summaries = [state["initial_summary"]] + summaries
+        if len(summaries) <= 1:
+            break
+
+        # Next round; a lone leftover summary is carried over as is
+        groups = merge_groups(summaries, merge_fanout)
+        state.update(round=state["round"] + 1, inputs=summaries,
+                     outputs=[group[0] if len(group) == 1 else None for group in groups])
+        if run_id is not None:
+            save_checkpoint(run_id, "summary", state)
+
+    progress_bar.close()
+    v_log(f"Total cost: {state['cost']:.3f}\n")
+
+    if not finished:
+        return "", state["cost"], False
+    if summaries:
+        return summaries[0], state["cost"], True
+    return state["initial_summary"], state["cost"], True
+
+
+def iteratively_summarize(*args, **kwargs):
+    """ Blocking iteratively_summarize_async """
+    return run_sync(lambda: iteratively_summarize_async(*args, **kwargs))
+
+
+def patch_summarize(*args, **kwargs):
+    """ Blocking patch_summarize_async """
+    return run_sync(lambda: patch_summarize_async(*args, **kwargs))
+
+
+def map_reduce_summarize(*args, **kwargs):
+    """ Blocking map_reduce_summarize_async """
+    return run_sync(lambda: map_reduce_summarize_async(*args, **kwargs))
+
+
+SUMMARY_STRATEGIES = {
+    "refine": iteratively_summarize_async,
+    "map_reduce": map_reduce_summarize_async,
+    "patch": patch_summarize_async,
+}
+
+
+def n_steps(text, strategy="refine", summary_template=default_summary_template(), max_chunk_tokens=None, merge_fanout=2):
+    """ Number of GPT-4 calls the strategy makes for the text, following the same chunk plan """
+    if strategy == "map_reduce":
+        chunks = n_chunks(text, summary_template, running_summary=False, max_chunk_tokens=max_chunk_tokens)
+        return chunks + n_merge_steps(chunks, merge_fanout)
+    return n_chunks(text, summary_template, max_chunk_tokens=max_chunk_tokens)
+
+
+async def summarize_async(text, strategy="refine", run_id=None, timeout=None, **kwargs):
+    """
+    Summarizes the text (a string, or an iterable of "Slide N:" sections) with one of
+    SUMMARY_STRATEGIES, returns (summary, cost, finished).
+    With a run_id every step is checkpointed, and calling again with the same run_id
+    continues an unfinished run from its first unfinished step. Past timeout seconds the
+    run is cancelled and asyncio.TimeoutError raised; finished steps stay in the checkpoint.
+    """
+    state = load_checkpoint(run_id, "summary")
+    if state is not None:
+        strategy = state["strategy"]
+    if strategy not in SUMMARY_STRATEGIES:
+        raise ValueError(f"Unknown summary strategy '{strategy}', expected one of {list(SUMMARY_STRATEGIES)}")
+
+    # Options of other strategies (e.g. merge_fanout) are ignored
+    function = SUMMARY_STRATEGIES[strategy]
+    accepted = inspect.signature(function).parameters
+    kwargs = {name: value for name, value in kwargs.items() if name in accepted}
+    with span("summary", strategy=strategy, run_id=run_id) as summary_span:
+        summary, cost, finished = await asyncio.wait_for(function(text, run_id=run_id, **kwargs), timeout)
+        summary_span.set(finished=finished)
+    return summary, cost, finished
+
+
+def summarize(text, strategy="refine", run_id=None, timeout=None, **kwargs):
+    """ Blocking summarize_async, for callers without an event loop """
+    return run_sync(lambda: summarize_async(text, strategy=strategy, run_id=run_id, timeout=timeout, **kwargs))
+
+
+def resume_summary(run_id, **kwargs):
+    """ Continues an unfinished summary run from its checkpoint """
+    if load_checkpoint(run_id, "summary") is None:
+        raise ValueError(f"No summary checkpoint for run {run_id}")
+    return summarize("", run_id=run_id, **kwargs)
+
+
 def main():
     
     def range_limited_float_type(arg):
@@ -107,16 +487,71 @@ def main():
     
     parser.add_argument("-v", "--verbose", action="store_true", help="Increase output verbosity")
     parser.add_argument("-z", "--zoom", type=range_limited_float_type, default=1.0, help="Zoom factor for PDF to JPEG conversion - 1 is original size, 0.5 is half resolution")
+    parser.add_argument("--image-format", choices=["jpeg", "png", "webp", "auto"], default="jpeg", help="Codec for the page images sent to the vision API (auto requires --adaptive)")
+    parser.add_argument("--adaptive", action="store_true", help="Size, encode and pick the detail level of every page adaptively instead of a fixed zoom")
+    parser.add_argument("--target-tiles", type=int, default=ImageBudget.target_tiles, help="With --adaptive: 512px tiles billed per page in high detail")
+    parser.add_argument("--max-image-bytes", type=int, default=ImageBudget.max_bytes, help="With --adaptive: upper limit for one encoded page")
+    parser.add_argument("--quality", type=int, default=80, help="Encoder quality for lossy image formats (1-100)")
+    parser.add_argument("--debug-images", metavar="DIR", default=None, help="Also write the rendered page images into a per-run folder under DIR")
+    parser.add_argument("--max-concurrency", type=int, default=RateLimits.max_concurrency, help="Maximum number of vision requests in flight")
+    parser.add_argument("--rpm", type=int, default=RateLimits.requests_per_minute, help="Requests per minute allowed for the API key")
+    parser.add_argument("--tpm", type=int, default=RateLimits.tokens_per_minute, help="Tokens per minute allowed for the API key")
+    parser.add_argument("--max-inflight-mb", type=int, default=DEFAULT_MAX_INFLIGHT_BYTES // 1_000_000, help="Memory ceiling for rendered pages waiting on or in an upload, in MB")
+    parser.add_argument("--text-only", action="store_true", help="Summarize the PDF's own text instead of vision descriptions (no vision costs)")
+    parser.add_argument("--max-pages", type=int, default=None, help="With --text-only: stop after this many pages with text")
+    parser.add_argument("--max-chars", type=int, default=None, help="With --text-only: stop after this many characters of text")
+    parser.add_argument("--triage", action="store_true", help="Send only image-heavy pages to the vision API, use the PDF text for the rest and skip blank or duplicate pages")
+    parser.add_argument("--batch-slides", type=int, default=1, help="Pages described per vision request (1 sends every page on its own)")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the on-disk vision description cache")
+    parser.add_argument("-s", "--strategy", choices=list(SUMMARY_STRATEGIES), default="refine", help="Summarization strategy: sequential refine, parallel map-reduce or section patches")
+    parser.add_argument("--merge-fanout", type=int, default=2, help="Summaries merged per call in the map_reduce strategy")
+    parser.add_argument("--max-chunk-tokens", type=int, default=None, help="Upper limit for deck text tokens per summarization step (default: whatever fits the model context)")
+    parser.add_argument("--stream", action="store_true", help="Print the summary as it is generated")
+    parser.add_argument("--run-id", default=None, help="Checkpoint the run under this id; running again with the same id resumes an unfinished run")
+    parser.add_argument("--trace", metavar="FILE", default=None, help="Append a JSON lines trace of every rendering, API and parsing step to FILE")
+    parser.add_argument("--base-url", default=None, help="OpenAI-compatible API to send requests to, e.g. a local mock server (default: OPENAI_BASE_URL or api.openai.com)")
+    parser.add_argument("--decks-db", default=DECK_STORE_PATH, help="SQLite file of the deck store the result is added to")
+    parser.add_argument("--no-store", action="store_true", help="Don't add the result to the deck store")
     parser.add_argument('pdf_path', type=str, help='Path to the PDF file to be processed')
     args = parser.parse_args()
 
     set_verbosity(args.verbose)
     pdf_path = args.pdf_path
+    if args.base_url:
+        os.environ["OPENAI_BASE_URL"] = args.base_url
+    if args.trace:
+        configure_tracing(args.trace)
+
+    if args.image_format == "auto" and not args.adaptive:
+        parser.error("--image-format auto requires --adaptive")
+    budget = ImageBudget(target_tiles=args.target_tiles, max_bytes=args.max_image_bytes, quality=args.quality) if args.adaptive else None
+
+    run_id = args.run_id or new_run_id()
+    print(f"Run id: {run_id}")
     
-    description_list, cost1 = get_descriptions(pdf_path, zoom_factor=args.zoom)
-    long_description = "\n".join(description_list)
+    if args.text_only:
+        # Pages are read as the chunker asks for them, the deck text is never held as one string
+        long_description, cost1 = iter_slide_texts(pdf_path, max_pages=args.max_pages, max_chars=args.max_chars), 0.0
+    else:
+        description_list, cost1 = get_descriptions(
+            pdf_path, zoom_factor=args.zoom, image_format=args.image_format, quality=args.quality, debug_folder=args.debug_images,
+            rate_limits=RateLimits(max_concurrency=args.max_concurrency, requests_per_minute=args.rpm, tokens_per_minute=args.tpm),
+            use_cache=not args.no_cache, run_id=run_id, triage=args.triage, budget=budget,
+            max_inflight_bytes=args.max_inflight_mb * 1_000_000,
+            batching=SlideBatching(max_slides=args.batch_slides) if args.batch_slides > 1 else None)
+        if description_list == []:
+            print(f"Description generation didn't finish. Resume with --run-id {run_id}")
+            return
+        long_description = description_list
     
-    summary, cost2, finished = iteratively_summarize(long_description)
+    summary, cost2, finished = summarize(
+        long_description, strategy=args.strategy, max_chunk_tokens=args.max_chunk_tokens,
+        merge_fanout=args.merge_fanout, run_id=run_id,
+        token_callback=(lambda delta, content: print(delta, end="", flush=True)) if args.stream else None)
+    if not finished:
+        print(f"Summary generation didn't finish. Resume with --run-id {run_id}")
+        return
+    delete_checkpoints(run_id)
     print(f"Final Summary:\n\n {summary}\n\nTotal cost: {(cost1 + cost2):.3f}")
     
     struct_summary, cost3 = structurize_summary(summary)
@@ -124,6 +559,16 @@ def main():
         print(f"{key}: {value}\n")
     
     print(f"Total cost: {(cost1 + cost2 + cost3):.3f}")
+
+    if not args.no_store:
+        deck_hash = file_sha256(pdf_path)
+        store = DeckStore(args.decks_db)
+        store.put(deck_hash, summary, struct_summary, None if args.text_only else description_list,
+                  name=os.path.basename(pdf_path), cost=cost1 + cost2 + cost3)
+        store.close()
+        print(f"Stored as {deck_hash[:12]} in {args.decks_db}")
+    if (rss := peak_rss()) is not None:
+        print(f"Peak RSS of this process: {rss / 1_000_000:.0f} MB (render workers not included)")
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
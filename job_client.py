@@ -0,0 +1,123 @@
+import os
+import time
+
+from urllib.parse import quote
+
+import httpx
+
+
+DEFAULT_SERVICE_URL = "http://127.0.0.1:8090"
+
+FINAL_STATUSES = ("done", "failed", "cancelled")
+
+UPLOAD_BLOCK_SIZE = 1 << 20
+
+
+def service_url(base_url=None):
+    """ URL of the job service: the argument, DECK_SERVICE_URL or the local default """
+    return (base_url or os.environ.get("DECK_SERVICE_URL") or DEFAULT_SERVICE_URL).rstrip("/")
+
+
+class JobClient:
+    """ Submits decks to job_service.py and polls their jobs; HTTP errors raise httpx.HTTPStatusError """
+
+    def __init__(self, base_url=None, timeout=30.0):
+        self.base_url = service_url(base_url)
+        self.http = httpx.Client(base_url=self.base_url, timeout=timeout)
+
+    def _json(self, response):
+        response.raise_for_status()
+        return response.json()
+
+    def healthy(self):
+        try:
+            return self._json(self.http.get("/health"))["ok"]
+        except httpx.HTTPError:
+            return False
+
+    def upload(self, data):
+        """
+        Uploads a PDF (stored once per distinct content), returns the deck hash. data is
+        the bytes or a binary file object, which is sent in blocks without reading it whole.
+        """
+        headers = {"Content-Type": "application/pdf"}
+        if not isinstance(data, bytes):
+            data.seek(0, os.SEEK_END)
+            headers["Content-Length"] = str(data.tell())
+            data.seek(0)
+            pdf_file = data
+            data = iter(lambda: pdf_file.read(UPLOAD_BLOCK_SIZE), b"")
+        return self._json(self.http.post("/uploads", content=data, headers=headers))["deck_hash"]
+
+    def submit(self, deck_hash, options=None, api_key=None, filename=None):
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        return self._json(self.http.post(
+            "/jobs", json={"deck_hash": deck_hash, "filename": filename, "options": options or {}}, headers=headers))
+
+    def job(self, job_id):
+        return self._json(self.http.get(f"/jobs/{job_id}"))
+
+    def find(self, job_id):
+        """ The job, or None if the service has no job with the id """
+        response = self.http.get(f"/jobs/{job_id}")
+        if response.status_code == 404:
+            return None
+        return self._json(response)
+
+    def jobs(self, deck_hash=None, limit=50):
+        params = {"limit": limit}
+        if deck_hash is not None:
+            params["deck_hash"] = deck_hash
+        return self._json(self.http.get("/jobs", params=params))["jobs"]
+
+    def result(self, job_id):
+        return self._json(self.http.get(f"/jobs/{job_id}/result"))
+
+    def deck(self, deck_hash):
+        """ The stored analysis of the deck, None if it was never analyzed """
+        response = self.http.get(f"/decks/{deck_hash}")
+        if response.status_code == 404:
+            return None
+        return self._json(response)
+
+    def decks(self, company=None, limit=50):
+        params = {"limit": limit}
+        if company is not None:
+            params["company"] = company
+        return self._json(self.http.get("/decks", params=params))["decks"]
+
+    def search(self, query, kind=None, limit=20):
+        params = {"q": query, "limit": limit}
+        if kind is not None:
+            params["kind"] = kind
+        return self._json(self.http.get("/search", params=params))["hits"]
+
+    def field(self, heading, value=None, limit=50):
+        params = {"limit": limit}
+        if value is not None:
+            params["value"] = value
+        return self._json(self.http.get(f"/fields/{quote(heading, safe='')}", params=params))["decks"]
+
+    def cancel(self, job_id):
+        return self._json(self.http.post(f"/jobs/{job_id}/cancel"))
+
+    def retry(self, job_id, api_key=None):
+        """ Resumes a failed or cancelled job; its key is dropped a day after it ended, so pass it again """
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        return self._json(self.http.post(f"/jobs/{job_id}/retry", headers=headers))
+
+    def wait(self, job_id, poll_interval=1.0, on_progress=None, timeout=None):
+        """ Polls until the job is done, failed or cancelled and returns it; on_progress(job) is called on every poll """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.job(job_id)
+            if on_progress is not None:
+                on_progress(job)
+            if job["status"] in FINAL_STATUSES:
+                return job
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Job {job_id} is still {job['status']}")
+            time.sleep(poll_interval)
+
+    def close(self):
+        self.http.close()
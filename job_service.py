@@ -0,0 +1,734 @@
+import os
+import re
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import hashlib
+import argparse
+import threading
+from dataclasses import dataclass, asdict, fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+from page_renderer import ImageBudget
+from pdf_text import iter_slide_texts
+from vision_analyzer import get_descriptions_async, SlideBatching
+from deck_versions import describe_version, slide_descriptions, summarize_version_async, evict_versions
+from gpt4_summarizer import summarize_async, set_verbosity, SUMMARY_STRATEGIES
+from response_parser import structurize_summary_async
+from prompt_templates.default_summary_template import default_summary_template
+from run_checkpoint import delete_checkpoints, evict_checkpoints
+from deck_store import DeckStore, DECK_STORE_PATH
+from openai_session import get_settings, close_async_client, forget_api_key
+from request_scheduler import key_id
+from render_pipeline import DEFAULT_MAX_INFLIGHT_BYTES
+from tracing import span, collect_spans, configure_tracing, peak_rss
+from disk_eviction import evict_files
+
+
+JOB_DB_PATH = os.path.join(".cache", "jobs.sqlite3")
+UPLOAD_FOLDER = os.path.join(".cache", "uploads")
+# Uploads are written to disk in blocks of this size, never held in memory whole
+UPLOAD_BLOCK_SIZE = 1 << 20
+DEFAULT_PORT = 8090
+# Most jobs, decks or search hits one GET returns, whatever ?limit= asks for
+MAX_LIST_LIMIT = 500
+# Streamed summary tokens are written to the job's progress at most this often (seconds)
+TOKEN_PROGRESS_INTERVAL = 0.5
+# Keys sent with a job are dropped once it is done, and this long after it failed or was cancelled
+API_KEY_RETENTION = 24 * 3600
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+FINAL_STATUSES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+DECK_HASH = re.compile(r"^[0-9a-f]{64}$")
+
+
+@dataclass
+class DiskLimits:
+    """
+    What the service keeps on disk. Uploads of queued and running jobs and the
+    checkpoints of their runs are never evicted.
+    """
+    max_upload_bytes: int = 200_000_000
+    uploads_max_bytes: int = 5_000_000_000
+    uploads_max_age: float = 7 * 24 * 3600
+    versions_max_bytes: int = 1_000_000_000
+    versions_max_age: float = 180 * 24 * 3600
+    # Checkpoints of failed and cancelled jobs, kept for a retry
+    checkpoints_max_age: float = 7 * 24 * 3600
+
+
+@dataclass
+class JobOptions:
+    use_vision: bool = False
+    triage: bool = True
+    use_cache: bool = True
+    use_versions: bool = False
+    # Slides per vision request, 1 sends every slide on its own
+    batch_slides: int = 1
+    strategy: str = "refine"
+    summary_template: str = None
+    structurize: bool = True
+    # Text budget of decks summarized without vision
+    max_pages: int = None
+    max_chars: int = None
+
+    @classmethod
+    def from_dict(cls, options):
+        known = {field.name for field in fields(cls)}
+        unknown = set(options) - known
+        if unknown:
+            raise ValueError(f"Unknown job options {sorted(unknown)}")
+        options = cls(**options)
+        if options.batch_slides < 1:
+            raise ValueError("batch_slides must be at least 1")
+        if options.strategy not in SUMMARY_STRATEGIES:
+            raise ValueError(f"Unknown summary strategy '{options.strategy}', expected one of {list(SUMMARY_STRATEGIES)}")
+        return options
+
+
+def store_upload(stream, length, folder=UPLOAD_FOLDER):
+    """
+    Spools `length` bytes of an uploaded PDF from the stream to disk block by block,
+    hashing as it goes, and keeps the file once per distinct content. Returns its hash,
+    or raises ValueError if the upload is not a PDF or ends early.
+    """
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = os.path.join(folder, f"upload.{uuid.uuid4().hex[:8]}.tmp")
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, "wb") as pdf_file:
+            remaining = length
+            while remaining > 0:
+                block = stream.read(min(UPLOAD_BLOCK_SIZE, remaining))
+                if not block:
+                    raise ValueError(f"Upload ended after {length - remaining} of {length} bytes")
+                if remaining == length and not block.startswith(b"%PDF"):
+                    raise ValueError("Upload is not a PDF file")
+                digest.update(block)
+                pdf_file.write(block)
+                remaining -= len(block)
+        if length == 0:
+            raise ValueError("Upload is not a PDF file")
+
+        deck_hash = digest.hexdigest()
+        path = upload_path(deck_hash, folder)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            # Uploads are evicted least recently modified first
+            os.utime(path)
+        else:
+            os.replace(tmp_path, path)
+        return deck_hash
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def upload_path(deck_hash, folder=UPLOAD_FOLDER):
+    return os.path.join(folder, f"{deck_hash}.pdf")
+
+
+def evict_disk(store, limits, upload_folder=UPLOAD_FOLDER):
+    """ Removes old uploads, deck versions and checkpoints past the limits, returns how many files """
+    active = store.active()
+    keep = {os.path.basename(upload_path(job["deck_hash"], upload_folder)) for job in active}
+    removed = evict_files(upload_folder, "*.pdf", max_bytes=limits.uploads_max_bytes, max_age=limits.uploads_max_age, keep=keep)
+    # Uploads cut off by a crash
+    removed += evict_files(upload_folder, "*.tmp", max_age=24 * 3600)
+    removed += evict_versions(limits.versions_max_bytes, limits.versions_max_age)
+    removed += evict_checkpoints(limits.checkpoints_max_age, keep_run_ids=[f"job-{job['id']}" for job in active])
+    return len(removed)
+
+
+class JobStore:
+    """
+    Durable SQLite queue of deck jobs. Jobs go queued -> running -> done / failed /
+    cancelled, and survive restarts of the service: jobs it left running are queued
+    again on the next start.
+    """
+
+    def __init__(self, path=JOB_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Shared by the HTTP handler threads and the worker loop, access is serialized by the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                deck_hash TEXT NOT NULL,
+                filename TEXT,
+                options TEXT NOT NULL,
+                api_key TEXT,
+                progress TEXT NOT NULL DEFAULT '{}',
+                result TEXT,
+                error TEXT,
+                cost REAL NOT NULL DEFAULT 0,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_deck_hash ON jobs (deck_hash, created)")
+        self._conn.commit()
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            cursor = self._conn.execute(sql, parameters)
+            rows = cursor.fetchall()
+            self._conn.commit()
+            return rows
+
+    def submit(self, deck_hash, options, api_key=None, filename=None):
+        job_id = uuid.uuid4().hex[:12]
+        self._execute(
+            "INSERT INTO jobs (id, status, deck_hash, filename, options, api_key, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, JOB_QUEUED, deck_hash, filename, json.dumps(asdict(options)), api_key, time.time()))
+        return job_id
+
+    def claim(self):
+        """ Marks the oldest queued job running and returns it with its options and API key, None if none is queued """
+        rows = self._execute("""
+            UPDATE jobs SET status = ?, started = ?, attempts = attempts + 1
+            WHERE id = (SELECT id FROM jobs WHERE status = ? ORDER BY created LIMIT 1) AND status = ?
+            RETURNING *""", (JOB_RUNNING, time.time(), JOB_QUEUED, JOB_QUEUED))
+        if not rows:
+            return None
+        job = self._to_dict(rows[0])
+        job["api_key"] = rows[0]["api_key"]
+        return job
+
+    def update_progress(self, job_id, progress):
+        self._execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id))
+
+    def add_cost(self, job_id, cost):
+        self._execute("UPDATE jobs SET cost = cost + ? WHERE id = ?", (cost, job_id))
+
+    def finish(self, job_id, status, result=None, error=None):
+        # Only a failed or cancelled job may need its key again, for a retry
+        self._execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?, cancel_requested = 0, "
+            "api_key = CASE WHEN ? = ? THEN NULL ELSE api_key END WHERE id = ?",
+            (status, json.dumps(result) if result is not None else None, error, time.time(), status, JOB_DONE, job_id))
+
+    def forget_api_keys(self, max_age=API_KEY_RETENTION):
+        """ Drops the keys of jobs that ended more than max_age seconds ago, returns how many """
+        return len(self._execute(
+            "UPDATE jobs SET api_key = NULL WHERE api_key IS NOT NULL AND status IN (?, ?, ?) AND finished < ? RETURNING id",
+            (JOB_DONE, JOB_FAILED, JOB_CANCELLED, time.time() - max_age)))
+
+    def has_api_key(self, job_id):
+        rows = self._execute("SELECT api_key IS NOT NULL AS has_key FROM jobs WHERE id = ?", (job_id,))
+        return bool(rows and rows[0]["has_key"])
+
+    def cancel(self, job_id):
+        """ Queued jobs are cancelled right away, running ones by their worker; returns the job """
+        self._execute("UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?",
+                      (JOB_CANCELLED, time.time(), job_id, JOB_QUEUED))
+        self._execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?", (job_id, JOB_RUNNING))
+        return self.get(job_id)
+
+    def cancel_requested(self):
+        return {row["id"] for row in self._execute(
+            "SELECT id FROM jobs WHERE status = ? AND cancel_requested = 1", (JOB_RUNNING,))}
+
+    def retry(self, job_id, api_key=None):
+        """ Queues a failed or cancelled job again, with a new key if given; it resumes from its checkpoints """
+        self._execute(
+            "UPDATE jobs SET status = ?, error = NULL, finished = NULL, created = ?, api_key = COALESCE(?, api_key) "
+            "WHERE id = ? AND status IN (?, ?)",
+            (JOB_QUEUED, time.time(), api_key, job_id, JOB_FAILED, JOB_CANCELLED))
+        return self.get(job_id)
+
+    def active(self):
+        """ Queued and running jobs """
+        rows = self._execute("SELECT * FROM jobs WHERE status IN (?, ?)", (JOB_QUEUED, JOB_RUNNING))
+        return [self._to_dict(row) for row in rows]
+
+    def requeue_running(self):
+        """ Jobs left running by a stopped service go back to the queue, returns how many """
+        return len(self._execute("UPDATE jobs SET status = ? WHERE status = ? RETURNING id", (JOB_QUEUED, JOB_RUNNING)))
+
+    def get(self, job_id):
+        rows = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return self._to_dict(rows[0]) if rows else None
+
+    def result(self, job_id):
+        rows = self._execute("SELECT result FROM jobs WHERE id = ?", (job_id,))
+        return json.loads(rows[0]["result"]) if rows and rows[0]["result"] else None
+
+    def list(self, deck_hash=None, limit=50):
+        if deck_hash is None:
+            rows = self._execute("SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,))
+        else:
+            rows = self._execute("SELECT * FROM jobs WHERE deck_hash = ? ORDER BY created DESC LIMIT ?", (deck_hash, limit))
+        return [self._to_dict(row) for row in rows]
+
+    @staticmethod
+    def _to_dict(row):
+        # The API key and the (possibly large) result are never part of the status
+        return {
+            "id": row["id"],
+            "status": row["status"],
+            "deck_hash": row["deck_hash"],
+            "filename": row["filename"],
+            "options": json.loads(row["options"]),
+            "progress": json.loads(row["progress"]),
+            "error": row["error"],
+            "cost": row["cost"],
+            "attempts": row["attempts"],
+            "created": row["created"],
+            "started": row["started"],
+            "finished": row["finished"],
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+async def run_job(store, job, upload_folder=UPLOAD_FOLDER, max_inflight_bytes=DEFAULT_MAX_INFLIGHT_BYTES):
+    """ Runs the whole pipeline for one job, returns its result dict """
+    job_id = job["id"]
+    options = JobOptions.from_dict(job["options"])
+    summary_template = options.summary_template or default_summary_template()
+    api_key = job["api_key"]
+    pdf_path = upload_path(job["deck_hash"], upload_folder)
+    # A retried or requeued job resumes from the checkpoints of its earlier attempts
+    run_id = f"job-{job_id}"
+
+    def progress(stage, step=0, steps=0, summary=None, partial=None):
+        store.update_progress(job_id, {"stage": stage, "step": step, "steps": steps, "summary": summary, "partial": partial})
+
+    def cost_of(cost):
+        store.add_cost(job_id, cost)
+        return cost
+
+    result = {"summary": "", "structured": {}, "cost": 0.0}
+    batching = SlideBatching(max_slides=options.batch_slides) if options.batch_slides > 1 else None
+    version_plan = None
+
+    if options.use_vision:
+        # Same rendering settings as the app used to run itself
+        zoom_factor, image_format, quality = 1.0, "auto", 80
+        budget = ImageBudget(quality=quality)
+        progress("describe")
+        if options.use_versions:
+            version_plan = await describe_version(
+                pdf_path, zoom_factor=zoom_factor, image_format=image_format, quality=quality, budget=budget,
+                api_key=api_key, use_cache=options.use_cache, run_id=run_id, max_inflight_bytes=max_inflight_bytes, batching=batching,
+                page_callback=lambda done, total: progress("describe", done, total))
+            descriptions = slide_descriptions(version_plan) if version_plan is not None else []
+            result["cost"] += cost_of(version_plan["cost"] if version_plan is not None else 0.0)
+        else:
+            descriptions, cost = await get_descriptions_async(
+                pdf_path, zoom_factor=zoom_factor, image_format=image_format, quality=quality, api_key=api_key,
+                use_cache=options.use_cache, run_id=run_id, triage=options.triage, budget=budget,
+                max_inflight_bytes=max_inflight_bytes, batching=batching,
+                page_callback=lambda done, total: progress("describe", done, total))
+            result["cost"] += cost_of(cost)
+        if descriptions == []:
+            raise RuntimeError("Description generation with vision didn't finish")
+        text = descriptions
+        result["descriptions"] = descriptions
+    else:
+        progress("extract")
+        # Read page by page while the chunker packs them, in a worker thread of the summary
+        text = iter_slide_texts(pdf_path, max_pages=options.max_pages, max_chars=options.max_chars)
+
+    # The summary of the step being generated goes to the progress as it streams in
+    summary_progress = {"step": 0, "steps": 0, "summary": None, "written": 0.0}
+
+    def show_step(step, total_steps, step_summary):
+        summary_progress.update(step=step, steps=total_steps, summary=step_summary)
+        progress("summarize", step, total_steps, step_summary)
+
+    def show_tokens(delta, content):
+        if time.monotonic() - summary_progress["written"] < TOKEN_PROGRESS_INTERVAL:
+            return
+        summary_progress["written"] = time.monotonic()
+        progress("summarize", summary_progress["step"], summary_progress["steps"], summary_progress["summary"], partial=content)
+
+    progress("summarize")
+    # A new version of an analyzed deck only needs its changed slides summarized
+    if version_plan is not None:
+        summary, cost, finished = await summarize_version_async(
+            version_plan, summary_template=summary_template, api_key=api_key, run_id=run_id,
+            strategy=options.strategy, iter_callback=show_step, token_callback=show_tokens)
+    else:
+        summary, cost, finished = await summarize_async(
+            text, strategy=options.strategy, summary_template=summary_template, api_key=api_key,
+            run_id=run_id, iter_callback=show_step, token_callback=show_tokens)
+    result["cost"] += cost_of(cost)
+    if not finished:
+        raise RuntimeError("Summary generation didn't finish")
+    result["summary"] = summary
+
+    if options.structurize:
+        progress("structurize")
+        structured, cost = await structurize_summary_async(summary, api_key=api_key, summary_template=summary_template)
+        result["structured"] = structured
+        result["cost"] += cost_of(cost)
+
+    progress("done")
+    delete_checkpoints(run_id)
+    return result
+
+
+class JobWorkers:
+    """
+    Runs up to `workers` jobs at a time on one event loop, in a background thread.
+    Rendering goes to the render process pool and the API calls of all jobs share the
+    key's rate limits, so more workers mostly means more decks waiting on the API.
+    Rendered pages take at most max_inflight_bytes per running job. Finished
+    analyses go to the deck store.
+    """
+
+    def __init__(self, store, decks, workers=4, poll_interval=0.5, upload_folder=UPLOAD_FOLDER, max_inflight_bytes=DEFAULT_MAX_INFLIGHT_BYTES, disk_limits=None):
+        self.store = store
+        self.decks = decks
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.upload_folder = upload_folder
+        self.max_inflight_bytes = max_inflight_bytes
+        self.disk_limits = disk_limits or DiskLimits()
+        self.running = {}
+        # key_id of the API key each running job brought along
+        self.job_keys = {}
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        requeued = self.store.requeue_running()
+        if requeued:
+            print(f"Requeued {requeued} jobs interrupted by an earlier shutdown")
+        self._thread = threading.Thread(target=asyncio.run, args=(self._loop(),), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    async def _loop(self):
+        keys_checked = 0.0
+        try:
+            while not self._stopping.is_set():
+                if time.monotonic() - keys_checked > 60:
+                    self.store.forget_api_keys()
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, evict_disk, self.store, self.disk_limits, self.upload_folder)
+                    keys_checked = time.monotonic()
+
+                while len(self.running) < self.workers:
+                    job = self.store.claim()
+                    if job is None:
+                        break
+                    self.running[job["id"]] = asyncio.create_task(self._run(job))
+
+                for job_id in self.store.cancel_requested() & set(self.running):
+                    self.running[job_id].cancel()
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            # Interrupted jobs stay running in the store and are requeued on the next start
+            for task in self.running.values():
+                task.cancel()
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+            await close_async_client()
+
+    async def _run(self, job):
+        job_id = job["id"]
+        print(f"Job {job_id} started ({job['deck_hash'][:12]})")
+        if job["api_key"]:
+            self.job_keys[job_id] = key_id(job["api_key"])
+        try:
+            with collect_spans() as trace, span("job", job_id=job_id, deck_hash=job["deck_hash"]) as job_span:
+                result = await run_job(self.store, job, self.upload_folder, self.max_inflight_bytes)
+            result["trace"] = trace
+            self.decks.put(job["deck_hash"], result["summary"], result["structured"], result.get("descriptions"),
+                           name=job["filename"], cost=result["cost"], options=job["options"])
+            self.store.finish(job_id, JOB_DONE, result=result)
+            print(f"Job {job_id} done ({result['cost']:.3f}$)")
+        except asyncio.CancelledError:
+            if not self._stopping.is_set():
+                self.store.finish(job_id, JOB_CANCELLED, error="Cancelled")
+                print(f"Job {job_id} cancelled")
+        except Exception as e:
+            self.store.finish(job_id, JOB_FAILED, error=f"{type(e).__name__}: {e}")
+            print(f"Job {job_id} failed: {e}")
+        finally:
+            self.running.pop(job_id, None)
+            # The clients and rate limits of a user's key stay cached only while a job uses the key
+            if self.job_keys.pop(job_id, None) is not None and key_id(job["api_key"]) not in self.job_keys.values():
+                forget_api_key(job["api_key"])
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in two writes, Nagle would hold the body back for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status, message):
+        self._send_json(status, {"error": message})
+
+    def _content_length(self):
+        return int(self.headers.get("Content-Length", 0))
+
+    def _read_body(self):
+        return self.rfile.read(self._content_length())
+
+    def _api_key(self):
+        authorization = self.headers.get("Authorization", "")
+        return authorization[len("Bearer "):] if authorization.startswith("Bearer ") else None
+
+    def _job_route(self, path):
+        # /jobs/<id> and /jobs/<id>/<action>
+        parts = path.strip("/").split("/")
+        if len(parts) in (2, 3) and parts[0] == "jobs":
+            return parts[1], parts[2] if len(parts) == 3 else None
+        return None, None
+
+    def do_GET(self):
+        store = self.server.store
+        decks = self.server.decks
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        query = parse_qs(url.query)
+        try:
+            limit = int(query.get("limit", ["50"])[0])
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            self._send_error(400, "limit must be a positive integer")
+            return
+        limit = min(limit, MAX_LIST_LIMIT)
+
+        if path == "/health":
+            # Of the service process since it started, it isn't broken down by job
+            self._send_json(200, {"ok": True, "running": len(self.server.workers.running), "peak_rss": peak_rss()})
+            return
+        if path == "/jobs":
+            deck_hash = query.get("deck_hash", [None])[0]
+            self._send_json(200, {"jobs": store.list(deck_hash, limit)})
+            return
+        if path == "/decks":
+            self._send_json(200, {"decks": decks.list(query.get("company", [None])[0], limit)})
+            return
+        if path.startswith("/decks/"):
+            deck = decks.get(path[len("/decks/"):])
+            if deck is None:
+                self._send_error(404, f"No analyzed deck {path[len('/decks/'):]}")
+            else:
+                self._send_json(200, deck)
+            return
+        if path == "/search":
+            text = query.get("q", [""])[0]
+            kind = query.get("kind", [None])[0]
+            self._send_json(200, {"hits": decks.search(text, kind=kind, limit=limit)})
+            return
+        if path.startswith("/fields/"):
+            heading = unquote(path[len("/fields/"):])
+            self._send_json(200, {"decks": decks.field(heading, query.get("value", [None])[0], limit)})
+            return
+
+        job_id, action = self._job_route(path)
+        job = store.get(job_id) if job_id else None
+        if job is None:
+            self._send_error(404, f"Unknown path {self.path}" if job_id is None else f"No job {job_id}")
+        elif action is None:
+            self._send_json(200, job)
+        elif action == "result":
+            if job["status"] != JOB_DONE:
+                self._send_error(409, f"Job {job_id} is {job['status']}")
+            else:
+                self._send_json(200, store.result(job_id))
+        else:
+            self._send_error(404, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        store = self.server.store
+        path = urlparse(self.path).path.rstrip("/")
+
+        if path == "/uploads":
+            if self._content_length() > self.server.workers.disk_limits.max_upload_bytes:
+                self.close_connection = True
+                self._send_error(413, f"Upload is larger than {self.server.workers.disk_limits.max_upload_bytes // 1_000_000} MB")
+                return
+            try:
+                deck_hash = store_upload(self.rfile, self._content_length(), self.server.upload_folder)
+            except ValueError as e:
+                # The rest of the body wasn't read, so the connection can't be reused
+                self.close_connection = True
+                self._send_error(400, str(e))
+                return
+            self._send_json(201, {"deck_hash": deck_hash})
+            return
+
+        body = self._read_body()
+
+        if path == "/jobs":
+            try:
+                request = json.loads(body or b"{}")
+                deck_hash = request.get("deck_hash", "")
+                options = JobOptions.from_dict(request.get("options", {}))
+            except (ValueError, TypeError) as e:
+                self._send_error(400, str(e))
+                return
+            if not DECK_HASH.match(deck_hash) or not os.path.exists(upload_path(deck_hash, self.server.upload_folder)):
+                self._send_error(404, f"No uploaded deck {deck_hash}, POST it to /uploads first")
+                return
+            os.utime(upload_path(deck_hash, self.server.upload_folder))
+
+            # Without a key of its own the job uses the service's key
+            api_key = self._api_key()
+            if not (api_key or get_settings().api_key):
+                self._send_error(401, "No API key given and the service has none configured")
+                return
+
+            job_id = store.submit(deck_hash, options, api_key=api_key, filename=request.get("filename"))
+            self._send_json(201, store.get(job_id))
+            return
+
+        job_id, action = self._job_route(path)
+        job = store.get(job_id) if job_id else None
+        if job is None:
+            self._send_error(404, f"Unknown path {self.path}" if job_id is None else f"No job {job_id}")
+        elif action == "cancel":
+            self._send_json(200, store.cancel(job_id))
+        elif action == "retry":
+            api_key = self._api_key()
+            if job["status"] not in (JOB_FAILED, JOB_CANCELLED):
+                self._send_error(409, f"Job {job_id} is {job['status']}, only failed or cancelled jobs can be retried")
+            elif not (api_key or store.has_api_key(job_id) or get_settings().api_key):
+                self._send_error(401, f"The key of job {job_id} was dropped, send it again to retry")
+            elif not os.path.exists(upload_path(job["deck_hash"], self.server.upload_folder)):
+                self._send_error(404, f"The upload of job {job_id} was evicted, POST it to /uploads again to retry")
+            else:
+                self._send_json(200, store.retry(job_id, api_key))
+        else:
+            self._send_error(404, f"Unknown path {self.path}")
+
+
+class JobService:
+    """
+    Local HTTP service running deck jobs in the background, so a closed browser tab
+    or a Streamlit rerun never loses work:
+
+        POST /uploads               PDF bytes, spooled to disk -> {"deck_hash"} (413 past max_upload_bytes)
+        POST /jobs                  {"deck_hash", "filename", "options"} -> job
+        GET  /jobs[?deck_hash=]     recent jobs
+        GET  /jobs/<id>             status, progress and cost
+        GET  /jobs/<id>/result      summary, structured summary, descriptions and trace
+        POST /jobs/<id>/cancel
+        POST /jobs/<id>/retry       resumes a failed or cancelled job from its checkpoints (optionally with a key again)
+        GET  /decks[?company=]      analyzed decks, by the start of the company name
+        GET  /decks/<deck_hash>     stored memo, structured summary and descriptions of a deck
+        GET  /search?q=[&kind=]     full-text search over memos, slides and heading values
+        GET  /fields/<heading>[?value=]  decks by the value of one template heading
+    """
+
+    def __init__(self, store=None, workers=4, host="127.0.0.1", port=DEFAULT_PORT, upload_folder=UPLOAD_FOLDER,
+                 max_inflight_bytes=DEFAULT_MAX_INFLIGHT_BYTES, decks=None, disk_limits=None):
+        self.store = store or JobStore()
+        self.decks = decks or DeckStore()
+        self.workers = JobWorkers(self.store, self.decks, workers, upload_folder=upload_folder, max_inflight_bytes=max_inflight_bytes,
+                                  disk_limits=disk_limits)
+
+        self.httpd = ThreadingHTTPServer((host, port), JobHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.store = self.store
+        self.httpd.decks = self.decks
+        self.httpd.workers = self.workers
+        self.httpd.upload_folder = upload_folder
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """ Serves in a background thread """
+        self.workers.start()
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.workers.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local HTTP service that queues Pitch Deck jobs and runs them with a worker pool.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Jobs run concurrently")
+    parser.add_argument("--db", default=JOB_DB_PATH, help="SQLite file of the job queue")
+    parser.add_argument("--decks-db", default=DECK_STORE_PATH, help="SQLite file of the analyzed deck store")
+    parser.add_argument("--max-inflight-mb", type=int, default=DEFAULT_MAX_INFLIGHT_BYTES // 1_000_000, help="Memory ceiling for rendered pages per running job, in MB")
+    parser.add_argument("--max-upload-mb", type=int, default=DiskLimits.max_upload_bytes // 1_000_000, help="Largest PDF accepted, in MB")
+    parser.add_argument("--max-uploads-gb", type=float, default=DiskLimits.uploads_max_bytes / 1e9, help="Disk space for uploaded decks, the least recently used are evicted past it, in GB")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Increase output verbosity")
+    parser.add_argument("--trace", metavar="FILE", default=None, help="Append a JSON lines trace of every rendering, API and parsing step to FILE")
+    parser.add_argument("--base-url", default=None, help="OpenAI-compatible API to send requests to, e.g. a local mock server (default: OPENAI_BASE_URL or api.openai.com)")
+    args = parser.parse_args()
+
+    set_verbosity(args.verbose)
+    if args.base_url:
+        os.environ["OPENAI_BASE_URL"] = args.base_url
+    if args.trace:
+        configure_tracing(args.trace)
+
+    service = JobService(JobStore(args.db), workers=args.workers, host=args.host, port=args.port,
+                         max_inflight_bytes=args.max_inflight_mb * 1_000_000, decks=DeckStore(args.decks_db),
+                         disk_limits=DiskLimits(max_upload_bytes=args.max_upload_mb * 1_000_000, uploads_max_bytes=int(args.max_uploads_gb * 1e9)))
+    service.workers.start()
+    print(f"Deck job service listening on {service.url} with {args.workers} workers")
+    try:
+        service.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.httpd.server_close()
+        service.workers.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,496 @@
+import re
+import json
+import time
+import math
+import random
+import base64
+import argparse
+import threading
+import collections
+import email.parser
+import email.policy
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from page_renderer import estimate_image_tokens
+from text_chunker import estimate_tokens
+
+
+FILLER = ("the company builds a scalable platform for enterprise customers with recurring revenue "
+          "strong team early traction growing market clear differentiation pilot customers seed round").split()
+
+# Lines like "Problem:" in a prompt are echoed back as headings, so summaries look like memos
+PROMPT_HEADING = re.compile(r"^([A-Z][^\n:()]{0,59}):", re.MULTILINE)
+# Labels of the pages in a batched vision request
+SLIDE_LABEL = re.compile(r"^Slide (\d+):$", re.MULTILINE)
+
+
+@dataclass
+class MockSettings:
+    # Time to the first token, e.g. "fixed:0.5", "uniform:0.2,1.5", "normal:1,0.3", "lognormal:0.8,0.5", "exponential:1"
+    latency: str = "lognormal:0.8,0.4"
+    # Generation time per completion token on top of the latency
+    token_latency: float = 0.005
+    # Share of requests answered with an injected 429 / 5xx
+    error_429_rate: float = 0.0
+    error_5xx_rate: float = 0.0
+    # Limits enforced over a sliding minute like the real API; 0 disables a limit
+    requests_per_minute: int = 0
+    tokens_per_minute: int = 0
+    # Average completion length when the request's max_tokens allows it
+    completion_tokens: int = 200
+    # Seconds a submitted batch takes before its output file is ready
+    batch_delay: float = 1.0
+    seed: int = None
+
+
+def latency_sampler(spec):
+    """ Callable drawing one latency in seconds from a "kind:param,param" spec """
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",") if value]
+
+    samplers = {
+        "fixed": lambda rng: values[0],
+        "uniform": lambda rng: rng.uniform(values[0], values[1]),
+        "normal": lambda rng: rng.normalvariate(values[0], values[1]),
+        # Parameterized by the median, which is easier to reason about than mu
+        "lognormal": lambda rng: rng.lognormvariate(math.log(values[0]), values[1]),
+        "exponential": lambda rng: rng.expovariate(1 / values[0]),
+    }
+    if kind not in samplers:
+        raise ValueError(f"Unknown latency distribution '{kind}', expected one of {list(samplers)}")
+    return lambda rng: max(0.0, samplers[kind](rng))
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile, None for no values """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+class SlidingWindow:
+    """ Amounts used during the last minute """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = collections.deque()
+        self.total = 0
+
+    def admit(self, amount, now):
+        """ Records amount if it fits the limit and returns None, otherwise the seconds until it would """
+        while self.used and self.used[0][0] <= now - 60:
+            self.total -= self.used.popleft()[1]
+        if not self.limit:
+            return None
+        if self.total + amount > self.limit and self.used:
+            return self.used[0][0] + 60 - now
+        self.used.append((now, amount))
+        self.total += amount
+        return None
+
+
+def prompt_tokens(messages):
+    """ Prompt tokens of a chat request: the text plus what the images would be billed """
+    tokens = 0
+    for message in messages:
+        content = message.get("content") or ""
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        for part in parts:
+            if part.get("type") == "image_url":
+                image_url = part["image_url"]
+                url = image_url["url"] if isinstance(image_url, dict) else image_url
+                detail = image_url.get("detail", "auto") if isinstance(image_url, dict) else "auto"
+                if detail == "low" or not url.startswith("data:"):
+                    tokens += 85
+                else:
+                    tokens += estimate_image_tokens(base64.b64decode(url.split(",", 1)[1]))
+            else:
+                tokens += estimate_tokens(part.get("text", ""))
+        tokens += 4
+    return tokens
+
+
+def prompt_text(messages):
+    texts = []
+    for message in messages:
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts.extend(part.get("text", "") for part in content if part.get("type") == "text")
+    return "\n".join(texts)
+
+
+def mock_content(text, n_tokens, rng):
+    """
+    Filler text of roughly n_tokens, laid out under the headings found in the prompt.
+    Prompts asking for a JSON object get a small section patch instead, batched vision
+    requests a description per labelled page.
+    """
+    n_words = max(1, int(n_tokens * 0.75))
+    slides = SLIDE_LABEL.findall(text)
+
+    if '"slides"' in text and slides:
+        # As long as a single page's description each, like a real batched answer
+        return json.dumps({"slides": [{"slide": int(slide), "description": " ".join(rng.choice(FILLER) for _ in range(n_words))}
+                                      for slide in slides]})
+    headings = list(dict.fromkeys(PROMPT_HEADING.findall(text)))[:30]
+
+    if "JSON object" in text and headings:
+        changed = rng.sample(headings, min(len(headings), rng.randint(0, 3)))
+        return json.dumps({heading: ["- " + " ".join(rng.choice(FILLER) for _ in range(8))] for heading in changed})
+
+    if not headings:
+        return " ".join(rng.choice(FILLER) for _ in range(n_words))
+
+    words_per_heading = max(1, n_words // len(headings))
+    return "\n\n".join(
+        f"{heading}:\n" + " ".join(rng.choice(FILLER) for _ in range(words_per_heading)) for heading in headings)
+
+
+def chat_completion(completion_id, created, model, content, usage):
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": usage,
+    }
+
+
+def parse_multipart(content_type, body):
+    """ {field name: (filename, bytes)} of a multipart/form-data body """
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    return {part.get_param("name", header="content-disposition"): (part.get_filename(), part.get_payload(decode=True))
+            for part in message.iter_parts()}
+
+
+class UsageStats:
+    """ Thread-safe request, status and token counters with per-request latencies """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.statuses = collections.Counter()
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.latencies = []
+
+    def record(self, status, latency, prompt=0, completion=0):
+        with self.lock:
+            self.requests += 1
+            self.statuses[status] += 1
+            self.prompt_tokens += prompt
+            self.completion_tokens += completion
+            if status == 200:
+                self.latencies.append(latency)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "statuses": {str(status): count for status, count in sorted(self.statuses.items())},
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "latency_p50": percentile(self.latencies, 50),
+                "latency_p95": percentile(self.latencies, 95),
+            }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status, message, error_type, headers=None):
+        self._send_json(status, {"error": {"message": message, "type": error_type, "code": None}}, headers)
+
+    def do_GET(self):
+        mock = self.server.mock
+        path = self.path.rstrip("/")
+        parts = path.split("/")
+        if path in ("/v1/stats", "/stats"):
+            self._send_json(200, mock.stats.snapshot())
+        elif path.startswith("/v1/batches/") and parts[3] in mock.batches:
+            self._send_json(200, mock.batches[parts[3]])
+        elif path.startswith("/v1/files/") and path.endswith("/content") and parts[3] in mock.files:
+            data = mock.files[parts[3]]["data"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._send_error(404, f"Unknown path {self.path}", "invalid_request_error")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        path = self.path.rstrip("/")
+
+        if path in ("/v1/stats/reset", "/stats/reset"):
+            self.server.mock.stats.reset()
+            self._send_json(200, {"reset": True})
+        elif path in ("/v1/chat/completions", "/chat/completions"):
+            try:
+                self.server.mock.complete(self, json.loads(body or b"{}"))
+            except (BrokenPipeError, ConnectionResetError):
+                # The client cancelled the request, e.g. a timed out stream
+                self.close_connection = True
+        elif path == "/v1/files":
+            fields = parse_multipart(self.headers.get("Content-Type", ""), body)
+            if "file" not in fields:
+                self._send_error(400, "Missing file", "invalid_request_error")
+                return
+            filename, data = fields["file"]
+            purpose = fields.get("purpose", (None, b"batch"))[1].decode()
+            self._send_json(200, self.server.mock.add_file(filename, purpose, data)["object"])
+        elif path == "/v1/batches":
+            request = json.loads(body or b"{}")
+            if request.get("input_file_id") not in self.server.mock.files:
+                self._send_error(400, f"No file {request.get('input_file_id')}", "invalid_request_error")
+                return
+            self._send_json(200, self.server.mock.create_batch(request))
+        else:
+            self._send_error(404, f"Unknown path {self.path}", "invalid_request_error")
+
+
+class MockOpenAIServer:
+    """
+    Local stand-in for the chat completions endpoint, for load testing without
+    API costs. Point the pipeline at it with OPENAI_BASE_URL=<url> or --base-url.
+    It also fakes the Batch API (files, batches and their output files), finishing
+    every batch after batch_delay seconds; injected 5xx errors become failed lines.
+    """
+
+    def __init__(self, settings=None, host="127.0.0.1", port=0):
+        self.settings = settings or MockSettings()
+        self.latency = latency_sampler(self.settings.latency)
+        self.stats = UsageStats()
+        self.rng = random.Random(self.settings.seed)
+        self.requests_window = SlidingWindow(self.settings.requests_per_minute)
+        self.tokens_window = SlidingWindow(self.settings.tokens_per_minute)
+        self.lock = threading.Lock()
+        self.ids = iter(range(1, 1 << 62))
+        self.files = {}
+        self.batches = {}
+
+        self.httpd = ThreadingHTTPServer((host, port), MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """ Serves in a background thread """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def add_file(self, filename, purpose, data):
+        with self.lock:
+            file_id = f"file-mock-{next(self.ids)}"
+        self.files[file_id] = {"data": data, "object": {
+            "id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed"}}
+        return self.files[file_id]
+
+    def create_batch(self, request):
+        with self.lock:
+            batch_id = f"batch_mock{next(self.ids)}"
+        self.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": request.get("endpoint", "/v1/chat/completions"),
+            "input_file_id": request["input_file_id"], "completion_window": request.get("completion_window", "24h"),
+            "status": "in_progress", "created_at": int(time.time()), "output_file_id": None, "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0}, "metadata": request.get("metadata"),
+        }
+        threading.Thread(target=self._run_batch, args=(batch_id,), daemon=True).start()
+        return self.batches[batch_id]
+
+    def _run_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        lines = [json.loads(line) for line in self.files[batch["input_file_id"]]["data"].splitlines() if line.strip()]
+        time.sleep(self.settings.batch_delay)
+
+        output, errors = [], []
+        for line in lines:
+            request = line["body"]
+            messages = request.get("messages", [])
+            with self.lock:
+                failed = self.rng.random() < self.settings.error_5xx_rate
+                n_completion = min(request.get("max_tokens") or 4096,
+                                   max(1, int(self.settings.completion_tokens * self.rng.uniform(0.5, 1.5))))
+                content = mock_content(prompt_text(messages), n_completion, self.rng)
+                completion_id = f"chatcmpl-mock-{next(self.ids)}"
+            result = {"id": f"batch_req_{completion_id}", "custom_id": line["custom_id"]}
+            if failed:
+                self.stats.record(500, 0.0)
+                errors.append(dict(result, response={"status_code": 500, "request_id": completion_id, "body": {
+                    "error": {"message": "The server had an error (mock)", "type": "server_error"}}}, error=None))
+                continue
+            n_prompt, n_completion = prompt_tokens(messages), max(1, estimate_tokens(content))
+            self.stats.record(200, 0.0, n_prompt, n_completion)
+            usage = {"prompt_tokens": n_prompt, "completion_tokens": n_completion, "total_tokens": n_prompt + n_completion}
+            output.append(dict(result, response={"status_code": 200, "request_id": completion_id, "body": chat_completion(
+                completion_id, int(time.time()), request.get("model", "mock"), content, usage)}, error=None))
+
+        def write(name, records):
+            if not records:
+                return None
+            data = "".join(json.dumps(record) + "\n" for record in records).encode()
+            return self.add_file(name, "batch_output", data)["object"]["id"]
+
+        batch.update(
+            output_file_id=write(f"{batch_id}_output.jsonl", output), error_file_id=write(f"{batch_id}_error.jsonl", errors),
+            request_counts={"total": len(lines), "completed": len(output), "failed": len(errors)},
+            status="completed", completed_at=int(time.time()))
+
+    def _limit(self, tokens):
+        # Like the real API, a request over either limit is rejected without counting
+        with self.lock:
+            now = time.monotonic()
+            retry_after = self.requests_window.admit(1, now)
+            if retry_after is None:
+                retry_after = self.tokens_window.admit(tokens, now)
+                if retry_after is not None:
+                    self.requests_window.used.pop()
+                    self.requests_window.total -= 1
+            return retry_after
+
+    def complete(self, handler, request):
+        started = time.monotonic()
+        messages = request.get("messages", [])
+        n_prompt = prompt_tokens(messages)
+        max_tokens = request.get("max_tokens") or 4096
+
+        with self.lock:
+            roll = self.rng.random()
+            latency = self.latency(self.rng)
+            n_completion = min(max_tokens, max(1, int(self.settings.completion_tokens * self.rng.uniform(0.5, 1.5))))
+            content = mock_content(prompt_text(messages), n_completion, self.rng)
+            # Usage and generation time follow what was actually generated
+            n_completion = max(1, estimate_tokens(content))
+            completion_id = f"chatcmpl-mock-{next(self.ids)}"
+
+        # Like the real API, max_tokens counts towards the token limit when it is set
+        retry_after = self._limit(n_prompt + (request.get("max_tokens") or n_completion))
+        if retry_after is not None or roll < self.settings.error_429_rate:
+            retry_after = retry_after or 1.0
+            self.stats.record(429, time.monotonic() - started)
+            handler._send_error(429, "Rate limit reached (mock)", "rate_limit_exceeded", {
+                "retry-after": str(math.ceil(retry_after)),
+                "retry-after-ms": str(int(retry_after * 1000)),
+            })
+            return
+
+        if roll < self.settings.error_429_rate + self.settings.error_5xx_rate:
+            status = self.rng.choice([500, 502, 503])
+            time.sleep(latency / 2)
+            self.stats.record(status, time.monotonic() - started)
+            handler._send_error(status, "The server had an error (mock)", "server_error")
+            return
+
+        created = int(time.time())
+        model = request.get("model", "mock")
+        usage = {"prompt_tokens": n_prompt, "completion_tokens": n_completion,
+                 "total_tokens": n_prompt + n_completion}
+
+        if request.get("stream"):
+            self._stream(handler, completion_id, created, model, content, latency, n_completion)
+        else:
+            time.sleep(latency + n_completion * self.settings.token_latency)
+            handler._send_json(200, chat_completion(completion_id, created, model, content, usage))
+
+        self.stats.record(200, time.monotonic() - started, n_prompt, n_completion)
+
+    def _stream(self, handler, completion_id, created, model, content, latency, n_completion):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Cache-Control", "no-cache")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        handler.close_connection = True
+
+        def event(delta, finish_reason=None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            handler.wfile.flush()
+
+        time.sleep(latency)
+        words = content.split(" ")
+        delay = n_completion * self.settings.token_latency / len(words)
+        event({"role": "assistant", "content": ""})
+        for i, word in enumerate(words):
+            event({"content": word if i == 0 else " " + word})
+            time.sleep(delay)
+        event({}, "stop")
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible chat completions server for load testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--latency", default=MockSettings.latency, help="Latency distribution in seconds, e.g. fixed:0.5, uniform:0.2,1.5, lognormal:0.8,0.4")
+    parser.add_argument("--token-latency", type=float, default=MockSettings.token_latency, help="Seconds per generated token")
+    parser.add_argument("--error-429", type=float, default=0.0, help="Share of requests answered with an injected 429")
+    parser.add_argument("--error-5xx", type=float, default=0.0, help="Share of requests answered with an injected 5xx")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests per minute before 429s (0: unlimited)")
+    parser.add_argument("--tpm", type=int, default=0, help="Tokens per minute before 429s (0: unlimited)")
+    parser.add_argument("--completion-tokens", type=int, default=MockSettings.completion_tokens, help="Average completion length in tokens")
+    parser.add_argument("--batch-delay", type=float, default=MockSettings.batch_delay, help="Seconds until a submitted batch is completed")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(MockSettings(
+        latency=args.latency, token_latency=args.token_latency, error_429_rate=args.error_429, error_5xx_rate=args.error_5xx,
+        requests_per_minute=args.rpm, tokens_per_minute=args.tpm, completion_tokens=args.completion_tokens,
+        batch_delay=args.batch_delay, seed=args.seed),
+        host=args.host, port=args.port)
+
+    print(f"Mock OpenAI API listening on {server.url} (usage at {server.url}/stats)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
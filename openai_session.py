@@ -0,0 +1,178 @@
+import os
+import asyncio
+import weakref
+import threading
+import contextvars
+import importlib.util
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from dotenv import load_dotenv
+from openai import OpenAI, AsyncOpenAI
+
+from request_scheduler import api_base_url, key_id, forget_rate_limits
+
+
+@dataclass(frozen=True)
+class ApiSettings:
+    api_key: str
+    base_url: str
+    # Vision requests are short; long GPT-4 completions need far more time
+    timeout: float = 40.0
+    completion_timeout: float = 600.0
+    connect_timeout: float = 10.0
+    max_connections: int = 64
+    max_keepalive_connections: int = 32
+    # Connection errors retried by the transport; status based retries are done by
+    # the scheduler (vision) and the OpenAI client (completions)
+    transport_retries: int = 1
+    max_retries: int = 2
+    http2: bool = False
+
+
+_lock = threading.Lock()
+_env_loaded = False
+# Keyed by key_id of the API key rather than the key itself
+_settings = {}
+_http_client = None
+_openai_clients = {}
+_async_clients = weakref.WeakKeyDictionary()
+_async_openai_clients = weakref.WeakKeyDictionary()
+
+
+def http2_available():
+    # httpx speaks HTTP/2 only with the optional h2 package installed
+    return importlib.util.find_spec("h2") is not None
+
+
+def get_settings(api_key=None, base_url=None):
+    """
+    API settings resolved once per process: the .env file is read on first use,
+    later calls only look up the cached result.
+    """
+    global _env_loaded
+    with _lock:
+        if not _env_loaded:
+            load_dotenv()
+            _env_loaded = True
+
+        key = (key_id(api_key), base_url)
+        if key not in _settings:
+            _settings[key] = ApiSettings(
+                api_key=api_key or os.environ.get("OPENAI_API_KEY"),
+                base_url=api_base_url(base_url),
+                http2=http2_available(),
+            )
+        return _settings[key]
+
+
+def _transport_options(settings):
+    # With an explicit transport httpx ignores the client's own limits/http2 arguments
+    return {
+        "retries": settings.transport_retries,
+        "http2": settings.http2,
+        "limits": httpx.Limits(max_connections=settings.max_connections,
+                               max_keepalive_connections=settings.max_keepalive_connections),
+    }
+
+
+def get_http_client():
+    """ The process-wide keep-alive connection pool used by the OpenAI clients (thread-safe) """
+    global _http_client
+    settings = get_settings()
+    with _lock:
+        if _http_client is None:
+            _http_client = httpx.Client(
+                transport=httpx.HTTPTransport(**_transport_options(settings)),
+                timeout=httpx.Timeout(settings.completion_timeout, connect=settings.connect_timeout))
+        return _http_client
+
+
+def get_openai_client(api_key=None):
+    """ Shared OpenAI client for the key, all of them on the same connection pool """
+    settings = get_settings(api_key)
+    http_client = get_http_client()
+    with _lock:
+        key = (key_id(settings.api_key), settings.base_url)
+        if key not in _openai_clients:
+            _openai_clients[key] = OpenAI(
+                api_key=settings.api_key, base_url=settings.base_url, max_retries=settings.max_retries,
+                timeout=httpx.Timeout(settings.completion_timeout, connect=settings.connect_timeout), http_client=http_client)
+        return _openai_clients[key]
+
+
+def get_async_client():
+    """
+    Shared httpx.AsyncClient of the running event loop. Connections belong to one
+    loop, so each loop gets its own pool; close it with close_async_client before
+    the loop ends.
+    """
+    loop = asyncio.get_running_loop()
+    settings = get_settings()
+    with _lock:
+        if loop not in _async_clients:
+            _async_clients[loop] = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(**_transport_options(settings)),
+                timeout=httpx.Timeout(settings.timeout, connect=settings.connect_timeout))
+        return _async_clients[loop]
+
+
+def get_async_openai_client(api_key=None):
+    """ AsyncOpenAI client for the key on the running loop's shared connection pool """
+    loop = asyncio.get_running_loop()
+    settings = get_settings(api_key)
+    http_client = get_async_client()
+    with _lock:
+        clients = _async_openai_clients.setdefault(loop, {})
+        key = (key_id(settings.api_key), settings.base_url)
+        if key not in clients:
+            clients[key] = AsyncOpenAI(
+                api_key=settings.api_key, base_url=settings.base_url, max_retries=settings.max_retries,
+                timeout=httpx.Timeout(settings.completion_timeout, connect=settings.connect_timeout), http_client=http_client)
+        return clients[key]
+
+
+def forget_api_key(api_key):
+    """
+    Drops the cached settings, clients and rate limits of api_key, e.g. of a user's
+    key once their job is over. Later calls with the key create them again.
+    """
+    key = key_id(api_key)
+    with _lock:
+        for cache in (_settings, _openai_clients, *_async_openai_clients.values()):
+            for cache_key in [cache_key for cache_key in cache if cache_key[0] == key]:
+                del cache[cache_key]
+    forget_rate_limits(api_key)
+
+
+async def close_async_client():
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_clients.pop(loop, None)
+        # The OpenAI clients of the loop only wrap its pool
+        _async_openai_clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+
+
+def run_sync(make_coroutine):
+    """
+    Runs make_coroutine() to completion for synchronous callers, in a new event loop whose
+    connection pool is closed at the end. Inside a thread that already runs a loop
+    (e.g. a notebook) the new loop gets a thread of its own.
+    """
+    async def main():
+        try:
+            return await make_coroutine()
+        finally:
+            await close_async_client()
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(main())
+
+    # The caller's context goes along, so spans still nest under the caller's
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(contextvars.copy_context().run, asyncio.run, main()).result()
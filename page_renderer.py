@@ -0,0 +1,258 @@
+import os
+import io
+import tempfile
+from dataclasses import dataclass
+
+import fitz
+from PIL import Image
+
+from page_triage import page_metrics
+from tracing import span
+
+
+# Codecs PyMuPDF can encode straight from a pixmap; anything else goes through PIL
+FITZ_FORMATS = {"png", "jpeg"}
+
+MIME_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+
+def normalize_format(image_format):
+    image_format = image_format.lower()
+    if image_format == "jpg":
+        image_format = "jpeg"
+    if image_format not in MIME_TYPES:
+        raise ValueError(
+            f"Unsupported image format '{image_format}', expected one of {sorted(MIME_TYPES)}")
+    return image_format
+
+
+def mime_type(image_format):
+    return MIME_TYPES[normalize_format(image_format)]
+
+
+def sniff_format(image_bytes):
+    """ Image format from the encoded bytes' signature """
+    if image_bytes.startswith(b"\x89PNG"):
+        return "png"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "webp"
+    return "jpeg"
+
+
+@dataclass(frozen=True)
+class ImageBudget:
+    # 512px tiles billed per page in high detail (85 + 170 tokens each)
+    target_tiles: int = 4
+    # Upper limit for one encoded page
+    max_bytes: int = 800_000
+    quality: int = 80
+    min_quality: int = 40
+    # Sparse pages go out in low detail: one 512px image for a flat 85 tokens
+    auto_detail: bool = True
+    low_detail_max_density: int = 150
+
+
+def image_size(image_bytes):
+    # PIL only parses the header here, the image data is not decoded
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return image.size
+
+
+def image_detail(image_bytes):
+    # An image within 512x512 loses nothing in low detail, and costs 85 tokens instead of 255
+    return "low" if max(image_size(image_bytes)) <= 512 else "high"
+
+
+def estimate_image_tokens(image_bytes):
+    """ Prompt tokens billed for an image: 85 in low detail, 85 base + 170 per 512px tile in high detail """
+    if image_detail(image_bytes) == "low":
+        return 85
+    width, height = image_size(image_bytes)
+
+    # The API fits the image into 2048x2048, then scales the shortest side down to 768
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+
+    tiles = -(-int(width) // 512) * -(-int(height) // 512)
+    return 85 + 170 * tiles
+
+
+def encode_pixmap(pix, image_format="jpeg", quality=80):
+    image_format = normalize_format(image_format)
+
+    with span("page.encode", format=image_format, quality=quality, width=pix.width, height=pix.height) as encode_span:
+        image_bytes = _encode(pix, image_format, quality)
+        encode_span.set(bytes=len(image_bytes))
+    return image_bytes
+
+
+def _encode(pix, image_format, quality):
+    if image_format == "png":
+        return pix.tobytes("png")
+    if image_format == "jpeg":
+        return pix.tobytes("jpeg", jpg_quality=quality)
+
+    # Other codecs: hand the raw samples to PIL without an intermediate PPM/PNG
+    mode = "RGBA" if pix.alpha else "RGB"
+    image = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+    buffer = io.BytesIO()
+    image.save(buffer, image_format.upper(), quality=quality)
+    return buffer.getvalue()
+
+
+def render_page(page, zoom_factor=1, image_format="jpeg", quality=80):
+    # A zoom factor of 1 is normal size, less than 1 is reduced size
+    mat = fitz.Matrix(zoom_factor, zoom_factor)
+    pix = page.get_pixmap(matrix=mat, alpha=False)
+    return encode_pixmap(pix, image_format=image_format, quality=quality)
+
+
+def high_detail_scale(width, height, target_tiles):
+    """ Largest scale for a width x height page that stays within target_tiles in high detail """
+    # Pixels beyond what the API keeps after its own downscaling would be wasted
+    api_scale = min(2048 / max(width, height), 768 / min(width, height))
+
+    best = 0
+    for columns in range(1, target_tiles + 1):
+        rows = target_tiles // columns
+        best = max(best, min(columns * 512 / width, rows * 512 / height))
+
+    # Stay clear of tile boundaries when the pixmap size is rounded
+    return min(api_scale, best) * 0.99
+
+
+def low_detail_scale(width, height):
+    return 512 / max(width, height) * 0.99
+
+
+def content_density(metrics):
+    # Rough amount of detail to read: text, vector graphics and raster images
+    return metrics["chars"] + 10 * metrics["drawings"] + 500 * metrics["image_coverage"]
+
+
+def render_page_adaptive(page, budget, image_format="auto"):
+    """
+    Renders a page at the resolution and detail its content needs, within the budget's
+    tile count and byte ceiling. With image_format "auto", photo-like pages are encoded
+    as JPEG and other pages as whichever of PNG/JPEG is smaller.
+    """
+    metrics = page_metrics(page)
+    width, height = page.rect.width, page.rect.height
+
+    if budget.auto_detail and content_density(metrics) <= budget.low_detail_max_density:
+        scale = low_detail_scale(width, height)
+    else:
+        scale = high_detail_scale(width, height, budget.target_tiles)
+
+    if image_format != "auto":
+        formats = [normalize_format(image_format)]
+    elif metrics["image_coverage"] > 0.05:
+        formats = ["jpeg"]
+    else:
+        formats = ["png", "jpeg"]
+
+    quality = budget.quality
+    while True:
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+        image_bytes = min((encode_pixmap(pix, image_format=f, quality=quality) for f in formats), key=len)
+        if len(image_bytes) <= budget.max_bytes or min(pix.width, pix.height) <= 64:
+            return image_bytes
+
+        # Over the ceiling: lower the quality first, then the resolution
+        if quality > budget.min_quality and formats != ["png"]:
+            quality = max(budget.min_quality, quality - 15)
+        else:
+            scale *= 0.8
+
+
+# Documents opened by this (worker) process, so its pages of one deck share one open
+_open_documents = {}
+MAX_OPEN_DOCUMENTS = 4
+
+
+def _open_document(pdf_path):
+    # A changed file is opened again instead of rendering stale pages
+    key = (os.path.abspath(pdf_path), os.path.getmtime(pdf_path))
+    if key not in _open_documents:
+        if len(_open_documents) >= MAX_OPEN_DOCUMENTS:
+            _open_documents.pop(next(iter(_open_documents))).close()
+        with span("pdf.open", path=os.path.basename(str(pdf_path))) as open_span:
+            _open_documents[key] = fitz.open(pdf_path)
+            open_span.set(pages=len(_open_documents[key]))
+    return _open_documents[key]
+
+
+def render_page_number(pdf_path, page_number, zoom_factor=1, image_format="jpeg", quality=80, budget=None):
+    """
+    Renders one 1-based page of the PDF at pdf_path. Meant for pool workers: each one
+    opens the document itself and keeps it open for the following pages.
+    """
+    pdf = _open_document(pdf_path)
+    with span("page.render", page_number=page_number, adaptive=budget is not None) as render_span:
+        if budget is not None:
+            image_bytes = render_page_adaptive(pdf[page_number - 1], budget, image_format=image_format)
+        else:
+            image_bytes = render_page(pdf[page_number - 1], zoom_factor=zoom_factor, image_format=image_format, quality=quality)
+        render_span.set(bytes=len(image_bytes))
+    return image_bytes
+
+
+def write_debug_images(pages, debug_folder):
+    """ Writes rendered pages into a fresh per-run folder under debug_folder, returns the file names """
+    os.makedirs(debug_folder, exist_ok=True)
+
+    # Unique folder per run, so concurrent runs never overwrite each other's pages
+    run_folder = tempfile.mkdtemp(prefix="pages_", dir=debug_folder)
+
+    files = []
+    for page_number, image_bytes in enumerate(pages):
+        filename = os.path.join(run_folder, f"page_{page_number + 1}.{sniff_format(image_bytes)}")
+        with open(filename, "wb") as image_file:
+            image_file.write(image_bytes)
+        files.append(filename)
+
+    return files
+
+
+def render_pdf_pages(pdf_path, zoom_factor=1, image_format="jpeg", quality=80, debug_folder=None, page_numbers=None, budget=None):
+    """
+    Renders the pages of the PDF (all, or the given 1-based page_numbers) to encoded image bytes, entirely in memory.
+    With an ImageBudget each page is sized and encoded adaptively, and zoom_factor and quality are not used.
+    """
+    with span("pdf.open", path=os.path.basename(str(pdf_path))) as open_span:
+        pdf = fitz.open(pdf_path)
+        open_span.set(pages=len(pdf))
+
+    print(f'Number of pages: {len(pdf)}')
+
+    if page_numbers is None:
+        page_numbers = range(1, len(pdf) + 1)
+
+    pages = []
+    for page_number in page_numbers:
+        # Encoding is traced as a child span, the rest of a page's time is rasterizing
+        with span("page.render", page_number=page_number, adaptive=budget is not None) as render_span:
+            if budget is not None:
+                image_bytes = render_page_adaptive(pdf[page_number - 1], budget, image_format=image_format)
+            else:
+                image_bytes = render_page(pdf[page_number - 1], zoom_factor=zoom_factor, image_format=image_format, quality=quality)
+            render_span.set(bytes=len(image_bytes))
+        pages.append(image_bytes)
+    pdf.close()
+
+    print(f"Finished rendering PDF to {image_format.upper()} "
+          f"({sum(len(p) for p in pages) / 1e6:.1f} MB)")
+
+    # Optional on-disk copies for inspecting what is sent to the API
+    if debug_folder is not None:
+        files = write_debug_images(pages, debug_folder)
+        print("Debug images written:")
+        print(files)
+
+    return pages
@@ -0,0 +1,121 @@
+import os
+import hashlib
+from dataclasses import dataclass
+
+import fitz
+
+from pdf_text import page_text
+from tracing import span
+
+
+PAGE_VISION = "vision"
+PAGE_TEXT = "text"
+PAGE_SKIP = "skip"
+
+
+@dataclass
+class TriageSettings:
+    # Share of the page covered by raster images that makes it worth a vision request
+    min_image_coverage: float = 0.25
+    # Vector paths on a page with a chart or diagram
+    min_drawings: int = 40
+    # Pages with less text than this and any visual content go to vision
+    min_text_chars: int = 80
+    # Below these a page counts as blank
+    blank_max_drawings: int = 3
+    blank_max_image_coverage: float = 0.01
+    # Zoom of the thumbnail compared for exact duplicates
+    thumbnail_zoom: float = 0.2
+
+
+def page_metrics(page):
+    """ Text, image coverage and vector drawing counts of one fitz page """
+    text = page_text(page)
+    page_area = abs(page.rect) or 1
+
+    image_area = 0
+    for info in page.get_image_info():
+        image_area += abs(fitz.Rect(info["bbox"]) & page.rect)
+
+    return {
+        "text": text,
+        "chars": len(text),
+        "image_coverage": min(1.0, image_area / page_area),
+        "drawings": len(page.get_drawings()),
+    }
+
+
+def page_fingerprint(page, zoom):
+    # Identical pages render to identical pixels, also when the PDF objects differ
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return hashlib.sha256(pix.samples).hexdigest()
+
+
+def classify_page(metrics, settings):
+    has_visuals = (metrics["image_coverage"] > settings.blank_max_image_coverage
+                   or metrics["drawings"] > settings.blank_max_drawings)
+
+    if metrics["chars"] == 0 and not has_visuals:
+        return PAGE_SKIP
+    if metrics["image_coverage"] >= settings.min_image_coverage or metrics["drawings"] >= settings.min_drawings:
+        return PAGE_VISION
+    if metrics["chars"] < settings.min_text_chars and has_visuals:
+        return PAGE_VISION
+    return PAGE_TEXT
+
+
+def triage_pages(pdf_path, settings=None):
+    """
+    Classifies every page as PAGE_VISION (image-heavy, needs a vision description),
+    PAGE_TEXT (the local text layer is enough) or PAGE_SKIP (blank or an exact
+    duplicate of an earlier page). Returns one dict per page.
+    """
+    settings = settings or TriageSettings()
+    with span("pdf.open", path=os.path.basename(str(pdf_path))) as open_span:
+        pdf = fitz.open(pdf_path)
+        open_span.set(pages=len(pdf))
+
+    with span("pdf.triage", pages=len(pdf)) as triage_span:
+        plan = []
+        seen = {}
+        for page in pdf:
+            metrics = page_metrics(page)
+            kind = classify_page(metrics, settings)
+            duplicate_of = None
+
+            if kind != PAGE_SKIP:
+                fingerprint = page_fingerprint(page, settings.thumbnail_zoom)
+                if fingerprint in seen:
+                    kind, duplicate_of = PAGE_SKIP, seen[fingerprint]
+                else:
+                    seen[fingerprint] = page.number + 1
+
+            plan.append({
+                "page_number": page.number + 1,
+                "kind": kind,
+                "duplicate_of": duplicate_of,
+                "text": metrics["text"],
+                "image_coverage": round(metrics["image_coverage"], 3),
+                "drawings": metrics["drawings"],
+            })
+        triage_span.set(vision=sum(1 for page in plan if page["kind"] == PAGE_VISION))
+
+    pdf.close()
+
+    counts = {kind: sum(1 for page in plan if page["kind"] == kind) for kind in (PAGE_VISION, PAGE_TEXT, PAGE_SKIP)}
+    print(f"Triage: {counts[PAGE_VISION]} pages to vision, {counts[PAGE_TEXT]} from text, {counts[PAGE_SKIP]} skipped")
+    return plan
+
+
+def merge_descriptions(plan, vision_descriptions):
+    """
+    Combines vision descriptions ({page_number: "Slide N:..."}) with the text of
+    text pages into one "Slide N:" list in page order; skipped pages are left out.
+    """
+    descriptions = []
+    for page in plan:
+        if page["kind"] == PAGE_VISION:
+            descriptions.append(vision_descriptions[page["page_number"]])
+        elif page["kind"] == PAGE_TEXT:
+            descriptions.append(f'Slide {page["page_number"]}:\n{page["text"]}')
+    return descriptions
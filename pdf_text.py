@@ -0,0 +1,88 @@
+import os
+import argparse
+
+import fitz
+
+from tracing import span
+
+
+# Block type of text blocks in page.get_text("blocks"); the others are images
+TEXT_BLOCK = 0
+
+
+def page_text(page):
+    """
+    Text of one fitz page in reading order: text blocks sorted top to bottom, then
+    left to right, separated by blank lines; whitespace-only lines are dropped.
+    """
+    blocks = []
+    for block in page.get_text("blocks", sort=True):
+        if block[6] != TEXT_BLOCK:
+            continue
+        lines = [line.strip() for line in block[4].splitlines()]
+        text = "\n".join(line for line in lines if line)
+        if text:
+            blocks.append(text)
+    return "\n\n".join(blocks)
+
+
+def iter_page_texts(pdf_path, page_numbers=None, max_pages=None, max_chars=None):
+    """
+    Yields (page_number, text) for the pages of the PDF (all, or the given 1-based
+    page_numbers), one page at a time. Pages without text are left out. Stops after
+    max_pages pages with text, or once max_chars characters were yielded; the last
+    page is then cut to fit.
+    """
+    with span("pdf.open", path=os.path.basename(str(pdf_path))) as open_span:
+        pdf = fitz.open(pdf_path)
+        open_span.set(pages=len(pdf))
+
+    try:
+        if page_numbers is None:
+            page_numbers = range(1, len(pdf) + 1)
+
+        pages, chars = 0, 0
+        for page_number in page_numbers:
+            if (max_pages is not None and pages >= max_pages) or (max_chars is not None and chars >= max_chars):
+                break
+
+            with span("page.text", page_number=page_number) as text_span:
+                text = page_text(pdf[page_number - 1])
+                if max_chars is not None:
+                    text = text[:max_chars - chars]
+                text_span.set(bytes=len(text))
+            if not text:
+                continue
+
+            pages += 1
+            chars += len(text)
+            yield page_number, text
+    finally:
+        pdf.close()
+
+
+def iter_slide_texts(pdf_path, page_numbers=None, max_pages=None, max_chars=None):
+    """ Yields the text of the PDF as "Slide N:" sections, the same form as the vision descriptions """
+    for page_number, text in iter_page_texts(pdf_path, page_numbers, max_pages, max_chars):
+        yield f"Slide {page_number}:\n{text}"
+
+
+def extract_text(pdf_path, page_numbers=None, max_pages=None, max_chars=None):
+    """ Text of the PDF as "Slide N:" sections joined into one string """
+    return "\n\n".join(iter_slide_texts(pdf_path, page_numbers, max_pages, max_chars))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the text of a Pitch Deck PDF, one \"Slide N:\" section per page.")
+    parser.add_argument("pdf_path", help="Path to the PDF file")
+    parser.add_argument("--max-pages", type=int, default=None, help="Stop after this many pages with text")
+    parser.add_argument("--max-chars", type=int, default=None, help="Stop after this many characters")
+    args = parser.parse_args()
+
+    # Printed page by page, so a long deck starts showing right away
+    for page_number, text in iter_page_texts(args.pdf_path, max_pages=args.max_pages, max_chars=args.max_chars):
+        print(f"Slide {page_number}:\n{text}\n", flush=True)
+
+
+if __name__ == "__main__":
+    main()
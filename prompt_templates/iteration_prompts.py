@@ -35,3 +35,68 @@ SUMMARY FORMAT TEMPLATE:
 
 {summary_template}
 '''
+
+
+def merge_prompt(summaries, summary_template):
+    partial_summaries = "\n--------\n".join(summaries)
+    return f'''
+You are an expert in summarizing startup pitchdecks according to a given template.
+Your goal is to create a structured summary memo of a pitchdeck for VC evaluation, according to the given template.
+Below you find partial summaries of the same pitchdeck, each written from a different part of the deck, in slide order:
+--------
+{partial_summaries}
+--------
+Combine the partial summaries into one summary. Keep all information found in any of them, merge duplicate points and do not add information that isn't in the partial summaries.
+Total output will be a list of important aspects of the startup company in question, very briefly in bullet points (no lenghty sentences), in the format of the following template:
+
+SUMMARY FORMAT TEMPLATE:
+
+{summary_template}
+'''
+
+
+def patch_prompt(chunk, summary_template, current_sections):
+    current_memo = "\n".join(f"{heading}: {text}" if text else f"{heading}:" for heading, text in current_sections.items())
+    return f'''
+You are an expert in summarizing startup pitchdecks according to a given template.
+Your goal is to keep a structured summary memo of a pitchdeck for VC evaluation up to date, section by section.
+The memo so far, one section per template heading:
+--------
+{current_memo}
+--------
+Below you find a partial extraction of the original pitchdeck's description text, slide by slide:
+--------
+{chunk}
+--------
+Return ONLY the sections that the new text changes, as one JSON object keyed by the exact template heading:
+- a list of strings adds new bullet points to the end of a section, e.g. {{"Problem": ["- Manual invoicing takes days"]}}
+- a string replaces the whole section, only when existing points are wrong or need rewriting
+Include only info existing in the pitchdeck, very briefly (no lenghty sentences). Follow the hints in the template below.
+Do not repeat unchanged sections. If the text adds nothing, return {{}}.
+
+SUMMARY FORMAT TEMPLATE:
+
+{summary_template}
+'''
+
+
+def revision_prompt(changes, summary_template, existing_summary):
+    return f'''
+You are an expert in summarizing startup pitchdecks according to a given template.
+Your goal is to keep a structured summary memo of a pitchdeck for VC evaluation up to date with a new version of the deck.
+This is the summary of the previous version of the deck:
+--------
+{existing_summary}
+--------
+Below you find what changed in the new version. "Slide N: (new or changed)" describes a slide of the new version,
+"Removed slide N of the previous version" describes a slide that is no longer in the deck:
+--------
+{changes}
+--------
+Update the summary to the new version: add or correct information from new and changed slides, and drop information that only came from removed slides.
+Keep everything else as it is. Total output will be a list of important aspects of the startup company in question, very briefly in bullet points (no lenghty sentences), in the format of the following template:
+
+SUMMARY FORMAT TEMPLATE:
+
+{summary_template}
+'''
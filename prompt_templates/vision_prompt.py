@@ -3,4 +3,11 @@ This image is one page of a pitch deck of a startup company. You are producing d
 of each page in the deck. Now, describe what is seen on this page as effectively and briefly
 as possible, focusing only on factors relevant for evaluating the company in venture capital
 investment context. Limit the description to 3-5 sentences.
-'''
\ No newline at end of file
+'''
+# Appended to the per-page prompt when several pages go out in one request
+batch_vision_prompt = '''
+Below are {count} pages of the deck, each image preceded by its label ("Slide N:"). Follow the
+instructions above for every page separately. Answer with a JSON object only, with one entry
+per page in the order given:
+{{"slides": [{{"slide": N, "description": "..."}}]}}
+'''
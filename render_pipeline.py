@@ -0,0 +1,116 @@
+import os
+import time
+import atexit
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from page_renderer import render_page_number
+from tracing import reset_context
+
+
+# Encoded pages rendered but not yet released by the uploader (queued or being sent)
+DEFAULT_MAX_INFLIGHT_BYTES = 64_000_000
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_render_pool(workers=None):
+    """ Process pool shared by the render pipelines of this process, started on first use """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=reset_context)
+            atexit.register(_pool.shutdown, cancel_futures=True)
+        return _pool
+
+
+class PageRenderPipeline:
+    """
+    Renders the pages of a PDF in a process pool and hands them to the uploader as they
+    are ready: `async for page_number, image_bytes in pipeline`. Every worker opens the
+    document itself, so no page data is pickled on the way in.
+
+    Pages come out in the order they finish. Rendering pauses while the pages handed out
+    but not yet given back with release() exceed max_inflight_bytes, which bounds memory
+    to that plus the pages still being rendered.
+    """
+
+    def __init__(self, pdf_path, page_numbers, zoom_factor=1, image_format="jpeg", quality=80, budget=None,
+                 pool=None, max_inflight_bytes=DEFAULT_MAX_INFLIGHT_BYTES, max_renders=None):
+        self.pdf_path = pdf_path
+        self.page_numbers = list(page_numbers)
+        self.render_args = (zoom_factor, image_format, quality, budget)
+        self.pool = pool
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_renders = max_renders or os.cpu_count()
+
+        self.inflight_bytes = 0
+        self.peak_inflight_bytes = 0
+        self.first_page_after = None
+        self._space = asyncio.Event()
+
+    def __len__(self):
+        return len(self.page_numbers)
+
+    def skip(self, page_numbers):
+        """ Leaves out pages the caller already has, before the iteration starts """
+        page_numbers = set(page_numbers)
+        self.page_numbers = [page_number for page_number in self.page_numbers if page_number not in page_numbers]
+
+    def release(self, image_bytes):
+        """ Gives a page's memory back once its request is done """
+        self.inflight_bytes -= len(image_bytes)
+        self._space.set()
+
+    async def _wait_for_space(self):
+        # A single page over the cap still goes through, alone
+        while self.inflight_bytes >= self.max_inflight_bytes and self.inflight_bytes > 0:
+            self._space.clear()
+            await self._space.wait()
+
+    async def _produce(self, queue):
+        loop = asyncio.get_running_loop()
+        pool = self.pool or get_render_pool()
+        renders = asyncio.Semaphore(self.max_renders)
+        started = time.perf_counter()
+
+        async def render(page_number):
+            try:
+                image_bytes = await loop.run_in_executor(
+                    pool, render_page_number, self.pdf_path, page_number, *self.render_args)
+            finally:
+                renders.release()
+
+            self.inflight_bytes += len(image_bytes)
+            self.peak_inflight_bytes = max(self.peak_inflight_bytes, self.inflight_bytes)
+            if self.first_page_after is None:
+                self.first_page_after = time.perf_counter() - started
+            await queue.put((page_number, image_bytes))
+
+        tasks = []
+        try:
+            for page_number in self.page_numbers:
+                await renders.acquire()
+                await self._wait_for_space()
+                tasks.append(asyncio.create_task(render(page_number)))
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            # The uploader raises it from the iteration
+            await queue.put(e)
+        finally:
+            for task in tasks:
+                task.cancel()
+        await queue.put(None)
+
+    async def __aiter__(self):
+        queue = asyncio.Queue(maxsize=self.max_renders)
+        producer = asyncio.create_task(self._produce(queue))
+        try:
+            while (item := await queue.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            producer.cancel()
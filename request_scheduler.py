@@ -0,0 +1,270 @@
+import os
+import time
+import random
+import asyncio
+import hashlib
+import threading
+import weakref
+from contextlib import contextmanager, asynccontextmanager
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+
+import httpx
+import openai
+
+from tracing import current_span
+
+
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+
+# Status codes worth retrying: rate limiting, timeouts and transient server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def api_base_url(base_url=None):
+    """ Base URL of the OpenAI-compatible API: the argument, OPENAI_BASE_URL or the real endpoint """
+    return (base_url or os.environ.get("OPENAI_BASE_URL") or DEFAULT_BASE_URL).rstrip("/")
+
+
+def key_id(api_key):
+    """ Hash of api_key used as its cache key, so the module-level caches don't hold the key itself """
+    return hashlib.sha256(api_key.encode()).hexdigest() if api_key else None
+
+
+@dataclass
+class RateLimits:
+    max_concurrency: int = 8
+    requests_per_minute: int = 100
+    tokens_per_minute: int = 40000
+    max_retries: int = 6
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+
+
+class TokenBucket:
+    """ Thread-safe token bucket refilled continuously at per_minute / 60 per second """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """ Takes amount from the bucket, returns how many seconds the caller has to wait before using it """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # A single request larger than the whole bucket still has to get through eventually
+            self.tokens -= min(amount, self.capacity)
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+def retry_after_seconds(response):
+    """ Reads the server's requested delay from Retry-After(-ms) headers, None if absent """
+    if response is None:
+        return None
+    headers = response.headers
+
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+
+    if "retry-after" in headers:
+        value = headers["retry-after"]
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        # HTTP-date format
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+
+    return None
+
+
+def _error_response(error):
+    # httpx.HTTPStatusError and openai.APIStatusError both carry the response
+    return getattr(error, "response", None)
+
+
+def _is_retryable_error(error):
+    if isinstance(error, (httpx.TransportError, openai.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is None and _error_response(error) is not None:
+        status = _error_response(error).status_code
+    return status in RETRYABLE_STATUS_CODES
+
+
+class RequestScheduler:
+    """
+    Runs API requests for one API key with bounded concurrency, request- and
+    token-per-minute budgets and exponential backoff with jitter on 429/5xx.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = limits or RateLimits()
+        self.request_bucket = TokenBucket(self.limits.requests_per_minute)
+        self.token_bucket = TokenBucket(self.limits.tokens_per_minute)
+        # Set on 429 so every request for the key backs off, not only the one that got limited
+        self.blocked_until = 0.0
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _semaphore(self):
+        # asyncio primitives are bound to one event loop; keep one per loop
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._semaphores:
+                self._semaphores[loop] = asyncio.Semaphore(self.limits.max_concurrency)
+            return self._semaphores[loop]
+
+    def backoff_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.limits.base_delay)
+        delay = min(self.limits.max_delay, self.limits.base_delay * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    async def _wait_for_budget(self, estimated_tokens):
+        wait = max(self.request_bucket.reserve(1),
+                   self.token_bucket.reserve(estimated_tokens),
+                   self.blocked_until - time.monotonic())
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def run(self, send, estimated_tokens=0):
+        """
+        Awaits send() - an async callable making one API request - within the limits.
+        Retryable responses and errors are retried; the final response is returned
+        or the final error raised. Time spent waiting (for a slot, the rate budget or a
+        backoff) and time spent on the network are added to the current trace span.
+        """
+        attempt = 0
+        traced = current_span()
+        queued = time.perf_counter()
+        async with self._semaphore():
+            while True:
+                await self._wait_for_budget(estimated_tokens)
+
+                sent = time.perf_counter()
+                try:
+                    response = await send()
+                except Exception as e:
+                    if traced is not None:
+                        traced.add(queue_wait=sent - queued, network=time.perf_counter() - sent, attempts=1)
+                    if attempt >= self.limits.max_retries or not _is_retryable_error(e):
+                        raise
+                    response = _error_response(e)
+                    status = getattr(e, "status_code", None) or getattr(response, "status_code", None)
+                else:
+                    if traced is not None:
+                        traced.add(queue_wait=sent - queued, network=time.perf_counter() - sent, attempts=1)
+                    status = getattr(response, "status_code", 200)
+                    if status not in RETRYABLE_STATUS_CODES or attempt >= self.limits.max_retries:
+                        return response
+
+                delay = self.backoff_delay(attempt, retry_after_seconds(response))
+                if status == 429:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+                print(f"Request failed with status {status}, retrying in {delay:.1f}s "
+                      f"({attempt + 1}/{self.limits.max_retries})")
+                attempt += 1
+                queued = time.perf_counter()
+                await asyncio.sleep(delay)
+
+
+class CompletionLimiter:
+    """
+    Limits for the GPT-4 calls made with one API key, shared by every thread and
+    event loop making them. Retries are left to the OpenAI client itself.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = limits or RateLimits()
+        self.request_bucket = TokenBucket(self.limits.requests_per_minute)
+        self.token_bucket = TokenBucket(self.limits.tokens_per_minute)
+        self.slots = threading.BoundedSemaphore(self.limits.max_concurrency)
+
+    @contextmanager
+    def slot(self, estimated_tokens=0):
+        queued = time.perf_counter()
+        with self.slots:
+            wait = max(self.request_bucket.reserve(1), self.token_bucket.reserve(estimated_tokens))
+            if wait > 0:
+                time.sleep(wait)
+            if current_span() is not None:
+                current_span().add(queue_wait=time.perf_counter() - queued)
+            yield
+
+    @asynccontextmanager
+    async def slot_async(self, estimated_tokens=0):
+        """ slot() for coroutines: waits without blocking the event loop, and can be cancelled while waiting """
+        queued = time.perf_counter()
+        # Threads and event loops share the slots of the key, so the semaphore is polled rather than awaited
+        while not self.slots.acquire(blocking=False):
+            await asyncio.sleep(0.05)
+        try:
+            wait = max(self.request_bucket.reserve(1), self.token_bucket.reserve(estimated_tokens))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if current_span() is not None:
+                current_span().add(queue_wait=time.perf_counter() - queued)
+            yield
+        finally:
+            self.slots.release()
+
+
+# Keyed by key_id(api_key)
+_schedulers = {}
+_limiters = {}
+_schedulers_lock = threading.Lock()
+
+
+def configure_rate_limits(api_key, limits):
+    """ Sets the limits used for all requests made with api_key """
+    with _schedulers_lock:
+        scheduler = _schedulers[key_id(api_key)] = RequestScheduler(limits)
+    return scheduler
+
+
+def get_scheduler(api_key, limits=None):
+    """ Returns the shared scheduler for api_key, creating it with limits (or defaults) if needed """
+    with _schedulers_lock:
+        key = key_id(api_key)
+        if key not in _schedulers:
+            _schedulers[key] = RequestScheduler(limits)
+        return _schedulers[key]
+
+
+def configure_completion_limits(api_key, limits):
+    """ Sets the limits used for GPT-4 text completions made with api_key """
+    with _schedulers_lock:
+        limiter = _limiters[key_id(api_key)] = CompletionLimiter(limits)
+    return limiter
+
+
+def get_completion_limiter(api_key, limits=None):
+    # Text and vision models have separate rate limits, so they don't share a budget
+    with _schedulers_lock:
+        key = key_id(api_key)
+        if key not in _limiters:
+            _limiters[key] = CompletionLimiter(limits)
+        return _limiters[key]
+
+
+def forget_rate_limits(api_key):
+    """ Drops the scheduler and limiter of api_key, e.g. of a user's key once their job is over """
+    with _schedulers_lock:
+        _schedulers.pop(key_id(api_key), None)
+        _limiters.pop(key_id(api_key), None)
@@ -1,21 +1,166 @@
 import re
-import os
-from dotenv import load_dotenv
-from openai import OpenAI
+import json
+import asyncio
 
+from prompt_templates.default_summary_template import default_summary_template
+from openai_session import get_async_openai_client, run_sync
+from tracing import span
 
-def structurize_summary(summary, api_key=None):
 
-    if api_key is None:
-        load_dotenv()
-        api_key = os.getenv("OPENAI_API_KEY")
+# Markdown a model may put around a heading: "## ", "**...**". List items are never
+# headings, a bullet named like a heading belongs to the section it is in
+HEADING_PREFIX = r"^[^\S\n]*(?:#+[^\S\n]*)?(?:\*\*|__)?[^\S\n]*"
+HEADING_SUFFIX = r"[^\S\n]*[)\]]?(?:\*\*|__)?[^\S\n]*(?::(?:\*\*|__)?|(?=\n)|\Z)"
 
-    client = OpenAI(api_key=api_key)
 
-    input_p1000_tokens = 0.03
-    output_p1000_tokens = 0.06
+def template_headings(summary_template):
+    """ Headings of a summary template: the text before ':' on every line that isn't a (hint) """
+    headings = []
+    for line in summary_template.splitlines():
+        line = line.strip()
+        if not line or line.startswith("(") or ":" not in line:
+            continue
+        heading = line.split(":", 1)[0].strip()
+        if heading and heading not in headings:
+            headings.append(heading)
+    return headings
+
+
+def heading_pattern(heading):
+    # Case, punctuation, spacing and "&"/"and" differences are tolerated
+    words = [word for word in re.findall(r"[^\W_]+", heading) if word.lower() != "and"]
+    return r"(?:[\W_]|and)*?".join(re.escape(word) for word in words)
+
+
+def compile_headings(headings):
+    """ One alternation matching any of the headings at the start of a line """
+    # Longer headings first, so a heading that starts with a shorter one wins
+    order = sorted(range(len(headings)), key=lambda i: len(headings[i]), reverse=True)
+    alternation = "|".join(f"(?P<h{i}>{heading_pattern(headings[i])})" for i in order)
+    return re.compile(f"{HEADING_PREFIX}(?:{alternation}){HEADING_SUFFIX}", re.IGNORECASE | re.MULTILINE)
+
+
+def parse_sections(summary, headings):
+    """
+    Splits the summary into {heading: text} in a single pass over the text.
+    Headings not found in the summary are left out.
+    """
+    pattern = compile_headings(headings)
 
-    prompt = f"""
+    # The first occurrence of a heading starts its section, later ones are text of the section they are in
+    found = {}
+    for match in pattern.finditer(summary):
+        found.setdefault(headings[int(match.lastgroup[1:])], match)
+
+    matches = list(found.items())
+    sections = {}
+    for i, (heading, match) in enumerate(matches):
+        end = matches[i + 1][1].start() if i + 1 < len(matches) else len(summary)
+        sections[heading] = summary[match.end():end].strip().strip(':').strip()
+
+    return sections
+
+
+def heading_key(heading):
+    # Same tolerance as the heading pattern: case, punctuation and "&"/"and" don't matter
+    return " ".join(word for word in re.findall(r"[^\W_]+", heading.lower()) if word != "and")
+
+
+def render_sections(sections):
+    """ Memo text of {heading: text} in the given order, in the layout of the template """
+    lines = []
+    for heading, text in sections.items():
+        if "\n" in text:
+            lines.append(f"{heading}:\n{text}\n")
+        else:
+            lines.append(f"{heading}: {text}".rstrip())
+    return "\n".join(lines).strip()
+
+
+def parse_patch(response):
+    """
+    The JSON object of a section patch response, None if there is none. Code
+    fences and text around the object are ignored.
+    """
+    start, end = response.find("{"), response.rfind("}")
+    if start == -1 or end < start:
+        return None
+    try:
+        patch = json.loads(response[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    return patch if isinstance(patch, dict) else None
+
+
+def apply_patch(sections, patch):
+    """
+    Merges a patch into sections (in place): a list value appends its lines to the
+    section, a string replaces the section. Returns the headings that changed;
+    headings not in sections are ignored.
+    """
+    by_key = {heading_key(heading): heading for heading in sections}
+    changed = []
+    for patch_heading, value in patch.items():
+        heading = by_key.get(heading_key(patch_heading))
+        if heading is None:
+            continue
+        if isinstance(value, list):
+            added = "\n".join(str(line).strip() for line in value if str(line).strip())
+            if added:
+                sections[heading] = f"{sections[heading]}\n{added}".strip()
+                changed.append(heading)
+        elif isinstance(value, str) and value.strip() != sections[heading]:
+            sections[heading] = value.strip()
+            changed.append(heading)
+    return changed
+
+
+def structurize_locally(summary, summary_template=None, max_missing_ratio=0.3):
+    """
+    Splits a summary into {heading: value} using the headings of the summary template,
+    None when more than max_missing_ratio of them can't be found.
+    """
+    if summary_template is None:
+        summary_template = default_summary_template()
+
+    with span("summary.parse", bytes=len(summary)) as parse_span:
+        headings = template_headings(summary_template)
+        sections = parse_sections(summary, headings)
+
+        # Headings present in the summary but left empty still count as found
+        found = len(sections)
+        local = bool(headings) and (len(headings) - found) / len(headings) <= max_missing_ratio
+        parse_span.set(headings=len(headings), found=found, fallback=not local)
+    if not local:
+        print(f"Only {found}/{len(headings)} template headings found")
+        return None
+    print(f"Parsed {found}/{len(headings)} template headings locally")
+    return {heading: sections.get(heading, "") for heading in headings}
+
+
+async def structurize_summary_async(summary, api_key=None, summary_template=None, max_missing_ratio=0.3, timeout=None):
+    """
+    Splits a summary into {heading: value} using the headings of the summary template.
+    Falls back to asking GPT-4 for the headings when more than max_missing_ratio of
+    the template headings can't be found, within timeout seconds. Returns the dict and the cost.
+    """
+    structured = structurize_locally(summary, summary_template, max_missing_ratio)
+    if structured is not None:
+        return structured, 0.0
+
+    print("Asking GPT-4 for the headings")
+    return await asyncio.wait_for(structurize_summary_with_llm(summary, api_key=api_key), timeout)
+
+
+def structurize_summary(summary, api_key=None, summary_template=None, max_missing_ratio=0.3, timeout=None):
+    """ Blocking structurize_summary_async """
+    return run_sync(lambda: structurize_summary_async(
+        summary, api_key=api_key, summary_template=summary_template, max_missing_ratio=max_missing_ratio, timeout=timeout))
+
+
+def headings_prompt(summary):
+    """ Prompt asking GPT-4 for the headings of a summary the template headings weren't found in """
+    return f"""
 Provide a complete list of all the headings present in the following text,
 in the order in which they appear, delimited by a newline and semicolon,
 like the exaple below. Do not return anything else than the list of headings:
@@ -39,24 +184,13 @@ Text to extract headings from:
 ---
 {summary}
 """
-    print(f"{prompt}\n\n")
 
-    completion = client.chat.completions.create(
-        model="gpt-4",
-        messages=[{"role": "system", "content": prompt}],
-        temperature=0
-    )
 
-    headings = completion.choices[0].message.content
+def split_on_headings(summary, headings):
+    """ Splits the summary into {heading: value} on the headings GPT-4 listed (its answer to headings_prompt) """
     sep_headings = [value.strip().strip(";")
                     for value in headings.split(';\n')]
 
-    output_cost = completion.usage.completion_tokens * output_p1000_tokens / 1000
-    input_cost = completion.usage.prompt_tokens * input_p1000_tokens / 1000
-    total_cost = (output_cost + input_cost)
-
-    print(f"{sep_headings}\nCost so far: {total_cost:.3f}\n")
-
     structured_summary = {}
 
     for i, heading in enumerate(sep_headings):
@@ -75,6 +209,36 @@ Text to extract headings from:
         else:
             structured_summary[heading] = ""
 
+    return structured_summary
+
+
+async def structurize_summary_with_llm(summary, api_key=None):
+
+    client = get_async_openai_client(api_key)
+
+    input_p1000_tokens = 0.03
+    output_p1000_tokens = 0.06
+
+    prompt = headings_prompt(summary)
+    print(f"{prompt}\n\n")
+
+    with span("api.completion", model="gpt-4", stream=False, bytes=len(prompt)) as api_span:
+        completion = await client.chat.completions.create(
+            model="gpt-4",
+            messages=[{"role": "system", "content": prompt}],
+            temperature=0
+        )
+
+        output_cost = completion.usage.completion_tokens * output_p1000_tokens / 1000
+        input_cost = completion.usage.prompt_tokens * input_p1000_tokens / 1000
+        total_cost = (output_cost + input_cost)
+        api_span.set(prompt_tokens=completion.usage.prompt_tokens,
+                     completion_tokens=completion.usage.completion_tokens, cost=total_cost)
+
+    headings = completion.choices[0].message.content
+    print(f"{headings}\nCost so far: {total_cost:.3f}\n")
+
+    structured_summary = split_on_headings(summary, headings)
     print(structured_summary)
 
     return structured_summary, total_cost
@@ -0,0 +1,64 @@
+import os
+import glob
+import json
+import time
+import uuid
+
+from disk_eviction import evict_files
+
+
+CHECKPOINT_FOLDER = os.path.join(".cache", "checkpoints")
+
+
+def new_run_id():
+    return uuid.uuid4().hex[:12]
+
+
+def _checkpoint_path(run_id, stage, folder):
+    return os.path.join(folder, f"{run_id}.{stage}.json")
+
+
+def save_checkpoint(run_id, stage, state, folder=CHECKPOINT_FOLDER):
+    """ Persists the state of one pipeline stage ("vision", "summary") of a run """
+    os.makedirs(folder, exist_ok=True)
+    state = dict(state, run_id=run_id, stage=stage, updated=time.time())
+
+    # Write to a temp file and swap it in, so a crash never leaves a half-written checkpoint
+    path = _checkpoint_path(run_id, stage, folder)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as checkpoint_file:
+        json.dump(state, checkpoint_file)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(run_id, stage, folder=CHECKPOINT_FOLDER):
+    """ Returns the saved state of the stage, or None if the run has no checkpoint for it """
+    if run_id is None:
+        return None
+    try:
+        with open(_checkpoint_path(run_id, stage, folder), encoding="utf-8") as checkpoint_file:
+            return json.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+
+
+def delete_checkpoints(run_id, folder=CHECKPOINT_FOLDER):
+    """ Removes all stage checkpoints of a finished run """
+    for path in glob.glob(os.path.join(folder, f"{glob.escape(run_id)}.*.json")):
+        os.remove(path)
+
+
+def list_checkpoints(folder=CHECKPOINT_FOLDER):
+    """ Saved stage states of all unfinished runs, most recently updated first """
+    states = []
+    for path in glob.glob(os.path.join(folder, "*.json")):
+        with open(path, encoding="utf-8") as checkpoint_file:
+            states.append(json.load(checkpoint_file))
+    return sorted(states, key=lambda state: state["updated"], reverse=True)
+
+
+def evict_checkpoints(max_age, keep_run_ids=(), folder=CHECKPOINT_FOLDER):
+    """ Removes the checkpoints of runs that weren't updated for max_age seconds, except keep_run_ids; returns their paths """
+    keep = {os.path.basename(path) for run_id in keep_run_ids
+            for path in glob.glob(os.path.join(glob.escape(folder), f"{glob.escape(run_id)}.*.json"))}
+    return evict_files(folder, "*.json", max_age=max_age, keep=keep) + evict_files(folder, "*.tmp", max_age=max_age)
@@ -1,31 +1,78 @@
-import os
-
-# dotenv
-from dotenv import load_dotenv
-
-# Tempfile
-import tempfile
-
 # Streamlit
 import streamlit as st
 
-# Langchain PyPDF
-from langchain.document_loaders import PyPDFLoader
-
 # Pandas
 import pandas as pd
 
+# HTTP errors of the job service
+import httpx
+
 # Import custom templates
 from prompt_templates.default_summary_template import default_summary_template
 
-# Import vision analyzer module
-from vision_analyzer import get_descriptions, get_pdf_page_count
+# Import the job service client; the pipeline itself runs in job_service.py
+from job_client import JobClient, FINAL_STATUSES
+
+# Import tracing
+from tracing import summarize_spans
+
+# Import API settings, resolved once per process
+from openai_session import get_settings
+
+
+# What the progress bar says in each stage of a job
+STAGE_TEXT = {
+    "describe": "📷 Generating descriptions with GPT-4 Vision",
+    "extract": "📄 Extracting text from the slides",
+    "summarize": "📝 Generating summary",
+    "structurize": "⛏️ Extracting headings and values",
+}
+
+# Slides per Vision request when batching is on
+BATCH_SLIDES = 4
 
-# Import GPT-4 summarizer module
-from gpt4_summarizer import iteratively_summarize, n_chunks
 
-# Import response parser module
-from response_parser import structurize_summary
+# One client for all sessions, it only holds a connection pool
+@st.cache_resource
+def get_job_client():
+    return JobClient()
+
+
+def trace_table(spans):
+    """ Where the time and money of a run went, one row per kind of span """
+    rows = []
+    for name, total in summarize_spans(spans).items():
+        rows.append({
+            "Span": name,
+            "Count": total["count"],
+            "Seconds": round(total["duration"], 2),
+            "Queue wait (s)": round(total["queue_wait"], 2),
+            "Network (s)": round(total["network"], 2),
+            "Tokens": total["prompt_tokens"] + total["completion_tokens"],
+            "Bytes": total["bytes"],
+            "Cost ($)": round(total["cost"], 4),
+        })
+    return pd.DataFrame(rows)
+
+
+def load_result(summary, structured_summary, trace=None):
+    """ Puts a finished analysis into the session state, replacing the shown one """
+    st.session_state.summary = summary
+    st.session_state['summary-json'] = structured_summary
+    st.session_state['summary-table-data'] = {}
+    st.session_state['structured-data'] = {"Heading": list(structured_summary.keys()),
+                                           "Text": list(structured_summary.values())}
+    st.session_state['trace'] = trace or []
+
+
+def search_table(hits):
+    """ One row per full-text hit in the deck store """
+    return pd.DataFrame([{
+        "Company": hit["company"] or hit["name"] or "",
+        "Found in": hit["kind"] if hit["ref"] is None else f"{hit['kind']} {hit['ref']}",
+        "Match": hit["snippet"],
+        "Deck": hit["deck_hash"][:12],
+    } for hit in hits])
 
 
 def main():
@@ -34,6 +81,13 @@ def main():
     st.title("Pitchdeck :rainbow[Summarizer] 1.0 ✨")
     st.caption(
         "This app uses OpenAI's GPT-4 to summarize pitchdecks according to a given summary template. Copyright 2024.")
+
+    # Decks are processed by the job service, so closing the tab never loses a run
+    client = get_job_client()
+    if not client.healthy():
+        st.error(f"The deck job service at {client.base_url} is not running. Start it with `python job_service.py`.", icon="🛑")
+        st.stop()
+
     api_key_holder = st.empty()
     api_key_input = None
     pdf_file = st.file_uploader("Choose a PDF file", type="pdf")
@@ -46,8 +100,7 @@ def main():
     summary_text = st.empty()
 
     # Initiate session state and input / display for API key
-    load_dotenv()
-    env_api_key = os.environ.get('OPENAI_API_KEY')
+    env_api_key = get_settings().api_key
 
     if env_api_key is not None:
         st.session_state['api_key'] = env_api_key
@@ -71,6 +124,15 @@ def main():
         st.session_state['summary-table-data'] = {}
     if 'warning' not in st.session_state:
         st.session_state['warning'] = '', ''
+    if 'trace' not in st.session_state:
+        st.session_state['trace'] = []
+    # The job id is also kept in the URL, so a reloaded tab picks up the running job
+    if 'job_id' not in st.session_state:
+        st.session_state['job_id'] = st.query_params.get('job')
+    if 'loaded_job' not in st.session_state:
+        st.session_state['loaded_job'] = None
+
+    job = client.find(st.session_state['job_id']) if st.session_state['job_id'] else None
 
     # If summary is not empty, display it, otherwise display placeholder
     if st.session_state['summary'] != '':
@@ -84,7 +146,25 @@ def main():
     summary_button_holder = st.empty()
     summary_button = summary_button_holder.button(
         'Generate Summary 🪄', disabled=True)
+    resume_button_holder = st.empty()
+    resume_button = None
+    cancel_button = None
     use_vision = st.checkbox("Use GPT-4 Vision API (costs more)")
+    use_triage = st.checkbox("Send only image-heavy slides to Vision", value=True,
+                             help="Text-heavy slides use the PDF's own text, blank and duplicate slides are skipped")
+    use_cache = st.checkbox("Reuse cached slide descriptions", value=True,
+                            help="Slides that were already described with the same settings are not sent to the API again")
+    batch_slides = st.checkbox("Describe several slides per Vision request", value=True,
+                               help="Fewer requests and prompt copies; falls back to one slide per request if an answer can't be split")
+    use_versions = st.checkbox("Reuse the analysis of an earlier version of this deck",
+                               help="Only slides that changed since the best matching analyzed version go to Vision, "
+                                    "and its summary is updated with the changes")
+    strategy = st.radio(
+        "Summarization strategy", ["refine", "map_reduce", "patch"], horizontal=True,
+        format_func=lambda name: {"refine": "Sequential refine", "map_reduce": "Parallel map-reduce (faster)",
+                                  "patch": "Section patches (fewest output tokens)"}[name])
+    show_trace = st.checkbox("Show trace of the last run",
+                             help="Time, tokens, bytes and cost of every rendering, API and parsing step")
     restructure_button_holder = st.empty()
     restructure_button = None
     export_button_holder = st.empty()
@@ -101,31 +181,56 @@ def main():
         summary_table_holder.table(pd.DataFrame(
             st.session_state['summary-table-data']))
 
-    # If PDF file is uploaded, load it and split it into pages
+    # If PDF file is uploaded, send it to the service once per upload; the service stores it by content
     if pdf_file is not None:
-        with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-            tmp_file.write(pdf_file.read())
-            pdf_path = tmp_file.name
+        upload_id = getattr(pdf_file, 'file_id', None) or (pdf_file.name, pdf_file.size)
+        upload = st.session_state.get('upload')
+        if upload is None or upload[0] != upload_id:
+            try:
+                st.session_state['upload'] = upload_id, client.upload(pdf_file)
+            except httpx.HTTPStatusError as e:
+                # E.g. a deck past the service's upload size limit
+                message_holder.error(e.response.json()['error'], icon="🚫")
+                st.stop()
+
+            # A deck analyzed before is shown right away from the deck store
+            stored = client.deck(st.session_state['upload'][1])
+            if stored is not None:
+                load_result(stored['summary'], stored['structured'])
+                st.session_state['warning'] = '', ''
+                summary_text.text_area(
+                    "**Summary**", value=stored['summary'], height=1500, disabled=True)
+                message_holder.info(
+                    f"This deck was analyzed before ({stored['cost']:.3f}$). Re-generate the summary for a new run.", icon="📚")
+        deck_hash = st.session_state['upload'][1]
 
-            summary_button_holder.empty()
-
-            # Activate the summary button
-            if st.session_state.summary == '':
-                summary_button = summary_button_holder.button(
-                    'Generate Summary 🪄', key=1)
-            else:
-                summary_button = summary_button_holder.button(
-                    'Re-generate Summary 🪄', key=2)
+        summary_button_holder.empty()
 
-    # Main block: If summary button is pressed, generate the summary
+        # Activate the summary button
+        if st.session_state.summary == '':
+            summary_button = summary_button_holder.button(
+                'Generate Summary 🪄', key=1)
+        else:
+            summary_button = summary_button_holder.button(
+                'Re-generate Summary 🪄', key=2)
+
+    # A failed or cancelled job can be continued from its last checkpoint, a running one cancelled
+    if job is not None and job['status'] in ('failed', 'cancelled'):
+        resume_button = resume_button_holder.button(
+            'Resume unfinished run ↻', key=5)
+    elif job is not None and job['status'] not in FINAL_STATUSES:
+        cancel_button = resume_button_holder.button(
+            'Cancel run ✖️', key=6)
+
+    # Submit: the summary button queues a new job
     if summary_button:
         # Use the summary template from the input
         if summary_template_input is not None:
             summary_template = summary_template_input
 
         # Check & store the API key in session state
-        if api_key_input is not "":
-            if len(api_key_input) < 30 or len(api_key) > 100:
+        if api_key_input:
+            if len(api_key_input) < 30 or len(api_key_input) > 100:
                 st.session_state['warning'] = "Invalid API key format. Please enter a valid API key.", "⚠️"
                 st.rerun()
             else:
@@ -134,70 +239,85 @@ def main():
             st.session_state["warning"] = "No API key provided. Please enter an API key.", "⚠️"
             st.rerun()
 
-        # Empty message & warning state
+        options = {
+            "use_vision": use_vision, "triage": use_triage, "use_cache": use_cache, "use_versions": use_versions,
+            "strategy": strategy, "summary_template": summary_template, "structurize": True,
+            "batch_slides": BATCH_SLIDES if batch_slides else 1,
+        }
+        # A key read from .env is the service's own key as well
+        job_api_key = None if env_api_key else st.session_state['api_key']
+        try:
+            job = client.submit(deck_hash, options, api_key=job_api_key, filename=pdf_file.name)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+            # The service evicted the upload since, it is sent again
+            deck_hash = client.upload(pdf_file)
+            job = client.submit(deck_hash, options, api_key=job_api_key, filename=pdf_file.name)
+        st.session_state['job_id'] = job['id']
+        st.query_params['job'] = job['id']
+        st.session_state['summary-template'] = summary_template
         st.session_state['warning'] = '', ''
-        message_holder.empty()
-        
-        cost_descriptions = 0
-
-        # UsePyPDF or Vision to get text from slides
-        if not use_vision:
-            # Use basic PyPDF from Langchain to get text from slides
-            loader = PyPDFLoader(pdf_path)
-            pages = loader.load_and_split()
-            combined_content = ''.join([p.page_content for p in pages])
-        else:
-            #Indicate page count
-            n_pages = get_pdf_page_count(pdf_path)
-            message_holder.info(
-                f"Generating descriptions with GPT-4 Vision for {n_pages} pages...", icon="📷")
-
-            # Use VisionAnalyzer to get descriptions of slides
-            with st.spinner("Working..."):
-                descriptions, cost_descriptions = get_descriptions(
-                    pdf_path, delete_temp_files=True, api_key=st.session_state['api_key'])
-
-            # If the descriptions didn't finish, display a warning
-            if descriptions == []:
-                st.session_state['warning'] = "Description generation with vision didn't finish. Check connection and try again.", "⚠️"
-                st.rerun()
-            else:
-                message_holder.empty()
-                combined_content = "\n\n".join(descriptions)
+        st.rerun()
 
-        # Indicate the number of steps for summarization
-        steps_n = n_chunks(combined_content)
-        message_holder.info(
-            f"Generating summary in {steps_n} steps...", icon="📝")
-        summary_button_holder.empty()
+    if resume_button:
+        client.retry(job['id'], api_key=None if env_api_key else st.session_state['api_key'])
+        st.session_state['warning'] = '', ''
+        st.rerun()
 
-        # Generate the summary
-        with st.spinner("Working..."):
-            summary, cost_summary, finished = iteratively_summarize(
-                combined_content, summary_template=summary_template, api_key=st.session_state['api_key'])
+    if cancel_button:
+        client.cancel(job['id'])
+        st.rerun()
 
-        # If the summary didn't finish, display a warning
-        # TODO: Add a button to rerun from the last step
-        if not finished:
-            st.session_state['warning'] = "Summary generation didn't finish. Check connection and try again.", "⚠️"
-            st.rerun()
+    # Poll the job until it ends; a rerun or closed tab only stops the polling, not the job
+    if job is not None and st.session_state['loaded_job'] != job['id']:
+        if job['status'] not in FINAL_STATUSES:
+            summary_button_holder.empty()
+            progress_bar = message_holder.progress(0.0, text="⏳ Queued...")
+
+            def show_progress(job):
+                progress = job['progress']
+                stage = STAGE_TEXT.get(progress.get('stage'), "⏳ Queued")
+                if progress.get('steps'):
+                    progress_bar.progress(progress['step'] / progress['steps'],
+                                          text=f"{stage}: step {progress['step']}/{progress['steps']} done")
+                else:
+                    progress_bar.progress(0.0, text=f"{stage}...")
+                # The summary of the current step as it streams in, else the one of the last finished step
+                if progress.get('partial') or progress.get('summary'):
+                    with summary_text.container():
+                        st.caption("**Summary** (generating...)")
+                        st.text(progress.get('partial') or progress['summary'])
+
+            job = client.wait(job['id'], poll_interval=0.5, on_progress=show_progress)
+
+        if job['status'] == 'done':
+            result = client.result(job['id'])
+            summary = result['summary']
+            structured_summary = result['structured']
+
+            # Store the summary and its structured form in session state
+            load_result(summary, structured_summary, result.get('trace'))
+            st.session_state['loaded_job'] = job['id']
+
+            # Display the summary as a new text area
+            summary_text.text_area(
+                "**Summary**", value=summary, height=1500, disabled=True)
+            summary_table_holder.empty()
+
+            # Display cost
+            message_holder.success(
+                f"Summary generated. Total cost: {job['cost']:.3f}$ (approx.)", icon="✅")
+
+            # Re-activate the summary button
+            if pdf_file is not None:
+                summary_button_holder.button(
+                    'Re-generate Summary 🪄', key=3)
+        elif job['status'] == 'failed':
+            st.session_state['warning'] = f"The run didn't finish ({job['error']}). Check connection and resume the run.", "⚠️"
+            message_holder.warning(st.session_state['warning'][0], icon=st.session_state['warning'][1])
         else:
-            message_holder.empty()
-
-        # Display the summary as a new text area
-        summary_text.text_area(
-            "**Summary**", value=summary, height=1500, disabled=True)
-
-        # Store the summary in session state
-        st.session_state.summary = summary
-        
-        # Display cost
-        message_holder.success(
-            f"Summary generated. Total cost: {cost_descriptions + cost_summary:.3f}$ (approx.)", icon="✅")
-
-        # Re-activate the summary button
-        summary_button = summary_button_holder.button(
-            'Re-generate Summary 🪄', key=3)
+            message_holder.warning("The run was cancelled. It can be resumed from where it stopped.", icon="⚠️")
 
     # If summary generated, display export button & restructure button
     # Currently disabled as the export function is WIP
@@ -207,22 +327,9 @@ def main():
         restructure_button = restructure_button_holder.button(
             'Extract headings and values ⛏️')
 
-    # If restructure button is pressed, parse the summary and display it as a table
+    # If restructure button is pressed, display the headings and values the job extracted as a table
     if restructure_button:
-        # Indicate started processing
-        message_holder.info("Processing summary in 1 step", icon="⛏️")
-        
-        # Parse the summary
-        with st.spinner("Working..."):
-            structured_summary, cost = structurize_summary(
-                st.session_state.summary, api_key=st.session_state['api_key'])
-        message_holder.empty()
-
-        # Store structured summary in session state
-        st.session_state['summary-json'] = structured_summary
-
-        # Flip structure to table format
-        data = {"Heading": structured_summary.keys(), "Text": structured_summary.values()}
+        data = st.session_state.get('structured-data', {})
         st.session_state['summary-table-data'] = data
 
         # Display the summary as a table
@@ -233,6 +340,21 @@ def main():
         restructure_button_holder.button(
             'Extract headings and values ⛏️', disabled=True, key=4)
 
+    # Trace panel: where the minutes and dollars of the last run went
+    if show_trace and st.session_state['trace']:
+        with st.expander("Trace of the last run", expanded=True):
+            st.dataframe(trace_table(st.session_state['trace']), hide_index=True)
+
+    # Search across every deck the service analyzed
+    with st.expander("Search analyzed decks 🔎"):
+        query = st.text_input("Words in memos, slides or headings", placeholder="e.g. battery recycling")
+        if query:
+            hits = client.search(query)
+            if hits:
+                st.dataframe(search_table(hits), hide_index=True)
+            else:
+                st.caption("No analyzed deck matches.")
+
     # If export button is pressed, export the summary to Google Drive with drive_export.py
     # if export_button:
 
@@ -0,0 +1,30 @@
+from batch_mode import BatchPipeline, BatchOptions, run_pipeline, STAGE_DONE
+from benchmark import make_deck
+from deck_store import DeckStore
+from mock_openai_server import MockOpenAIServer, MockSettings
+
+
+MOCK_API_KEY = "sk-mock-batch-test-00000000000000000000"
+
+
+def test_rounds_go_through_files_and_batches(tmp_path, monkeypatch):
+    paths = [make_deck(str(tmp_path / f"deck_{i}.pdf"), 3, seed=i) for i in range(2)]
+    options = BatchOptions(use_cache=False, max_shard_requests=4)
+
+    with MockOpenAIServer(MockSettings(latency="fixed:0.01", batch_delay=0.1, seed=1)) as server:
+        monkeypatch.setenv("OPENAI_BASE_URL", server.url)
+        pipeline = BatchPipeline.start(str(tmp_path / "work"), paths, options)
+        run_pipeline(pipeline, "openai", api_key=MOCK_API_KEY, poll_interval=0.05)
+        batches = list(server.batches.values())
+
+    decks = list(BatchPipeline(str(tmp_path / "work")).decks.values())
+    assert [deck["stage"] for deck in decks] == [STAGE_DONE, STAGE_DONE]
+    assert all(deck["summary"] and deck["structured"] and deck["cost"] > 0 for deck in decks)
+    # Six vision requests in shards of at most four, then the summaries; the headings parse locally
+    assert len(batches) == 3 and all(batch["status"] == "completed" for batch in batches)
+    assert pipeline.state["pending"] is None
+
+    store = DeckStore(str(tmp_path / "decks.sqlite3"))
+    assert pipeline.store_results(store) == 2
+    assert len(decks[0]["descriptions"]) == 3 and store.get(decks[0]["deck_hash"])["summary"] == decks[0]["summary"]
+    store.close()
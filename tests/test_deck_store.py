@@ -0,0 +1,60 @@
+import pytest
+
+from deck_store import DeckStore, KIND_SLIDE, KIND_FIELD
+
+
+ACME, BOLT = "a" * 64, "b" * 64
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = DeckStore(str(tmp_path / "decks.sqlite3"))
+    store.put(ACME, "Light memo: Acme Robotics\nAcme builds warehouse robots.",
+              {"Light memo": "Acme Robotics", "Stage": "Seed", "Problem": "Picking is slow"},
+              ["Slide 1:\nAcme Robotics", "Slide 2:\nRobots picking parcels in warehouses"], name="acme.pdf", cost=0.5)
+    store.put(BOLT, "Light memo: Bolt Energy\nBolt stores solar power.",
+              {"Light memo": "Bolt Energy", "Stage": "Series A", "Problem": ""},
+              ["Slide 1:\nBattery storage"], name="bolt.pdf")
+    yield store
+    store.close()
+
+
+def test_put_and_get_round_trip(store):
+    deck = store.get(ACME)
+
+    assert deck["company"] == "Acme Robotics" and deck["name"] == "acme.pdf" and deck["slides"] == 2
+    assert deck["structured"] == {"Light memo": "Acme Robotics", "Stage": "Seed", "Problem": "Picking is slow"}
+    assert deck["descriptions"] == ["Slide 1:\nAcme Robotics", "Slide 2:\nRobots picking parcels in warehouses"]
+    assert store.get("c" * 64) is None
+
+
+def test_put_again_replaces_the_deck(store):
+    created = store.get(ACME)["created"]
+    store.put(ACME, "Light memo: Acme\nNew memo.", {"Stage": "Series A"})
+
+    deck = store.get(ACME)
+    assert deck["structured"] == {"Stage": "Series A"} and deck["descriptions"] == [] and deck["created"] == created
+    assert store.search("warehouse") == []
+    assert store.counts() == {"decks": 2, "slides": 1, "fields": 4}
+
+
+def test_search_matches_stemmed_words_and_kinds(store):
+    hits = store.search("warehouse")
+    assert {hit["deck_hash"] for hit in hits} == {ACME}
+    assert {hit["kind"] for hit in hits} == {"summary", KIND_SLIDE}
+
+    slide = store.search("pick parcel", kind=KIND_SLIDE)
+    assert [(hit["deck_hash"], hit["ref"]) for hit in slide] == [(ACME, "2")]
+    assert "[parcels]" in slide[0]["snippet"]
+    assert [hit["ref"] for hit in store.search("seri*", kind=KIND_FIELD)] == ["Stage"]
+    assert store.search("") == []
+
+
+def test_lookups_by_company_and_heading(store):
+    assert [deck["deck_hash"] for deck in store.list(company="acme")] == [ACME]
+    assert [deck["deck_hash"] for deck in store.list(company="100%")] == []
+
+    assert {deck["deck_hash"] for deck in store.field("stage")} == {ACME, BOLT}
+    assert [deck["value"] for deck in store.field("Stage:", value="series")] == ["Series A"]
+    # Empty values don't count as having the heading
+    assert [deck["deck_hash"] for deck in store.field("Problem")] == [ACME]
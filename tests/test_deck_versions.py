@@ -0,0 +1,45 @@
+import os
+import hashlib
+
+import deck_versions
+from deck_versions import save_version, find_previous_version, evict_versions, VERSION_INDEX
+
+
+def signature(page_number, text, dhash):
+    return {"page_number": page_number, "dhash": dhash, "text": text,
+            "text_hash": hashlib.sha256(text.encode()).hexdigest()[:16]}
+
+
+def version(deck_hash, pages):
+    return {"deck_hash": deck_hash, "name": f"{deck_hash}.pdf", "created": 0.0, "previous": None, "summary": "",
+            "summary_template": None, "pages": [dict(page, description=page["text"]) for page in pages]}
+
+
+def test_only_versions_sharing_page_hashes_are_read(tmp_path, monkeypatch):
+    folder = str(tmp_path)
+    for i in range(30):
+        save_version(version(f"other{i}", [signature(n, f"deck {i} slide {n}", f"{i:08x}{n:08x}") for n in (1, 2, 3)]), folder)
+    old = [signature(1, "acme robots", "f0f0f0f0f0f0f0f0"), signature(2, "market size", "0f0f0f0f0f0f0f0f"),
+           signature(3, "team", "00ff00ff00ff00ff")]
+    save_version(version("acme1", old), folder)
+
+    loaded = []
+    load_version = deck_versions.load_version
+    monkeypatch.setattr(deck_versions, "load_version", lambda deck_hash, folder: loaded.append(deck_hash) or load_version(deck_hash, folder))
+    # Page 2 is re-exported (dHash off by a bit), page 3 is new
+    new = [old[0], signature(2, "market size", "0f0f0f0f0f0f0f0e"), signature(3, "financials", "123456789abcdef0")]
+
+    assert find_previous_version(new, folder)["deck_hash"] == "acme1"
+    assert loaded == ["acme1"]
+
+
+def test_versions_stored_before_the_index_and_evicted_ones(tmp_path):
+    folder = str(tmp_path)
+    pages = [signature(1, "acme robots", "f0f0f0f0f0f0f0f0")]
+    save_version(version("acme1", pages), folder)
+    os.remove(os.path.join(folder, VERSION_INDEX))
+
+    assert find_previous_version(pages, folder)["deck_hash"] == "acme1"
+
+    assert len(evict_versions(max_bytes=0, max_age=None, folder=folder)) == 1
+    assert find_previous_version(pages, folder) is None
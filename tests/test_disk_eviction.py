@@ -0,0 +1,42 @@
+import os
+import time
+
+from disk_eviction import evict_files
+from job_service import JobStore, JobOptions, DiskLimits, evict_disk, upload_path
+from run_checkpoint import save_checkpoint, CHECKPOINT_FOLDER
+
+
+def write_file(path, size, age):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    modified = time.time() - age
+    os.utime(path, (modified, modified))
+
+
+def test_old_files_go_then_least_recently_modified_past_max_bytes(tmp_path):
+    for name, age in [("a", 500), ("b", 300), ("c", 200), ("d", 100), ("e", 0)]:
+        write_file(str(tmp_path / f"{name}.pdf"), 100, age)
+
+    removed = evict_files(str(tmp_path), "*.pdf", max_bytes=200, max_age=400, keep={"b.pdf"})
+
+    assert sorted(os.path.basename(path) for path in removed) == ["a.pdf", "c.pdf"]
+    assert sorted(os.listdir(tmp_path)) == ["b.pdf", "d.pdf", "e.pdf"]
+
+
+def test_files_of_active_jobs_are_kept(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = JobStore("jobs.sqlite3")
+    active_hash, finished_hash = "a" * 64, "f" * 64
+    write_file(upload_path(active_hash), 100, 30 * 24 * 3600)
+    write_file(upload_path(finished_hash), 100, 30 * 24 * 3600)
+    job_id = store.submit(active_hash, JobOptions())
+    save_checkpoint(f"job-{job_id}", "summary", {})
+    save_checkpoint("old-run", "summary", {})
+    for name in os.listdir(CHECKPOINT_FOLDER):
+        os.utime(os.path.join(CHECKPOINT_FOLDER, name), (0, 0))
+
+    assert evict_disk(store, DiskLimits()) == 2
+    assert os.path.exists(upload_path(active_hash)) and not os.path.exists(upload_path(finished_hash))
+    assert os.listdir(CHECKPOINT_FOLDER) == [f"job-{job_id}.summary.json"]
+    store.close()
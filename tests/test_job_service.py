@@ -0,0 +1,18 @@
+import httpx
+
+from job_service import JobService, JobStore, MAX_LIST_LIMIT
+from deck_store import DeckStore
+
+
+def test_limit_is_validated_and_capped(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    decks = DeckStore("decks.sqlite3")
+    for i in range(MAX_LIST_LIMIT + 5):
+        decks.put(f"{i:064x}", f"Light memo: Company {i}")
+
+    with JobService(JobStore("jobs.sqlite3"), workers=1, port=0, upload_folder="uploads", decks=decks) as service:
+        for limit in ("abc", "0", "-1", "2.5"):
+            response = httpx.get(f"{service.url}/jobs?limit={limit}")
+            assert response.status_code == 400 and "limit" in response.json()["error"]
+        assert len(httpx.get(f"{service.url}/decks?limit={MAX_LIST_LIMIT * 10}").json()["decks"]) == MAX_LIST_LIMIT
+        assert len(httpx.get(f"{service.url}/decks?limit=3").json()["decks"]) == 3
@@ -0,0 +1,42 @@
+import asyncio
+
+import openai_session
+import request_scheduler
+from openai_session import get_settings, get_openai_client, get_async_openai_client, close_async_client, forget_api_key
+from request_scheduler import get_scheduler, get_completion_limiter, key_id
+
+
+USER_KEY = "sk-user-0000000000000000000000000000"
+
+
+def cached_keys():
+    async_keys = [key for clients in openai_session._async_openai_clients.values() for key in clients]
+    return [*openai_session._settings, *openai_session._openai_clients, *async_keys,
+            *request_scheduler._schedulers, *request_scheduler._limiters]
+
+
+def user_entries():
+    # Settings and clients are keyed by (key_id, base_url), the rate limits by key_id
+    user = key_id(USER_KEY)
+    return [key for key in cached_keys() if key == user or isinstance(key, tuple) and key[0] == user]
+
+
+def test_user_keys_are_not_kept_in_caches():
+    async def use_key():
+        get_async_openai_client(USER_KEY)
+        assert USER_KEY not in repr(cached_keys())
+        forget_api_key(USER_KEY)
+        assert user_entries() == []
+        await close_async_client()
+
+    settings = get_settings(USER_KEY)
+    get_openai_client(USER_KEY)
+    get_scheduler(settings.api_key)
+    get_completion_limiter(settings.api_key)
+    assert USER_KEY not in repr(cached_keys())
+    assert len(user_entries()) == 4
+
+    forget_api_key(USER_KEY)
+    assert user_entries() == []
+    asyncio.run(use_key())
+    assert user_entries() == []
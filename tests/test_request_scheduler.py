@@ -0,0 +1,95 @@
+import asyncio
+
+import httpx
+
+import request_scheduler
+from request_scheduler import TokenBucket, RequestScheduler, RateLimits
+
+
+class FakeTime:
+    """ Stands in for the time module in request_scheduler; sleeping advances it """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    perf_counter = monotonic
+    time = monotonic
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def fake_clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(request_scheduler, "time", clock)
+    monkeypatch.setattr(request_scheduler.asyncio, "sleep", clock.sleep)
+    return clock
+
+
+def responses(*statuses, headers=None):
+    sent = []
+
+    async def send():
+        sent.append(len(sent))
+        return httpx.Response(statuses[len(sent) - 1], headers=headers or {})
+    return send, sent
+
+
+def test_bucket_waits_for_refill(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    bucket = TokenBucket(per_minute=60)
+
+    assert bucket.reserve(60) == 0.0
+    assert bucket.reserve(1) == 1.0
+    clock.now += 30
+    assert bucket.reserve(10) == 0.0
+    # Larger than the whole bucket: takes what a full bucket holds
+    assert bucket.reserve(500) == 41.0
+
+
+def test_429_waits_retry_after_and_blocks_the_key(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    scheduler = RequestScheduler(RateLimits(base_delay=0.0))
+    send, sent = responses(429, 429, 200, headers={"retry-after": "2"})
+
+    response = asyncio.run(scheduler.run(send))
+
+    assert response.status_code == 200 and len(sent) == 3
+    assert [seconds for seconds in clock.sleeps if seconds > 0] == [2.0, 2.0]
+    assert scheduler.blocked_until == 1004.0
+
+
+def test_5xx_backs_off_exponentially_until_retries_run_out(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    scheduler = RequestScheduler(RateLimits(max_retries=3, base_delay=1.0, max_delay=3.0))
+    send, sent = responses(503, 503, 503, 503)
+
+    response = asyncio.run(scheduler.run(send))
+
+    assert response.status_code == 503 and len(sent) == 4
+    delays = [seconds for seconds in clock.sleeps if seconds > 0]
+    assert [low <= delay <= high for delay, (low, high) in zip(delays, [(0.5, 1), (1, 2), (1.5, 3)])] == [True] * 3
+    assert scheduler.blocked_until == 0.0
+
+
+def test_concurrency_is_capped():
+    scheduler = RequestScheduler(RateLimits(max_concurrency=2, requests_per_minute=10_000))
+    running, peak = [0], [0]
+
+    async def send():
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        await asyncio.sleep(0.01)
+        running[0] -= 1
+        return httpx.Response(200)
+
+    async def main():
+        return await asyncio.gather(*(scheduler.run(send) for _ in range(6)))
+
+    assert len(asyncio.run(main())) == 6
+    assert peak[0] == 2
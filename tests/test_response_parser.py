@@ -0,0 +1,42 @@
+from response_parser import structurize_locally, parse_sections, template_headings
+from prompt_templates.default_summary_template import default_summary_template
+
+
+def test_bullets_named_like_headings_stay_in_their_section():
+    summary = "\n".join([
+        "Light memo: Acme",
+        "Stage: Seed",
+        "Summary:",
+        "Acme builds robots.",
+        "- Stage: raising Series A now",
+        "- Problem: warehouses lack staff",
+        "Problem: Picking is slow and expensive",
+        "Product & Business model: Robots as a service",
+    ])
+    structured = structurize_locally(summary, max_missing_ratio=1.0)
+
+    assert structured["Stage"] == "Seed"
+    assert structured["Summary"] == "\n".join([
+        "Acme builds robots.", "- Stage: raising Series A now", "- Problem: warehouses lack staff"])
+    assert structured["Problem"] == "Picking is slow and expensive"
+    assert structured["Product & Business model"] == "Robots as a service"
+
+
+def test_repeated_heading_does_not_end_or_replace_a_section():
+    headings = template_headings(default_summary_template())
+    summary = "Summary: first\nProblem: real problem\nmore\nSummary: again\nFinancials: none"
+
+    sections = parse_sections(summary, headings)
+
+    assert sections["Summary"] == "first"
+    assert sections["Problem"] == "real problem\nmore\nSummary: again"
+    assert sections["Financials"] == "none"
+
+
+def test_markdown_headings():
+    headings = template_headings(default_summary_template())
+    summary = "## Summary\nshort\n**Problem:** slow\n**Market & Competition**\nbig"
+
+    sections = parse_sections(summary, headings)
+
+    assert sections == {"Summary": "short", "Problem": "slow", "Market & Competition": "big"}
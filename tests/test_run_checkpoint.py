@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+import vision_analyzer
+from benchmark import make_deck
+from gpt4_summarizer import summarize_async
+from vision_analyzer import get_descriptions_async
+from run_checkpoint import load_checkpoint
+from openai_session import close_async_client
+from mock_openai_server import MockOpenAIServer, MockSettings
+
+
+class Stop(Exception):
+    pass
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # Checkpoints go to .cache/checkpoints under the working directory
+    monkeypatch.chdir(tmp_path)
+    with MockOpenAIServer(MockSettings(latency="fixed:0.01", token_latency=0.0, seed=1)) as server:
+        monkeypatch.setenv("OPENAI_BASE_URL", server.url)
+        yield server
+
+
+def run(coroutine_function, *args, **kwargs):
+    async def main():
+        try:
+            return await coroutine_function(*args, **kwargs)
+        finally:
+            await close_async_client()
+    return asyncio.run(main())
+
+
+def test_summary_resumes_after_the_last_finished_step(server):
+    text = "\n\n".join(f"Slide {i}:\n" + f"point {i} " * 200 for i in range(1, 6))
+    options = dict(strategy="refine", api_key="sk-mock-resume-summary-000000000000000", run_id="run1", max_chunk_tokens=500)
+
+    def stop_after_two(step, steps, summary):
+        if step == 2:
+            raise Stop()
+
+    with pytest.raises(Stop):
+        run(summarize_async, text, iter_callback=stop_after_two, **options)
+    state = load_checkpoint("run1", "summary")
+    assert state["step"] == 2 and len(state["chunks"]) > 3
+    sent = server.stats.requests
+
+    steps = []
+    summary, cost, finished = run(summarize_async, "", iter_callback=lambda step, *_: steps.append(step), **options)
+
+    assert finished and summary
+    assert steps == list(range(3, len(state["chunks"]) + 1))
+    assert server.stats.requests - sent == len(state["chunks"]) - 2
+
+
+def test_vision_resends_only_pages_without_a_description(server, tmp_path, monkeypatch):
+    pdf_path = make_deck(str(tmp_path / "deck.pdf"), 5, seed=1)
+    options = dict(api_key="sk-mock-resume-vision-0000000000000000", use_cache=False, run_id="run2")
+    interpret_image = vision_analyzer.interpret_image
+
+    async def fail_some(client, image_bytes, prompt, page_number=None, **kwargs):
+        if page_number in (2, 4):
+            return "", 0.0
+        return await interpret_image(client, image_bytes, prompt, page_number=page_number, **kwargs)
+
+    monkeypatch.setattr(vision_analyzer, "interpret_image", fail_some)
+    descriptions, _ = run(get_descriptions_async, pdf_path, **options)
+    assert descriptions == []
+    assert sorted(load_checkpoint("run2", "vision")["descriptions"]) == ["1", "3", "5"]
+
+    monkeypatch.setattr(vision_analyzer, "interpret_image", interpret_image)
+    sent = server.stats.requests
+    descriptions, _ = run(get_descriptions_async, pdf_path, **options)
+
+    assert len(descriptions) == 5 and all(descriptions)
+    assert server.stats.requests - sent == 2
@@ -0,0 +1,27 @@
+from text_chunker import plan_chunks, estimate_tokens
+
+
+def test_word_longer_than_budget_is_cut():
+    blob = "x" * 5000
+    chunks = plan_chunks("Slide 1:\nintro words here " + blob + " tail", 200)
+
+    assert all(estimate_tokens(chunk) <= 200 for chunk in chunks)
+    assert "".join(chunks).replace(" ", "") == ("Slide 1:\nintro words here " + blob + " tail").replace(" ", "")
+
+
+def test_slides_are_packed_whole():
+    text = "\n\n".join(f"Slide {i}:\n" + "word " * 50 for i in range(1, 7))
+    chunks = plan_chunks(text, 150)
+
+    assert len(chunks) == 3
+    assert all(chunk.startswith("Slide ") for chunk in chunks)
+
+
+def test_oversized_slide_keeps_its_line_breaks():
+    text = "Slide 1:\n" + "\n".join(f"- point {i} " + "detail " * 10 + "end." for i in range(40))
+    chunks = plan_chunks(text, 150)
+
+    assert len(chunks) > 1 and all(estimate_tokens(chunk) <= 150 for chunk in chunks)
+    # Every bullet still starts a line, within its chunk or at the start of one
+    assert sum(chunk.count("\n- ") + chunk.startswith("- ") for chunk in chunks) == text.count("\n- ")
+    assert " ".join(chunks).split() == text.split()
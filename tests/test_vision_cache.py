@@ -0,0 +1,33 @@
+import vision_cache
+from vision_cache import DescriptionCache
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+def test_least_recently_used_and_expired_entries_are_evicted(tmp_path, monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(vision_cache, "time", clock)
+    cache = DescriptionCache(str(tmp_path / "cache.sqlite3"), max_bytes=300, max_age_days=1)
+
+    for key in "abc":
+        cache.put(key, key * 100)
+        clock.now += 60
+    # a is used again, so b is now the least recently used
+    assert cache.get("a") == "a" * 100
+    cache.put("d", "d" * 100)
+
+    assert [cache.get(key) is not None for key in "abcd"] == [True, False, True, True]
+    assert cache.stats()["bytes"] == 300 and cache.stats()["entries"] == 3
+
+    # A day later a, c and d have expired, the new entry is all that's left
+    clock.now += 24 * 3600 + 1
+    cache.put("e", "é" * 50)
+    assert cache.stats()["entries"] == 1 and cache.stats()["bytes"] == 100
+    assert cache.get("a") is None and cache.get("e") == "é" * 50
+    cache.close()
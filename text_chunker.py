@@ -0,0 +1,130 @@
+import re
+from math import ceil
+
+
+# Context window sizes in tokens
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-1106-preview": 128000,
+    "gpt-4-turbo-preview": 128000,
+    "gpt-3.5-turbo": 16385,
+}
+
+# Tokens reserved for the model's answer, i.e. one summary memo
+DEFAULT_OUTPUT_TOKENS = 1500
+
+# The estimate below is rough, keep some headroom in every chunk
+SAFETY_MARGIN = 0.9
+
+MIN_CHUNK_TOKENS = 256
+
+# Words, short digit groups and single punctuation marks each tend to be a token of their own
+TOKEN_PIECES = re.compile(r"[^\W\d_]+|\d{1,3}|[^\w\s]")
+
+SLIDE_START = re.compile(r"^(?=Slide \d+:)", re.MULTILINE)
+PARAGRAPH_END = re.compile(r"(?<=\n)\s*\n")
+SENTENCE_END = re.compile(r"(?<=[.!?\n])(\s+)")
+WORD_END = re.compile(r"(\s+)")
+
+
+def _token_weight(text):
+    return max(len(text) / 4, len(TOKEN_PIECES.findall(text)))
+
+
+def estimate_tokens(text):
+    """ Offline token count estimate, errs on the high side for numbers and punctuation """
+    return ceil(_token_weight(text))
+
+
+def chunk_token_budget(prompt_overhead, model="gpt-4", summary_tokens=DEFAULT_OUTPUT_TOKENS,
+                       output_tokens=DEFAULT_OUTPUT_TOKENS, max_chunk_tokens=None):
+    """
+    Tokens left for the deck text in one prompt: the model context minus the prompt
+    instructions and template, the running summary sent along and the answer.
+    """
+    context = MODEL_CONTEXT_TOKENS.get(model, MODEL_CONTEXT_TOKENS["gpt-4"])
+    budget = int((context - estimate_tokens(prompt_overhead) - summary_tokens - output_tokens) * SAFETY_MARGIN)
+    if max_chunk_tokens is not None:
+        budget = min(budget, max_chunk_tokens)
+    return max(budget, MIN_CHUNK_TOKENS)
+
+
+def _split_keep(text, pattern):
+    return [part for part in pattern.split(text) if part.strip()]
+
+
+def split_units(text):
+    """ Splits text into whole slides ("Slide N:" descriptions) or, failing that, paragraphs """
+    units = _split_keep(text, SLIDE_START)
+    if len(units) > 1:
+        return units
+    return _split_keep(text, PARAGRAPH_END)
+
+
+def _split_after(text, pattern):
+    # Each piece keeps the whitespace that followed it (pattern captures it), so line breaks and bullets survive
+    parts = pattern.split(text) + [""]
+    return [parts[i] + parts[i + 1] for i in range(0, len(parts) - 1, 2) if parts[i].strip()]
+
+
+def _split_oversized(unit, budget):
+    # Sentences first, then words, so only a single enormous word is ever cut
+    pieces = _split_after(unit, SENTENCE_END)
+    if len(pieces) == 1:
+        pieces = _split_after(unit, WORD_END)
+    if len(pieces) <= 1:
+        # No split makes progress: cut the text, never more tokens than characters
+        text = pieces[0].strip() if pieces else ""
+        return [text[i:i + budget] for i in range(0, len(text), budget)]
+    return pack(pieces, budget, separator="")
+
+
+def iter_chunks(units, budget, separator="\n\n"):
+    """
+    Greedily packs consecutive units into chunks of at most budget tokens. Units are
+    consumed lazily and each chunk is yielded as soon as it is full, so a generator
+    of slides is never held in memory as a whole.
+    """
+    current, current_tokens = [], 0
+
+    def flush():
+        chunk = separator.join(current).strip()
+        current.clear()
+        return chunk
+
+    for unit in units:
+        unit = unit.strip() if separator else unit
+        tokens = _token_weight(unit)
+
+        if tokens > budget:
+            if current:
+                yield flush()
+                current_tokens = 0
+            yield from (chunk for chunk in _split_oversized(unit, budget) if chunk)
+            continue
+
+        if current and current_tokens + tokens > budget:
+            yield flush()
+            current_tokens = 0
+
+        current.append(unit)
+        current_tokens += tokens
+
+    if current:
+        yield flush()
+
+
+def pack(units, budget, separator="\n\n"):
+    """ Greedily packs consecutive units into chunks of at most budget tokens """
+    return [chunk for chunk in iter_chunks(units, budget, separator) if chunk]
+
+
+def plan_chunks(text, budget):
+    """
+    The chunk plan for a text: whole slides / paragraphs packed up to budget tokens each.
+    text may also be an iterable of sections (e.g. a generator of "Slide N:" descriptions),
+    which are packed as they come without joining them into one string first.
+    """
+    units = split_units(text) if isinstance(text, str) else text
+    return pack(units, budget)
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+# Set by configure_tracing; child processes (e.g. render workers) inherit it
+TRACE_FILE_ENV = "DECK_TRACE_FILE"
+
+# Numeric span attributes summed up by summarize_spans
+METRICS = ("duration", "queue_wait", "network", "prompt_tokens", "completion_tokens", "bytes", "cost")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_collectors = contextvars.ContextVar("span_collectors", default=())
+_write_lock = threading.Lock()
+
+
+class Span:
+    """ One timed pipeline operation; attributes hold its counts, sizes and cost """
+
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.attributes = attributes
+        self.collectors = _collectors.get()
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, **amounts):
+        """ Increments numeric attributes, e.g. span.add(queue_wait=0.4, attempts=1) """
+        for key, amount in amounts.items():
+            self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.started,
+            "duration": self.duration,
+            "pid": os.getpid(),
+            **self.attributes,
+        }
+
+
+def configure_tracing(path):
+    """ Appends finished spans as JSON lines to path (None turns the trace file off) """
+    if path:
+        os.environ[TRACE_FILE_ENV] = os.path.abspath(path)
+    else:
+        os.environ.pop(TRACE_FILE_ENV, None)
+
+
+def reset_context():
+    """ Starts worker processes without spans; forked workers otherwise inherit whichever span was current """
+    _current_span.set(None)
+    _collectors.set(())
+
+
+def current_span():
+    return _current_span.get()
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process since it started, in bytes; None where the
+    platform doesn't report it. Render pool workers are separate processes and not
+    included, and in a long-running process it covers everything run so far, so it is
+    a figure for a whole run, never for one deck or job.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+def _emit(span):
+    record = span.to_dict()
+    for collector in span.collectors:
+        collector.append(record)
+
+    path = os.environ.get(TRACE_FILE_ENV)
+    if path:
+        line = json.dumps(record, default=str) + "\n"
+        # One write per line in append mode, so processes sharing the file don't interleave lines
+        with _write_lock, open(path, "a", encoding="utf-8") as trace_file:
+            trace_file.write(line)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the block as a child of the current span. Attributes set on the
+    yielded span (tokens, bytes, cost...) end up in the trace record.
+    """
+    current = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        current.duration = time.perf_counter() - current._start
+        _current_span.reset(token)
+        _emit(current)
+
+
+@contextmanager
+def collect_spans():
+    """ Collects the records of the spans finished in this context (and tasks started from it) into a list """
+    spans = []
+    token = _collectors.set(_collectors.get() + (spans,))
+    try:
+        yield spans
+    finally:
+        _collectors.reset(token)
+
+
+def summarize_spans(spans):
+    """ Totals of the METRICS per span name, in order of first appearance """
+    totals = {}
+    for record in spans:
+        total = totals.setdefault(record["name"], {"count": 0, **{metric: 0 for metric in METRICS}})
+        total["count"] += 1
+        for metric in METRICS:
+            total[metric] += record.get(metric) or 0
+    return totals
+
+
+def read_trace(path):
+    with open(path, encoding="utf-8") as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
@@ -1,17 +1,26 @@
-import os
-from dotenv import load_dotenv
+import json
 import base64
-import time
+from dataclasses import dataclass
 
 import fitz
-from PIL import Image
-import io
 
-import httpx
 import asyncio
 from tqdm.asyncio import tqdm
 
-from prompt_templates.vision_prompt import default_vision_prompt as main_prompt
+from prompt_templates.vision_prompt import default_vision_prompt as main_prompt, batch_vision_prompt
+from page_renderer import render_pdf_pages, mime_type, sniff_format, image_detail, estimate_image_tokens
+from render_pipeline import PageRenderPipeline, get_render_pool, DEFAULT_MAX_INFLIGHT_BYTES
+from request_scheduler import get_scheduler, configure_rate_limits
+from openai_session import get_settings, get_async_client, run_sync
+from vision_cache import cache_key, get_default_cache
+from run_checkpoint import load_checkpoint, save_checkpoint
+from page_triage import triage_pages, merge_descriptions, PAGE_VISION
+from tracing import span
+
+VISION_MODEL = "gpt-4-vision-preview"
+VISION_MAX_TOKENS = 300
+# Completion tokens per page for the JSON around a batched page's description
+BATCH_FORMAT_TOKENS = 30
 
 
 def get_pdf_page_count(pdf_path):
@@ -21,155 +30,429 @@ def get_pdf_page_count(pdf_path):
     return page_count
 
 
-def convert_pdf_to_jpeg(pdf_path, zoom_factor=1, output_folder_path="tmp"):
-    # Open the PDF file
-    pdf = fitz.open(pdf_path)
-
-    # Check if the directory exists
-    if not os.path.exists(output_folder_path):
-        # Create the directory if it does not exist
-        os.makedirs(output_folder_path)
-
-    files = []
+@dataclass(frozen=True)
+class SlideBatching:
+    # Most pages sent in one request; 1 sends every page on its own
+    max_slides: int = 4
+    # Upper limit for the billed image tokens of one request, so high-detail pages go in smaller batches
+    max_image_tokens: int = 3000
+    # Upper limit for the encoded images of one request
+    max_bytes: int = 8_000_000
 
-    # Delete
-    print(f'Number of pages: {len(pdf)}')
 
-    for page_number in range(len(pdf)):
-        # Get the page
-        page = pdf.load_page(page_number)
+def batch_prompt(prompt, count):
+    return prompt + batch_vision_prompt.format(count=count)
 
-        # Define the zoom factor for the resolution; lower values = lower resolution
-        # A zoom factor of 1 is normal size, less than 1 is reduced size
-        mat = fitz.Matrix(zoom_factor, zoom_factor)
 
-        # Render page to an image (pix) object with the zoom factor
-        pix = page.get_pixmap(matrix=mat)
-        image_data = pix.tobytes("ppm")
-
-        # Open the image using PIL
-        image = Image.open(io.BytesIO(image_data))
-
-        # Convert to JPEG
-        jpeg_image = image.convert("RGB")
+def parse_batch_descriptions(content, page_numbers):
+    """
+    Splits the JSON answer to a batched request into the descriptions of the pages,
+    in the order of page_numbers. None if the answer is not JSON or misses a page.
+    """
+    start, end = content.find("{"), content.rfind("}")
+    if start < 0 or end < start:
+        return None
+    try:
+        slides = json.loads(content[start:end + 1])["slides"]
+        descriptions = {int(slide["slide"]): slide["description"] for slide in slides}
+    except (ValueError, KeyError, TypeError):
+        return None
 
-        filename = f"{output_folder_path}/page_{page_number + 1}.png"
+    descriptions = [descriptions.get(page_number) for page_number in page_numbers]
+    if not all(isinstance(description, str) and description.strip() for description in descriptions):
+        return None
+    return [description.strip() for description in descriptions]
 
-        jpeg_image.save(filename, "PNG")
-        files.append(filename)
 
-    pdf.close()
-    print("Finished converting PDF to PNG. File names:")
-    print(files)
-    return files
+def vision_max_tokens(count, labelled=False):
+    return VISION_MAX_TOKENS * count + (BATCH_FORMAT_TOKENS * count if labelled else 0)
 
 
-async def interpret_image(client, image_path, prompt, delete_file=False, api_key=None):
+def vision_cost(prompt_tokens, completion_tokens):
+    input_cost_per_1000_tokens = 0.01
+    output_cost_per_1000_tokens = 0.03
+    return input_cost_per_1000_tokens / 1000 * prompt_tokens + output_cost_per_1000_tokens / 1000 * completion_tokens
+
+
+def vision_payload(images, prompt, page_numbers=None, labelled=False):
+    """ Chat completion request body for the images; with labelled every image is preceded by its "Slide N:" label """
+    content = [{"type": "text", "text": prompt}]
+    for image_bytes, page_number in zip(images, page_numbers or [None] * len(images)):
+        if labelled:
+            content.append({"type": "text", "text": f"Slide {page_number}:"})
+        base64_image = base64.b64encode(image_bytes).decode('utf-8')
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{mime_type(sniff_format(image_bytes))};base64,{base64_image}",
+                "detail": image_detail(image_bytes)
+            }
+        })
+    return {
+        "model": VISION_MODEL,
+        "messages": [{"role": "user", "content": content}],
+        "max_tokens": vision_max_tokens(len(images), labelled)
+    }
 
-    # OpenAI API Key
-    if not api_key:
-        load_dotenv()
-        api_key = os.environ['OPENAI_API_KEY']
 
-    # Function to encode the image
-    def encode_image(image_path):
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+async def request_vision(client, images, prompt, api_key=None, page_numbers=None, scheduler=None, labelled=False):
+    """
+    Sends the images with the prompt in one chat completion, returns the answer and the
+    cost ("" and 0 if the request failed). With labelled every image is preceded by its
+    "Slide N:" label.
+    """
 
-    # Getting the base64 string
-    base64_image = encode_image(image_path)
+    # Key and endpoint are resolved once per process, not per page
+    settings = get_settings(api_key)
+    api_key = settings.api_key
 
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}"
     }
 
-    payload = {
-        "model": "gpt-4-vision-preview",
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    }
-                ]
-            }
-        ],
-        "max_tokens": 300
-    }
+    details = [image_detail(image_bytes) for image_bytes in images]
+    max_tokens = vision_max_tokens(len(images), labelled)
 
-    input_cost_per_1000_tokens = 0.01
-    output_cost_per_1000_tokens = 0.03
-
-    # Send the request & extract the description
-    try:
-        response = await client.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-
-        total_cost = input_cost_per_1000_tokens / 1000 * \
-            response.json()["usage"]["prompt_tokens"] + output_cost_per_1000_tokens / \
-            1000 * response.json()["usage"]["completion_tokens"]
-        description = response.json()["choices"][0]["message"]["content"]
-
-    except Exception as e:
-        print(f"Error processing image {image_path}:\n{e}")
-        total_cost = 0
-        description = ""
-
-    # Delete temp file (Deleted whether or not the request was successful)
-        if delete_file:
-            os.remove(image_path)
+    if scheduler is None:
+        scheduler = get_scheduler(api_key)
 
-    return description, total_cost
+    # Rough budget for the tokens-per-minute limiter: text + images + completion
+    estimated_tokens = len(prompt) // 4 + sum(estimate_image_tokens(image_bytes) for image_bytes in images) + max_tokens
 
-
-async def process_pdf(pdf_path, prompt_per_page, zoom_factor=1, delete_temp_files=False, api_key=None):
-
-    # Convert PDF to JPEG
-    jpeg_paths = convert_pdf_to_jpeg(pdf_path, zoom_factor=zoom_factor)
-    length = len(jpeg_paths)
+    # Send the request & extract the description
+    # Size of the base64 images, 4 characters per 3 bytes
+    base64_length = sum((len(image_bytes) + 2) // 3 * 4 for image_bytes in images)
+    attributes = {"page_number": page_numbers[0]} if len(images) == 1 else {"page_numbers": list(page_numbers)}
+    with span("api.vision", **attributes, model=VISION_MODEL, detail=details[0] if len(set(details)) == 1 else "mixed",
+              bytes=base64_length + len(prompt)) as api_span:
+        try:
+            # The payload is built only once the scheduler lets the request go, so pages waiting
+            # for a slot hold their encoded bytes and not also a base64 copy; it is dropped once
+            # httpx has serialized it
+            response = await scheduler.run(
+                lambda: client.post(f"{settings.base_url}/chat/completions", headers=headers,
+                                    json=vision_payload(images, prompt, page_numbers, labelled)),
+                estimated_tokens=estimated_tokens)
+            response.raise_for_status()
+
+            usage = response.json()["usage"]
+            total_cost = vision_cost(usage["prompt_tokens"], usage["completion_tokens"])
+            answer = response.json()["choices"][0]["message"]["content"]
+            api_span.set(status=response.status_code, prompt_tokens=usage["prompt_tokens"],
+                         completion_tokens=usage["completion_tokens"], cost=total_cost)
+
+        except Exception as e:
+            print(f"Error processing page{'s' if len(images) > 1 else ''} {', '.join(map(str, page_numbers))}:\n{e}")
+            api_span.set(error=f"{type(e).__name__}: {e}")
+            total_cost = 0
+            answer = ""
+
+    return answer, total_cost
+
+
+async def interpret_image(client, image_bytes, prompt, api_key=None, page_number=None, scheduler=None):
+    """ Describes one page, returns the description ("" if the request failed) and the cost """
+    return await request_vision(client, [image_bytes], prompt, api_key=api_key, page_numbers=[page_number], scheduler=scheduler)
+
+
+async def interpret_images(client, images, prompt, api_key=None, page_numbers=None, scheduler=None):
+    """
+    Describes several pages in one request. Returns their descriptions in the order of the
+    images, or None if the request failed or its answer couldn't be split into them, and the cost.
+    """
+    answer, cost = await request_vision(client, images, batch_prompt(prompt, len(images)), api_key=api_key,
+                                        page_numbers=page_numbers, scheduler=scheduler, labelled=True)
+    return (parse_batch_descriptions(answer, page_numbers) if answer else None), cost
+
+
+async def process_pdf(pdf_path, prompt_per_page, zoom_factor=1, image_format="jpeg", quality=80, debug_folder=None, api_key=None, rate_limits=None, use_cache=True, cache=None, run_id=None, pages=None, triage=False, triage_settings=None, budget=None, max_inflight_bytes=DEFAULT_MAX_INFLIGHT_BYTES, page_callback=None, batching=None):
+
+    api_key = get_settings(api_key).api_key
+
+    # Requests for the same key share one scheduler, also across concurrent decks
+    if rate_limits is not None:
+        scheduler = configure_rate_limits(api_key, rate_limits)
+    else:
+        scheduler = get_scheduler(api_key)
+
+    # With triage only image-heavy pages go to vision, text pages use the PDF's own text;
+    # it reads every page, so it runs in the render pool instead of on the event loop
+    plan = await asyncio.get_running_loop().run_in_executor(
+        get_render_pool(), triage_pages, pdf_path, triage_settings) if triage else None
+    page_numbers = [page["page_number"] for page in plan if page["kind"] == PAGE_VISION] if triage else None
+
+    # Pages are rendered in worker processes and sent while the rest are still rendering;
+    # debug images need the whole deck, so that path renders everything first
+    if pages is None and debug_folder is None:
+        if page_numbers is None:
+            page_numbers = list(range(1, get_pdf_page_count(pdf_path) + 1))
+        pages = PageRenderPipeline(pdf_path, page_numbers, zoom_factor=zoom_factor, image_format=image_format,
+                                   quality=quality, budget=budget, max_inflight_bytes=max_inflight_bytes)
+    elif pages is None:
+        pages = render_pdf_pages(pdf_path, zoom_factor=zoom_factor, image_format=image_format,
+                                 quality=quality, debug_folder=debug_folder, page_numbers=page_numbers, budget=budget)
+    elif page_numbers is not None:
+        pages = [pages[page_number - 1] for page_number in page_numbers]
+
+    # Decks described on the same event loop share its connection pool
+    descriptions, total_cost = await describe_pages(
+        get_async_client(), pages, prompt_per_page, zoom_factor=zoom_factor, api_key=api_key, scheduler=scheduler,
+        use_cache=use_cache, cache=cache, run_id=run_id, page_numbers=page_numbers, page_callback=page_callback,
+        batching=batching)
+
+    if not triage or (descriptions == [] and page_numbers):
+        return descriptions, total_cost
+    return merge_descriptions(plan, dict(zip(page_numbers, descriptions))), total_cost
+
+
+async def describe_pages(client, pages, prompt_per_page, zoom_factor=1, api_key=None, scheduler=None, use_cache=True, cache=None, run_id=None, page_numbers=None, page_callback=None, batching=None):
+    """
+    Describes rendered pages, returns the "Slide N:" descriptions ([] if any page failed) and the cost.
+    page_numbers are the 1-based PDF page numbers of the pages, when not all pages are given.
+    pages is either a list of encoded images or a PageRenderPipeline, whose pages are sent as soon as they are rendered.
+    page_callback(done, total) is called after every finished page.
+    With batching (a SlideBatching) several pages go out per request; see describe_batched.
+    """
+    streamed = isinstance(pages, PageRenderPipeline)
+    if streamed:
+        page_numbers = list(pages.page_numbers)
+    length = len(pages)
+    if page_numbers is None:
+        page_numbers = list(range(1, length + 1))
+    batched = batching is not None and batching.max_slides > 1
+
+    # Descriptions are cached by page content, prompt and request settings
+    if use_cache and cache is None:
+        cache = get_default_cache()
+    cache_hits = 0
+    # Batched requests whose answer couldn't be split still cost something
+    failed_batch_cost = 0.0
+    requests = 0
+
+    # Pages finished in an earlier attempt of the same run are not sent again
+    state = load_checkpoint(run_id, "vision") or {"descriptions": {}, "cost": 0.0}
+    if state["descriptions"]:
+        print(f'Resuming run {run_id}: {len(state["descriptions"])}/{length} pages already done')
 
     print(f'Processing {length} pages...')
 
     # Interpret each page
-    async with httpx.AsyncClient(timeout=40.0) as client:
-        progress_bar = tqdm(range(length))
-
-        async def interpret_and_update(i):
-            time.sleep(i * 0.5 + 0.1)  # To avoid rate limiting
-            result = await interpret_image(client, jpeg_paths[i], prompt_per_page, delete_file=delete_temp_files, api_key=api_key)
-            progress_bar.update(1)
+    progress_bar = tqdm(range(length))
+
+    def page_done():
+        progress_bar.update(1)
+        if page_callback is not None:
+            page_callback(progress_bar.n, length)
+
+    def known(i, image_bytes):
+        # The page's description from the run's checkpoint or the cache, None if it has to be sent
+        nonlocal cache_hits
+        page_key = str(page_numbers[i])
+        if page_key in state["descriptions"]:
+            page_done()
+            return state["descriptions"][page_key], 0.0
+
+        cached = cache.get(page_cache_key(image_bytes)) if use_cache else None
+        if cached is None:
+            return None
+        cache_hits += 1
+        return remember(i, image_bytes, (cached, 0.0), from_cache=True)
+
+    def page_cache_key(image_bytes):
+        # Batched and single requests share the entries, both answer the per-page prompt
+        return cache_key(image_bytes, prompt_per_page, VISION_MODEL, zoom_factor, VISION_MAX_TOKENS)
+
+    def remember(i, image_bytes, result, from_cache=False):
+        # Failed pages are not cached so they are retried next time
+        if not from_cache and use_cache and result[0] != "":
+            cache.put(page_cache_key(image_bytes), result[0], result[1])
+
+        if result[0] != "" and run_id is not None:
+            state["descriptions"][str(page_numbers[i])] = result[0]
+            state["cost"] += result[1]
+            save_checkpoint(run_id, "vision", state)
+
+        page_done()
+        return result
+
+    # Pacing and retries are left to the scheduler
+    async def interpret_and_update(i, image_bytes):
+        nonlocal requests
+        result = known(i, image_bytes)
+        if result is not None:
             return result
-
-        tasks = [interpret_and_update(i) for i in range(length)]
-        results = await asyncio.gather(*tasks)
-        progress_bar.close()
+        requests += 1
+        result = await interpret_image(client, image_bytes, prompt_per_page,
+                                       api_key=api_key, page_number=page_numbers[i], scheduler=scheduler)
+        return remember(i, image_bytes, result)
+
+    async def upload(i, image_bytes):
+        try:
+            return await interpret_and_update(i, image_bytes)
+        finally:
+            # Lets the pipeline render further pages in its place
+            pages.release(image_bytes)
+
+    async def describe_stream():
+        # Pages done earlier in the run are not rendered again
+        done = [page_number for page_number in page_numbers if str(page_number) in state["descriptions"]]
+        pages.skip(done)
+        index = {page_number: i for i, page_number in enumerate(page_numbers)}
+        tasks = {index[page_number]: asyncio.create_task(interpret_and_update(index[page_number], None)) for page_number in done}
+        try:
+            # Each page goes out as soon as it is rendered; the scheduler paces the requests
+            async for page_number, image_bytes in pages:
+                tasks[index[page_number]] = asyncio.create_task(upload(index[page_number], image_bytes))
+            return await asyncio.gather(*[tasks[i] for i in range(length)])
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+    # Pages per request: halved when an answer can't be split, grown back one by one after good answers
+    batch_limit = batching.max_slides if batched else 1
+
+    async def interpret_batch(batch):
+        nonlocal batch_limit, failed_batch_cost, requests
+        try:
+            if len(batch) == 1:
+                i, image_bytes = batch[0]
+                return [(i, await interpret_and_update(i, image_bytes))]
+
+            requests += 1
+            numbers = [page_numbers[i] for i, _ in batch]
+            descriptions, cost = await interpret_images(client, [image_bytes for _, image_bytes in batch], prompt_per_page,
+                                                        api_key=api_key, page_numbers=numbers, scheduler=scheduler)
+            if descriptions is None:
+                print(f"Couldn't split the answer for slides {', '.join(map(str, numbers))}, sending them one by one")
+                batch_limit = max(1, batch_limit // 2)
+                if run_id is not None:
+                    state["cost"] += cost
+                else:
+                    failed_batch_cost += cost
+                results = await asyncio.gather(*[interpret_and_update(i, image_bytes) for i, image_bytes in batch])
+                return [(i, result) for (i, _), result in zip(batch, results)]
+
+            batch_limit = min(batching.max_slides, batch_limit + 1)
+            # The request's cost is shared evenly by its pages
+            return [(i, remember(i, image_bytes, (description, cost / len(batch))))
+                    for (i, image_bytes), description in zip(batch, descriptions)]
+        finally:
+            if streamed:
+                for _, image_bytes in batch:
+                    pages.release(image_bytes)
+
+    async def describe_batched():
+        """
+        Groups the pages to send, in the order they are ready, into requests of at most
+        batch_limit pages within the image token and byte limits of batching. A request
+        whose answer can't be split into the pages is sent again page by page.
+        """
+        results, tasks = {}, []
+        pending, pending_tokens, pending_bytes = [], 0, 0
+
+        def flush():
+            nonlocal pending, pending_tokens, pending_bytes
+            if pending:
+                tasks.append(asyncio.create_task(interpret_batch(pending)))
+            pending, pending_tokens, pending_bytes = [], 0, 0
+
+        async def ready_pages():
+            if streamed:
+                index = {page_number: i for i, page_number in enumerate(page_numbers)}
+                async for page_number, image_bytes in pages:
+                    yield index[page_number], image_bytes
+            else:
+                for i in range(length):
+                    yield i, pages[i]
+
+        if streamed:
+            # Pages done earlier in the run are not rendered again
+            done = [i for i, page_number in enumerate(page_numbers) if str(page_number) in state["descriptions"]]
+            pages.skip([page_numbers[i] for i in done])
+            for i in done:
+                results[i] = known(i, None)
+
+        try:
+            async for i, image_bytes in ready_pages():
+                result = known(i, image_bytes)
+                if result is not None:
+                    results[i] = result
+                    if streamed:
+                        pages.release(image_bytes)
+                    continue
+
+                tokens = estimate_image_tokens(image_bytes)
+                if pending and (len(pending) >= batch_limit or pending_tokens + tokens > batching.max_image_tokens
+                                or pending_bytes + len(image_bytes) > batching.max_bytes):
+                    flush()
+                pending.append((i, image_bytes))
+                pending_tokens += tokens
+                pending_bytes += len(image_bytes)
+
+                # Held pages count towards the pipeline's memory ceiling, so a stalled pipeline gets them sent
+                if len(pending) >= batch_limit or (streamed and pages.inflight_bytes >= pages.max_inflight_bytes):
+                    flush()
+            flush()
+
+            for batch_results in await asyncio.gather(*tasks):
+                results.update(batch_results)
+            return [results[i] for i in range(length)]
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    # Page requests started inside the span are traced as its children
+    with span("vision.describe", pages=length, streamed=streamed, batched=batched) as describe_span:
+        if batched:
+            results = await describe_batched()
+        elif streamed:
+            results = await describe_stream()
+        else:
+            results = await asyncio.gather(*[interpret_and_update(i, pages[i]) for i in range(length)])
+        if streamed:
+            describe_span.set(first_page_after=pages.first_page_after, peak_inflight_bytes=pages.peak_inflight_bytes)
+        describe_span.set(cache_hits=cache_hits, requests=requests)
+    progress_bar.close()
+
+    if use_cache:
+        print(f'Vision cache: {cache_hits}/{length} pages reused')
+    if batched:
+        print(f'Vision requests: {requests} for {length} pages')
 
     descriptions = [result[0] for result in results]
-    total_cost = sum([result[1] for result in results])
+    # Includes what earlier attempts of the run spent
+    total_cost = state["cost"] if run_id is not None else sum([result[1] for result in results]) + failed_batch_cost
 
     # Check if any of the descriptions are empty
-    # TODO: Return unprocessed incides/image paths to enable rerunning
+    # Rerunning with the same run_id only processes the missing pages
     if any([description == "" for description in descriptions]):
         return [], total_cost
 
-    descriptions = [f'Slide {i + 1}:\n{results[i][0]}' for i in range(length)]
+    descriptions = [f'Slide {page_numbers[i]}:\n{results[i][0]}' for i in range(length)]
     print(f'Finished processing {length} pages. Total cost: {total_cost}')
 
     return descriptions, total_cost
 
 
-def get_descriptions(pdf_path, prompt_per_page=main_prompt, zoom_factor=1.0, delete_temp_files=False, api_key=None):
-    descriptions, cost = asyncio.run(process_pdf(
-        pdf_path, prompt_per_page, zoom_factor=zoom_factor, delete_temp_files=delete_temp_files, api_key=api_key))
-    return descriptions, cost
+async def get_descriptions_async(pdf_path, prompt_per_page=main_prompt, zoom_factor=1.0, image_format="jpeg", quality=80, debug_folder=None, api_key=None, rate_limits=None, use_cache=True, cache=None, run_id=None, pages=None, triage=False, triage_settings=None, budget=None, max_inflight_bytes=DEFAULT_MAX_INFLIGHT_BYTES, page_callback=None, batching=None, timeout=None):
+    """
+    Describes the pages of the PDF on the running event loop, returns the descriptions and the cost.
+    Past timeout seconds the pages still in flight are cancelled and asyncio.TimeoutError raised;
+    with a run_id the pages already described are kept for the next attempt.
+    """
+    return await asyncio.wait_for(process_pdf(
+        pdf_path, prompt_per_page, zoom_factor=zoom_factor, image_format=image_format, quality=quality,
+        debug_folder=debug_folder, api_key=api_key, rate_limits=rate_limits, use_cache=use_cache, cache=cache, run_id=run_id, pages=pages,
+        triage=triage, triage_settings=triage_settings, budget=budget, max_inflight_bytes=max_inflight_bytes,
+        page_callback=page_callback, batching=batching), timeout)
+
+
+def get_descriptions(pdf_path, *args, **kwargs):
+    """ Blocking get_descriptions_async """
+    return run_sync(lambda: get_descriptions_async(pdf_path, *args, **kwargs))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,130 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+
+
+DEFAULT_CACHE_PATH = os.path.join(".cache", "vision_descriptions.sqlite3")
+
+
+def cache_key(image_bytes, prompt, model, zoom_factor, max_tokens):
+    """ Content address of one vision request: the rendered page plus everything that shapes the answer """
+    digest = hashlib.sha256(image_bytes)
+    digest.update(json.dumps([prompt, model, zoom_factor, max_tokens]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class DescriptionCache:
+    """
+    SQLite-backed cache of per-slide vision descriptions. Entries older than
+    max_age_days are dropped, and the least recently used entries are evicted
+    once the stored descriptions exceed max_bytes.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=50_000_000, max_age_days=30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Shared between the Streamlit script threads, access is serialized by the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS descriptions (
+                key TEXT PRIMARY KEY,
+                description TEXT NOT NULL,
+                cost REAL NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS descriptions_last_used ON descriptions (last_used)")
+        self._conn.commit()
+
+    def get(self, key):
+        """ Returns the cached description for key, or None """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT description, created FROM descriptions WHERE key = ?", (key,)).fetchone()
+
+            if row is None or now - row[1] > self.max_age:
+                self.misses += 1
+                return None
+
+            self._conn.execute("UPDATE descriptions SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, description, cost=0.0):
+        now = time.time()
+        size = len(description.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO descriptions VALUES (?, ?, ?, ?, ?, ?)",
+                (key, description, cost, size, now, now))
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM descriptions WHERE created < ?", (now - self.max_age,))
+
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM descriptions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Drop least recently used entries until the cache fits again
+        to_delete = []
+        for key, size in self._conn.execute("SELECT key, size FROM descriptions ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM descriptions WHERE key = ?", to_delete)
+
+    def stats(self):
+        with self._lock:
+            entries, size, saved = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(cost), 0) FROM descriptions").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+            # What the cached entries originally cost to generate
+            "stored_cost": saved,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM descriptions")
+            self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = DescriptionCache()
+        return _default_cache